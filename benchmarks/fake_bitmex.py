@@ -0,0 +1,262 @@
+"""Local stand-ins for the Bitmex REST API and the instrument websocket feed"""
+import json
+import time
+import uuid
+import asyncio
+import datetime
+import threading
+import typing as typ
+from urllib.parse import urlparse, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import websockets
+from bravado.client import SwaggerClient
+from bravado.requests_client import RequestsClient
+from BitMEXAPIKeyAuthenticator import APIKeyAuthenticator
+
+from orders import frames
+
+
+def _operation(operation_id: str, params: typ.Dict[str, str], location: str, many: bool = False) -> dict:
+    schema = {'type': 'array', 'items': {'type': 'object'}} if many else {'type': 'object'}
+    return {
+        'operationId': operation_id,
+        'tags': ['Order'],
+        'parameters': [
+            {'name': name, 'in': location, 'required': False, 'type': type_}
+            for name, type_ in params.items()
+        ],
+        'responses': {'200': {'description': 'OK', 'schema': schema}},
+    }
+
+
+def swagger_spec(host: str) -> dict:
+    """Minimal subset of the Bitmex swagger spec used by the project"""
+    return {
+        'swagger': '2.0',
+        'info': {'title': 'Fake Bitmex API', 'version': '1.0.0'},
+        'host': host,
+        'basePath': '/api/v1',
+        'schemes': ['http'],
+        'consumes': ['application/x-www-form-urlencoded'],
+        'produces': ['application/json'],
+        'paths': {
+            '/order': {
+                'get': _operation('Order.getOrders', {
+                    'filter': 'string', 'count': 'number', 'start': 'number',
+                    'reverse': 'boolean', 'startTime': 'string',
+                }, location='query', many=True),
+                'post': _operation('Order.new', {
+                    'symbol': 'string', 'side': 'string', 'orderQty': 'number',
+                    'price': 'number', 'ordType': 'string',
+                }, location='formData'),
+                'put': _operation('Order.amend', {
+                    'orderID': 'string', 'orderQty': 'number', 'price': 'number',
+                }, location='formData'),
+                'delete': _operation('Order.cancel', {'orderID': 'string'}, location='formData', many=True),
+            },
+            '/order/bulk': {
+                'put': _operation('Order.amendBulk', {'orders': 'string'}, location='formData', many=True),
+            },
+        },
+    }
+
+
+class FakeBitmexServer:
+    """Bitmex REST API stand-in keeping orders in memory
+
+    :param latency: emulated exchange processing time in seconds
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.orders: typ.Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def host(self) -> str:
+        return '%s:%s' % self._httpd.server_address[:2]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def client(self, api_key: str = None, api_secret: str = None, **_):
+        """Create a bravado client the same way `bitmex.bitmex` does, but for this server"""
+        config = {'use_models': False, 'validate_responses': False, 'also_return_response': True}
+        http_client = RequestsClient()
+        http_client.authenticator = APIKeyAuthenticator(f'http://{self.host}', api_key, api_secret)
+        return SwaggerClient.from_url(
+            f'http://{self.host}/api/explorer/swagger.json',
+            config=config,
+            http_client=http_client,
+        )
+
+    def new_order(self, params: dict) -> dict:
+        now = _now_()
+        order = {
+            'orderID': str(uuid.uuid4()),
+            'symbol': params.get('symbol'),
+            'side': params.get('side'),
+            'orderQty': int(float(params.get('orderQty') or 0)),
+            'price': float(params['price']) if params.get('price') else None,
+            'ordType': params.get('ordType', 'Limit'),
+            'ordStatus': 'New',
+            'cumQty': 0,
+            'avgPx': None,
+            'transactTime': now,
+            'timestamp': now,
+        }
+        with self._lock:
+            self.orders[order['orderID']] = order
+        return order
+
+    def amend_order(self, params: dict) -> typ.Optional[dict]:
+        with self._lock:
+            if not (order := self.orders.get(params.get('orderID'))):
+                return None
+            if params.get('orderQty'):
+                order['orderQty'] = int(float(params['orderQty']))
+            if params.get('price'):
+                order['price'] = float(params['price'])
+            order['timestamp'] = _now_()
+            return dict(order)
+
+    def cancel_order(self, order_id: str) -> typ.Optional[dict]:
+        with self._lock:
+            if not (order := self.orders.get(order_id)):
+                return None
+            order.update(ordStatus='Canceled', timestamp=_now_())
+            return dict(order)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, data, status=200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _params(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else ''
+                return dict(parse_qsl(body or urlparse(self.path).query))
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/api/explorer/swagger.json':
+                    return self._reply(swagger_spec(server.host))
+                time.sleep(server.latency)
+                filter_ = json.loads(dict(parse_qsl(url.query)).get('filter') or '{}')
+                with server._lock:
+                    orders = [
+                        dict(order) for order in server.orders.values()
+                        if all(order.get(key) == value for key, value in filter_.items())
+                    ]
+                self._reply(orders)
+
+            def do_POST(self):
+                time.sleep(server.latency)
+                self._reply(server.new_order(self._params()))
+
+            def do_PUT(self):
+                time.sleep(server.latency)
+                params = self._params()
+                if urlparse(self.path).path.endswith('/bulk'):
+                    amended = [server.amend_order(order) for order in json.loads(params.get('orders', '[]'))]
+                    return self._reply([order for order in amended if order])
+                if (order := server.amend_order(params)) is None:
+                    return self._reply({'error': {'message': 'Not Found', 'name': 'HTTPError'}}, status=404)
+                self._reply(order)
+
+            def do_DELETE(self):
+                time.sleep(server.latency)
+                if (order := server.cancel_order(self._params().get('orderID'))) is None:
+                    return self._reply({'error': {'message': 'Not Found', 'name': 'HTTPError'}}, status=404)
+                self._reply([order])
+
+        return Handler
+
+
+# a few frames of the Bitmex `instrument` topic, used when no recorded frames are given
+SAMPLE_FRAMES = [
+    {'table': 'instrument', 'action': 'update', 'data': [
+        {'symbol': 'XBTUSD', 'lastPrice': 9500.5 + step, 'timestamp': ''},
+        {'symbol': 'ETHUSD', 'lastPrice': 240.15 + step / 100, 'timestamp': ''},
+        {'symbol': '.EVOL7D', 'fairPrice': 5.48, 'timestamp': ''},
+    ]}
+    for step in range(10)
+]
+
+
+class FakeInstrumentFeed:
+    """Bitmex instrument websocket stand-in replaying frames at the needed rate
+
+    Every instrument `timestamp` is replaced by the send time,
+    so receivers can measure the relay latency.
+
+    :param frames: upstream frames to replay in a loop
+    :param rate: frames per second (0 - as fast as possible)
+    """
+
+    def __init__(self, frames: typ.Sequence[dict] = None, rate: float = 100):
+        self.frames = list(frames or SAMPLE_FRAMES)
+        self.rate = rate
+        self.sent = 0
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f'ws://{host}:{port}/realtime?subscribe=instrument'
+
+    async def __aenter__(self):
+        self._server = await websockets.serve(self._replay, '127.0.0.1', 0)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _replay(self, ws, path):
+        delay = 1 / self.rate if self.rate else 0
+        position = 0
+        while ws.open:
+            frame = self.frames[position % len(self.frames)]
+            position += 1
+            timestamp = _now_()
+            for instrument_info in frame.get('data', ()):
+                instrument_info['timestamp'] = timestamp
+            await ws.send(json.dumps(frame))
+            self.sent += 1
+            await asyncio.sleep(delay)
+
+
+def load_frames(path: str) -> typ.List[dict]:
+    """Load recorded upstream frames (a frames file of the relay recorder or one JSON frame per line)"""
+    with open(path, 'rb') as frames_file:
+        is_recording = frames_file.read(len(frames.MAGIC)) == frames.MAGIC
+    if is_recording:
+        return [json.loads(frame) for _, frame in frames.read_frames(path)]
+    with open(path) as frames_file:
+        return [json.loads(line) for line in frames_file if line.strip()]
+
+
+def _now_() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
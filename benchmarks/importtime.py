@@ -0,0 +1,112 @@
+"""Startup (import time) benchmark of the worker processes
+
+Imports the project in fresh interpreters with `python -X importtime`,
+as a web/websocket worker or a management command does on a cold start:
+
+    $ python -m benchmarks.importtime --runs 5
+
+The exchange client libraries are imported on their first use only
+(see orders/exchange.py), the `web` scenario reports them if they are loaded.
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+import typing as typ
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETUP = 'import django; django.setup()'
+SCENARIOS = {
+    # management commands, migrations
+    'setup': SETUP,
+    # REST and websocket workers
+    'web': f'{SETUP}; import bitmex_orders.urls, bitmex_orders.routing',
+    # a worker after its first Bitmex call
+    'exchange': f'{SETUP}; import bitmex_orders.urls, bitmex_orders.routing; '
+                f'from orders import exchange; exchange.HTTPError, exchange.ConnectionClosed; import bitmex',
+}
+
+# heavy libraries which are not needed until the first Bitmex call
+EXCHANGE_LIBRARIES = ('bitmex', 'bravado', 'websockets', 'BitMEXAPIKeyAuthenticator')
+
+
+class Sample(typ.NamedTuple):
+    # cumulative import seconds by the top-level imported packages
+    packages: typ.Dict[str, float]
+    # every imported module name
+    modules: typ.Set[str]
+
+    @property
+    def total(self) -> float:
+        return sum(self.packages.values())
+
+
+class Result(typ.NamedTuple):
+    scenario: str
+    samples: typ.List[Sample]
+
+    @property
+    def median(self) -> Sample:
+        return sorted(self.samples, key=lambda sample: sample.total)[len(self.samples) // 2]
+
+    def report(self, top: int) -> str:
+        totals = [sample.total for sample in self.samples]
+        loaded = [
+            library for library in EXCHANGE_LIBRARIES
+            if any(module == library or module.startswith(f'{library}.') for module in self.median.modules)
+        ]
+        lines = [
+            f'{self.scenario:<10} {len(self.samples):>3} runs '
+            f'median {statistics.median(totals) * 1000:>8.1f} ms '
+            f'min {min(totals) * 1000:>8.1f} ms '
+            f'exchange libraries: {", ".join(loaded) or "not loaded"}'
+        ]
+        heaviest = sorted(self.median.packages.items(), key=lambda item: item[1], reverse=True)[:top]
+        lines += [f'    {package:<32} {seconds * 1000:>8.1f} ms' for package, seconds in heaviest]
+        return '\n'.join(lines)
+
+
+def measure(code: str) -> Sample:
+    """Run the code in a fresh interpreter and parse its `-X importtime` report
+
+    :param code: python code to run
+    :return: import times of the run
+    """
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'bitmex_orders.settings'}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(f'Failed to run {code!r}:\n{result.stderr[-2000:]}')
+
+    packages, modules = defaultdict(float), set()
+    for line in result.stderr.splitlines():
+        # import time: <self us> | <cumulative us> | <nesting indent><module>
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line.split('|')
+        module = name[1:]
+        modules.add(module.strip())
+        if not module.startswith(' '):
+            packages[module.split('.')[0]] += int(cumulative) / 1e6
+    return Sample(dict(packages), modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per scenario')
+    parser.add_argument('--top', type=int, default=8, help='heaviest top-level packages to show')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    args = parser.parse_args()
+
+    for scenario in args.scenarios:
+        result = Result(scenario, [measure(SCENARIOS[scenario]) for _ in range(args.runs)])
+        print(result.report(args.top))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Memory/allocation benchmark of the relayed instrument messages
+
+Relays upstream instrument frames through the relay path (the transform
+pipeline, the in-memory channel layer copy per subscriber and the JSON
+encoding per subscriber) under `tracemalloc`, once with the plain message
+dicts and once with the compact ticks (see orders/ticks.py):
+
+    $ python -m benchmarks.memory --ticks 100000 --subscribers 5
+
+The reported numbers are per 100k relayed ticks: the memory blocks and bytes
+retained by the backlogs of the relayed ticks (e.g. the outbound queues of slow
+clients), the peak traced memory and the generation 0 garbage collections.
+"""
+import gc
+import copy
+import json
+import time
+import argparse
+import tracemalloc
+import typing as typ
+
+from orders import ticks
+from orders.pipeline import DEFAULT_KEY, get_pipeline
+
+ACCOUNT_NAME = 'benchmark'
+SYMBOLS = ('XBTUSD', 'ETHUSD', 'XRPUSD', 'BCHUSD', 'LTCUSD', 'EOSUSD', 'TRXUSD', 'ADAUSD')
+# instrument rows per upstream frame
+FRAME_ROWS = 8
+
+
+class Result(typ.NamedTuple):
+    scenario: str
+    ticks: int
+    elapsed: float
+    # memory blocks and bytes held by the backlogs of all the relayed ticks
+    blocks: int
+    retained: int
+    # peak traced memory, the backlog and the transient copies and encoded messages
+    peak: int
+    collections: int
+
+    def __str__(self):
+        scale = 100_000 / self.ticks
+        return (
+            f'{self.scenario:<8} {self.ticks:>8} ticks {self.ticks / self.elapsed:>10.1f} ticks/s '
+            f'per 100k: {self.blocks * scale:>9.0f} blocks {self.retained * scale / 1024:>9.1f} KiB retained '
+            f'{self.peak * scale / 1024:>9.1f} KiB peak {self.collections * scale:>6.0f} gc'
+        )
+
+
+def make_frames(count: int) -> typ.List[str]:
+    """Make upstream instrument frames of `FRAME_ROWS` rows each"""
+    return [
+        json.dumps({'table': 'instrument', 'action': 'update', 'data': [
+            {
+                'symbol': SYMBOLS[(number * FRAME_ROWS + row) % len(SYMBOLS)],
+                'lastPrice': 9000 + (number * FRAME_ROWS + row) % 1000 / 2,
+                'timestamp': f'2020-05-30T12:{number // 60 % 60:02}:{number % 60:02}.000Z',
+            }
+            for row in range(FRAME_ROWS)
+        ]})
+        for number in range(count)
+    ]
+
+
+def dict_message(row: dict, account: str) -> typ.Optional[dict]:
+    """The message dict of the default pipeline, as it was made before the ticks"""
+    if (value := row.get('lastPrice')) is None:
+        return None
+    return {'timestamp': row.get('timestamp'), 'account': account, 'symbol': row.get('symbol'), 'price': value}
+
+
+def relay(frames: typ.List[str], extract: typ.Callable[[dict, str], typ.Any], subscribers: int,
+          encode: typ.Callable[[typ.Any], str], backlog: typ.List) -> int:
+    """Relay the frames to every subscriber, keeping the received messages of all of them in the backlog"""
+    relayed = 0
+    for frame in frames:
+        for row in json.loads(frame)['data']:
+            if (message := extract(row, ACCOUNT_NAME)) is None:
+                continue
+            event = {'type': 'send_message', 'message': message, 'received_at': time.time()}
+            for _ in range(subscribers):
+                # InMemoryChannelLayer.send deep copies every message it queues
+                received = copy.deepcopy(event)['message']
+                encode(received)
+                backlog.append(received)
+            relayed += 1
+    return relayed
+
+
+def measure(scenario: str, frames: typ.List[str], subscribers: int) -> Result:
+    if scenario == 'dict':
+        extract, encode = dict_message, json.dumps
+    else:
+        extract, encode = get_pipeline(DEFAULT_KEY).extract, ticks.encode
+
+    backlog = []
+    gc.collect()
+    collections = gc.get_stats()[0]['collections']
+    tracemalloc.start()
+    started = time.perf_counter()
+    relayed = relay(frames, extract, subscribers, encode, backlog)
+    elapsed = time.perf_counter() - started
+    collections = gc.get_stats()[0]['collections'] - collections
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    statistics = snapshot.statistics('filename')
+    return Result(
+        scenario, relayed, elapsed,
+        blocks=sum(statistic.count for statistic in statistics),
+        retained=sum(statistic.size for statistic in statistics),
+        peak=peak,
+        collections=collections,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ticks', type=int, default=100_000, help='relayed ticks')
+    parser.add_argument('--subscribers', type=int, default=5, help='websocket subscribers of the account')
+    args = parser.parse_args()
+
+    frames = make_frames(max(args.ticks // FRAME_ROWS, 1))
+    for scenario in ('dict', 'tick'):
+        print(measure(scenario, frames, args.subscribers))
+
+
+if __name__ == '__main__':
+    main()
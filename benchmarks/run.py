@@ -0,0 +1,301 @@
+"""Latency/throughput benchmarks of the order API and the instrument relay
+
+Runs against a temporary test database and local Bitmex stand-ins, no network is needed:
+
+    $ python -m benchmarks.run --requests 200 --orders 10000 --subscribers 50
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+import datetime
+import typing as typ
+from unittest import mock
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bitmex_orders.settings')
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+
+from orders.metrics import Counter, Histogram  # noqa: E402
+from orders.admission import AdmissionController, Overloaded  # noqa: E402
+from orders.models import Account, Order, Side  # noqa: E402
+from orders.consumer import BitmexInstrumentConsumer, coordinator  # noqa: E402
+from bitmex_orders.routing import application  # noqa: E402
+from benchmarks.fake_bitmex import FakeBitmexServer, FakeInstrumentFeed, load_frames  # noqa: E402
+
+ACCOUNT_NAME = 'benchmark'
+
+# Bitmex requests served at once by the emulated overloaded exchange
+EXCHANGE_CAPACITY = 4
+
+
+class Result(typ.NamedTuple):
+    scenario: str
+    operations: int
+    elapsed: float
+    latency: Histogram
+    received_bytes: int = 0
+
+    def __str__(self):
+        return (
+            f'{self.scenario:<24} {self.operations:>8} ops '
+            f'{self.operations / self.elapsed:>10.1f} ops/s '
+            f'p50 {self.latency.percentile(50) * 1000:>8.3f} ms '
+            f'p99 {self.latency.percentile(99) * 1000:>8.3f} ms'
+        ) + (f' {self.received_bytes / self.elapsed / 1024:>10.1f} KiB/s' if self.received_bytes else '')
+
+
+def _measure_requests_(scenario: str, requests: int, send: typ.Callable[[int], typ.Any]) -> Result:
+    latency = Histogram()
+    started = time.perf_counter()
+    for number in range(requests):
+        request_started = time.perf_counter()
+        response = send(number)
+        latency.record(time.perf_counter() - request_started)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{scenario}: unexpected response {response.status_code} {response.data}')
+    return Result(scenario, requests, time.perf_counter() - started, latency)
+
+
+def bench_orders_post(client: APIClient, account: Account, requests: int) -> Result:
+    url = f'{reverse("orders")}?account={account.name}'
+    data = json.dumps({'symbol': 'XBTUSD', 'volume': 1, 'side': 'Buy'})
+    return _measure_requests_(
+        'Orders.post', requests,
+        lambda _: client.post(url, data=data, content_type='application/json'),
+    )
+
+
+def bench_orders_fanout(client: APIClient, accounts: int, requests: int) -> typ.List[Result]:
+    account_names = [
+        Account.objects.create(name=f'{ACCOUNT_NAME}-fanout-{number}', api_key='key', api_secret='secret').name
+        for number in range(accounts)
+    ]
+    url = reverse('orders-fanout')
+    data = json.dumps({'symbol': 'XBTUSD', 'volume': 1, 'side': 'Buy', 'accounts': account_names})
+    sequential_url = reverse('orders')
+    sequential_data = json.dumps({'symbol': 'XBTUSD', 'volume': 1, 'side': 'Buy'})
+
+    def send_sequentially(_):
+        for account_name in account_names:
+            response = client.post(
+                f'{sequential_url}?account={account_name}',
+                data=sequential_data,
+                content_type='application/json',
+            )
+        return response
+
+    return [
+        _measure_requests_(
+            f'Orders.post x{accounts}', requests, send_sequentially,
+        ),
+        _measure_requests_(
+            f'OrdersFanOut.post x{accounts}', requests,
+            lambda _: client.post(url, data=data, content_type='application/json'),
+        ),
+    ]
+
+
+def bench_overload(clients: int, requests: int, exchange_latency: float) -> typ.List[Result]:
+    """Latency of the accepted requests of `clients` threads calling an exchange slower than the load
+
+    The exchange serves `EXCHANGE_CAPACITY` requests at once, so without the
+    admission control the requests queue up on it and their latency grows
+    with the clients; with it the requests over the limits are shed (and
+    retried after the emulated `Retry-After`) and the accepted ones stay fast.
+    """
+    latency = max(exchange_latency, 0.005)
+    exchange_slots = threading.BoundedSemaphore(EXCHANGE_CAPACITY)
+    controllers = {
+        'unlimited': AdmissionController(max_concurrent=0, max_per_account=0, queue_size=0, queue_timeout=0),
+        'admission': AdmissionController(
+            max_concurrent=EXCHANGE_CAPACITY, max_per_account=0, queue_size=EXCHANGE_CAPACITY,
+            queue_timeout=latency * 2,
+        ),
+    }
+
+    results = []
+    for name, controller in controllers.items():
+        histogram, shed = Histogram(), Counter()
+
+        def send():
+            for _ in range(requests):
+                started = time.perf_counter()
+                try:
+                    with controller.admit(ACCOUNT_NAME), exchange_slots:
+                        time.sleep(latency)
+                except Overloaded:
+                    shed.inc()
+                    time.sleep(latency)
+                    continue
+                histogram.record(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=send) for _ in range(clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        print(f'overload x{clients} {name}: {shed.value} of {clients * requests} requests shed')
+        results.append(Result(f'overload x{clients} {name}', histogram.count, elapsed, histogram))
+    return results
+
+
+def bench_orders_get(client: APIClient, account: Account, requests: int, orders: int) -> typ.List[Result]:
+    Order.objects.filter(account=account).delete()
+    Order.objects.bulk_create(
+        Order(
+            order_id=f'bench-{number}',
+            symbol='XBTUSD',
+            volume=1,
+            side=Side.BUY if number % 2 else Side.SELL,
+            price=9000 + number % 100,
+            account=account,
+            status='New' if number % 10 == 0 else 'Filled',
+        )
+        for number in range(orders)
+    )
+    url = reverse('orders')
+    return [
+        _measure_requests_(
+            f'Orders.get[{orders}]', requests,
+            lambda _: client.get(url, {'account': account.name}),
+        ),
+        _measure_requests_(
+            f'Orders.get[{orders}] open', requests,
+            lambda _: client.get(url, {'account': account.name, 'status': 'open'}),
+        ),
+    ]
+
+
+def bench_order_detail(client: APIClient, account: Account, requests: int,
+                       server: FakeBitmexServer) -> typ.List[Result]:
+    order_ids = [
+        Order.objects.create(
+            order_id=server.new_order({'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 1, 'price': 9000})['orderID'],
+            symbol='XBTUSD', volume=1, side=Side.BUY, price=9000, account=account,
+        ).order_id
+        for _ in range(requests)
+    ]
+
+    def detail_url(number: int) -> str:
+        return f'{reverse("order-detail", kwargs={"order_id": order_ids[number]})}?account={account.name}'
+
+    return [
+        _measure_requests_(
+            'OrderDetail.get', requests,
+            lambda number: client.get(detail_url(number)),
+        ),
+        _measure_requests_(
+            'OrderDetail.patch', requests,
+            lambda number: client.patch(detail_url(number), data={'price': 9001}, format='json'),
+        ),
+        _measure_requests_(
+            'OrderDetail.delete', requests,
+            lambda number: client.delete(detail_url(number)),
+        ),
+    ]
+
+
+async def bench_ws_fanout(account: Account, subscribers: int, rate: float, duration: float,
+                          frames: typ.Optional[typ.List[dict]], mode: str = 'full') -> Result:
+    latency = Histogram()
+    received = received_bytes = 0
+
+    async def subscriber(communicator: WebsocketCommunicator, deadline: float):
+        nonlocal received, received_bytes
+        while (timeout := deadline - time.monotonic()) > 0:
+            try:
+                text_data = await communicator.receive_from(timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            received_bytes += len(text_data)
+            message = json.loads(text_data)
+            if timestamp := message.get('timestamp'):
+                sent_at = datetime.datetime.fromisoformat(timestamp)
+                latency.record((datetime.datetime.now(datetime.timezone.utc) - sent_at).total_seconds())
+                received += 1
+
+    async with FakeInstrumentFeed(frames=frames, rate=rate) as feed:
+        with mock.patch.object(BitmexInstrumentConsumer, 'bitmex_ws_url', feed.url), \
+                mock.patch.object(BitmexInstrumentConsumer, 'upstream_throttle', 0):
+            communicators = [WebsocketCommunicator(application, 'instrument/') for _ in range(subscribers)]
+            for communicator in communicators:
+                await communicator.connect()
+                await communicator.send_json_to({'action': 'subscribe', 'account': account.name, 'mode': mode})
+                await communicator.receive_from(timeout=5)
+
+            started = time.monotonic()
+            await asyncio.gather(*(
+                subscriber(communicator, deadline=started + duration)
+                for communicator in communicators
+            ))
+            elapsed = time.monotonic() - started
+            for communicator in communicators:
+                await communicator.disconnect()
+            # stop the upstream relay before the feed goes away (the feed server closes its own connections)
+            await coordinator.stop()
+
+    return Result(f'ws fan-out x{subscribers} {mode}', received, elapsed, latency, received_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests per REST scenario')
+    parser.add_argument('--orders', type=int, default=10000, help='orders in the table for Orders.get')
+    parser.add_argument('--accounts', type=int, default=20, help='accounts of the fan-out order placement')
+    parser.add_argument('--exchange-latency', type=float, default=0.0,
+                        help='emulated Bitmex processing time in seconds')
+    parser.add_argument('--subscribers', type=int, default=50, help='websocket subscribers')
+    parser.add_argument('--rate', type=float, default=200, help='upstream frames per second (0 - unlimited)')
+    parser.add_argument('--duration', type=float, default=5, help='websocket scenario duration in seconds')
+    parser.add_argument('--mode', default='full', choices=['full', 'delta'], help='websocket subscription mode')
+    parser.add_argument('--frames', help='file with recorded upstream frames (one JSON frame per line)')
+    parser.add_argument('--clients', type=int, default=32, help='concurrent clients of the overload scenario')
+    parser.add_argument('--scenarios', nargs='+', default=['post', 'get', 'detail', 'fanout', 'ws', 'overload'],
+                        choices=['post', 'get', 'detail', 'fanout', 'ws', 'overload'])
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        account = Account.objects.create(name=ACCOUNT_NAME, api_key='key', api_secret='secret')
+        client = APIClient()
+        results = []
+        with FakeBitmexServer(latency=args.exchange_latency) as server, \
+                mock.patch('orders.exchange.bitmex', server.client):
+            if 'post' in args.scenarios:
+                results.append(bench_orders_post(client, account, args.requests))
+            if 'detail' in args.scenarios:
+                results += bench_order_detail(client, account, args.requests, server)
+            if 'fanout' in args.scenarios:
+                results += bench_orders_fanout(client, args.accounts, args.requests)
+            if 'get' in args.scenarios:
+                results += bench_orders_get(client, account, args.requests, args.orders)
+        if 'overload' in args.scenarios:
+            results += bench_overload(args.clients, args.requests // 10 or 1, args.exchange_latency)
+        if 'ws' in args.scenarios:
+            frames = load_frames(args.frames) if args.frames else None
+            results.append(asyncio.run(bench_ws_fanout(
+                account, subscribers=args.subscribers, rate=args.rate,
+                duration=args.duration, frames=frames, mode=args.mode,
+            )))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    for result in results:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 from django.contrib import admin
-from orders.models import Account, Order
+from orders.models import Account, Order, Position, ConditionalOrder
 
 
 admin.site.register(Account)
 admin.site.register(Order)
+admin.site.register(Position)
+admin.site.register(ConditionalOrder)
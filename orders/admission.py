@@ -0,0 +1,201 @@
+import time
+import threading
+import functools
+import itertools
+import contextlib
+import typing as typ
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+
+from orders import metrics
+
+
+class Priority:
+    # order cancels free the exchange margin and the open orders, so they go first
+    CANCEL = 0
+    # order amends
+    AMEND = 1
+    # new orders
+    NEW = 2
+
+    NAMES = {CANCEL: 'cancel', AMEND: 'amend', NEW: 'new'}
+
+
+class Overloaded(Exception):
+    """Request is not admitted to the exchange by the admission control"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('account', 'priority', 'seq', 'event', 'granted', 'shed')
+
+    def __init__(self, account: str, priority: int, seq: int):
+        self.account = account
+        self.priority = priority
+        self.seq = seq
+        self.event = threading.Event()
+        self.granted = False
+        self.shed = False
+
+
+class AdmissionController:
+    """Limits the concurrent exchange requests globally and per account
+
+    A request over a limit waits in a bounded queue, served by priority
+    (cancels first) and then by arrival. A request which can not get a slot
+    within `queue_timeout` seconds, or finds the queue full of requests of the
+    same or higher priority, is shed at once, so the workers are never
+    blocked on an exchange backlog and the admitted requests latency stays
+    bounded by the limits instead of growing with the load.
+
+    :param max_concurrent: maximum exchange requests in flight (0 - unlimited)
+    :param max_per_account: maximum exchange requests in flight per account (0 - unlimited)
+    :param queue_size: maximum requests waiting for a slot
+    :param queue_timeout: seconds a request may wait for a slot
+    :param retry_after: seconds the shed requests are asked to retry after
+    """
+
+    def __init__(self, max_concurrent: int, max_per_account: int, queue_size: int, queue_timeout: float,
+                 retry_after: int = 1):
+        self.max_concurrent = max_concurrent
+        self.max_per_account = max_per_account
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        # requests in flight by account names
+        self.accounts: typ.Dict[str, int] = {}
+        self.waiters: typ.List[_Waiter] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def admit(self, account_name: str, priority: int = Priority.NEW) -> typ.Iterator[None]:
+        """Hold a slot for an exchange request of the account
+
+        :param account_name: account name
+        :param priority: one of the `Priority` values
+        :raise Overloaded: if the request is shed
+        """
+        self.acquire(account_name, priority)
+        try:
+            yield
+        finally:
+            self.release(account_name)
+
+    def acquire(self, account_name: str, priority: int = Priority.NEW) -> None:
+        """Take a slot, waiting for it in the queue if needed
+
+        :raise Overloaded: if the request is shed
+        """
+        started = time.monotonic()
+        with self._lock:
+            # waiters are granted as soon as a slot frees up, so none of them can take this slot
+            if self._has_slot(account_name):
+                self._take(account_name)
+                return
+            if len(self.waiters) >= self.queue_size:
+                evicted = max(self.waiters, key=lambda waiter: (waiter.priority, waiter.seq), default=None)
+                if evicted is None or evicted.priority <= priority:
+                    self._reject('queue_full', priority)
+                # a queued request of a lower priority gives its place up
+                self.waiters.remove(evicted)
+                evicted.shed = True
+                evicted.event.set()
+            waiter = _Waiter(account_name, priority, next(self._seq))
+            self.waiters.append(waiter)
+            self._report()
+
+        waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            if not waiter.granted:
+                if not waiter.shed:
+                    self.waiters.remove(waiter)
+                self._report()
+                self._reject('evicted' if waiter.shed else 'timeout', priority)
+        metrics.observe('admission_wait_seconds', time.monotonic() - started, priority=Priority.NAMES[priority])
+
+    def release(self, account_name: str) -> None:
+        with self._lock:
+            self.active -= 1
+            if self.accounts[account_name] > 1:
+                self.accounts[account_name] -= 1
+            else:
+                del self.accounts[account_name]
+            self._grant()
+            self._report()
+
+    def _has_slot(self, account_name: str) -> bool:
+        return (not self.max_concurrent or self.active < self.max_concurrent) and \
+            (not self.max_per_account or self.accounts.get(account_name, 0) < self.max_per_account)
+
+    def _take(self, account_name: str) -> None:
+        self.active += 1
+        self.accounts[account_name] = self.accounts.get(account_name, 0) + 1
+
+    def _grant(self) -> None:
+        for waiter in sorted(self.waiters, key=lambda waiter: (waiter.priority, waiter.seq)):
+            if self.max_concurrent and self.active >= self.max_concurrent:
+                break
+            if self._has_slot(waiter.account):
+                self.waiters.remove(waiter)
+                self._take(waiter.account)
+                waiter.granted = True
+                waiter.event.set()
+
+    def _reject(self, reason: str, priority: int) -> typ.NoReturn:
+        metrics.inc('admission_rejected_total', reason=reason, priority=Priority.NAMES[priority])
+        raise Overloaded(
+            f'Too many exchange requests in flight ({reason.replace("_", " ")}), retry later',
+            retry_after=self.retry_after,
+        )
+
+    def _report(self) -> None:
+        metrics.set_gauge('admission_active', self.active)
+        metrics.set_gauge('admission_queued', len(self.waiters))
+
+
+controller = AdmissionController(
+    max_concurrent=settings.ADMISSION_MAX_CONCURRENT,
+    max_per_account=settings.ADMISSION_MAX_PER_ACCOUNT,
+    queue_size=settings.ADMISSION_QUEUE_SIZE,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+    retry_after=settings.ADMISSION_RETRY_AFTER,
+)
+
+
+def admitted(priority: int) -> typ.Callable:
+    """Run the REST handler in an admission slot of the request `account`
+
+    The slot is taken before the handler opens any transaction, so a queued
+    request never holds row locks. Shed requests get 503 with `Retry-After`.
+
+    :param priority: one of the `Priority` values
+    """
+    def decorator(handler: typ.Callable) -> typ.Callable:
+        @functools.wraps(handler)
+        def wrapper(request, *args, **kwargs):
+            account_name = request.query_params.get('account') or ''
+            try:
+                controller.acquire(account_name, priority)
+            except Overloaded as err:
+                return get_overloaded_response(err)
+            try:
+                return handler(request, *args, **kwargs)
+            finally:
+                controller.release(account_name)
+        return wrapper
+    return decorator
+
+
+def get_overloaded_response(err: Overloaded) -> Response:
+    return Response(
+        data={'error': str(err)},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': str(err.retry_after)},
+    )
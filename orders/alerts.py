@@ -0,0 +1,316 @@
+import time
+import bisect
+import socket
+import asyncio
+import itertools
+import ipaddress
+import typing as typ
+import urllib.parse
+
+import requests
+from django.conf import settings
+from channels.layers import get_channel_layer
+
+from orders import metrics
+from orders.feeds import FeedCoordinator
+from orders.pipeline import DEFAULT_KEY
+from orders.ticks import Tick
+
+
+class AlertType:
+    # price goes up to the level
+    ABOVE = 'above'
+    # price goes down to the level
+    BELOW = 'below'
+    # price crosses the level in any direction (from the price at the registration)
+    CROSS = 'cross'
+    # price moves by the percent in any direction (from the price at the registration)
+    MOVE = 'move'
+
+    ALL = (ABOVE, BELOW, CROSS, MOVE)
+
+
+class AlertError(Exception):
+    """Invalid alert"""
+
+
+class Alert:
+    __slots__ = ('id', 'account', 'symbol', 'type', 'value', 'target', 'webhook', 'levels')
+
+    def __init__(self, id: int, account: str, symbol: str, type: str, value: float,
+                 target: typ.Optional[str] = None, webhook: typ.Optional[str] = None):
+        self.id = id
+        self.account = account
+        self.symbol = symbol
+        self.type = type
+        # price level or percent for the move alerts
+        self.value = value
+        # websocket consumer channel to deliver the alert to
+        self.target = target
+        self.webhook = webhook
+        # (side, level) entries in the book
+        self.levels: typ.List[typ.Tuple[str, float]] = []
+
+    def event(self, price: float, timestamp: typ.Optional[str]) -> dict:
+        return {
+            'alert': self.id,
+            'account': self.account,
+            'symbol': self.symbol,
+            'type': self.type,
+            'value': self.value,
+            'price': price,
+            'timestamp': timestamp,
+        }
+
+
+class AlertBook:
+    """Alerts of one instrument sorted by their price levels
+
+    `up` entries fire when the price goes up to their level, `down` ones when it
+    goes down to it, so a tick finds the fired entries with one bisect per side
+    and never looks at the others.
+    """
+
+    def __init__(self):
+        self.levels = {'up': [], 'down': []}
+        self.alerts = {'up': [], 'down': []}
+        # cross/move alerts waiting for the first price to be placed relative to it
+        self.pending: typ.List[Alert] = []
+        self.last_price: typ.Optional[float] = None
+
+    def __len__(self):
+        return len(self.alerts['up']) + len(self.alerts['down']) + len(self.pending)
+
+    def add(self, alert: Alert) -> None:
+        if alert.type in (AlertType.ABOVE, AlertType.BELOW):
+            self._insert(alert, 'up' if alert.type == AlertType.ABOVE else 'down', alert.value)
+        elif self.last_price is None:
+            self.pending.append(alert)
+        else:
+            self._place(alert, self.last_price)
+
+    def remove(self, alert: Alert) -> None:
+        if alert in self.pending:
+            self.pending.remove(alert)
+        for side, level in alert.levels:
+            levels, alerts = self.levels[side], self.alerts[side]
+            index = bisect.bisect_left(levels, level)
+            while index < len(levels) and levels[index] == level:
+                if alerts[index] is alert:
+                    del levels[index], alerts[index]
+                    break
+                index += 1
+        alert.levels = []
+
+    def trigger(self, price: float) -> typ.List[Alert]:
+        """Pop the alerts fired by the new price"""
+        self.last_price = price
+        if self.pending:
+            pending, self.pending = self.pending, []
+            for alert in pending:
+                self._place(alert, price)
+
+        up = bisect.bisect_right(self.levels['up'], price)
+        down = bisect.bisect_left(self.levels['down'], price)
+        if not up and down == len(self.levels['down']):
+            return []
+
+        fired = self.alerts['up'][:up] + self.alerts['down'][down:]
+        del self.levels['up'][:up], self.alerts['up'][:up]
+        del self.levels['down'][down:], self.alerts['down'][down:]
+        for alert in fired:
+            # the other level of a move alert
+            if len(alert.levels) > 1:
+                self.remove(alert)
+            alert.levels = []
+        # the both levels of a move alert may fire at once
+        return list({alert.id: alert for alert in fired}.values())
+
+    def _place(self, alert: Alert, price: float) -> None:
+        if alert.type == AlertType.CROSS:
+            self._insert(alert, 'up' if price < alert.value else 'down', alert.value)
+        else:
+            self._insert(alert, 'up', price * (1 + alert.value / 100))
+            self._insert(alert, 'down', price * (1 - alert.value / 100))
+
+    def _insert(self, alert: Alert, side: str, level: float) -> None:
+        index = bisect.bisect_right(self.levels[side], level)
+        self.levels[side].insert(index, level)
+        self.alerts[side].insert(index, alert)
+        alert.levels.append((side, level))
+
+
+class AlertEngine:
+    """Evaluates price alerts on the relayed instrument stream
+
+    The engine listens to the account groups of the default pipeline (so the
+    account feed is relayed by its worker as for any subscriber) and
+    delivers the fired alerts to the websocket consumers or the webhooks.
+
+    :param coordinator: upstream feeds coordinator
+    """
+
+    def __init__(self, coordinator: FeedCoordinator):
+        self.coordinator = coordinator
+        self.alerts: typ.Dict[int, Alert] = {}
+        self.books: typ.Dict[typ.Tuple[str, str], AlertBook] = {}
+        self._ids = itertools.count(1)
+        # number of alerts by account names
+        self._accounts: typ.Dict[str, int] = {}
+        self._channel: typ.Optional[str] = None
+        self._listener: typ.Optional[asyncio.Task] = None
+
+    async def add(self, account: str, symbol: str, type: str, value: float,
+                  target: str = None, webhook: str = None) -> Alert:
+        """Register a new alert
+
+        :param account: account name which feed is watched
+        :param symbol: instrument symbol
+        :param type: one of the `AlertType` values
+        :param value: price level or percent for the move alerts
+        :param target: websocket consumer channel to deliver the alert to
+        :param webhook: url to POST the alert to (instead of the websocket)
+        :return: registered alert
+        :raise AlertError: if the alert is not valid
+        """
+        if type not in AlertType.ALL:
+            raise AlertError(f'Got unknown alert type: {type!r}. Available types are: {list(AlertType.ALL)}')
+        if not isinstance(symbol, str) or not symbol:
+            raise AlertError('Missed alert symbol')
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+            raise AlertError(f'Expected a positive alert value, got: {value!r}')
+        if webhook is not None:
+            host = check_webhook(webhook)
+            try:
+                addresses = await asyncio.get_running_loop().getaddrinfo(host, None)
+            except socket.gaierror as err:
+                raise AlertError(f'Can not resolve the webhook host {host!r}: {err}')
+            if _is_private_(addresses):
+                raise AlertError(f'Webhook host {host!r} resolves to a private address')
+
+        await self._ensure_listening(account)
+        alert = Alert(next(self._ids), account, symbol, type, value, target=target, webhook=webhook)
+        self.alerts[alert.id] = alert
+        self.books.setdefault((account, symbol), AlertBook()).add(alert)
+        metrics.set_gauge('alerts_active', len(self.alerts))
+        return alert
+
+    def remove(self, alert_id: int) -> typ.Optional[Alert]:
+        if (alert := self.alerts.pop(alert_id, None)) is None:
+            return None
+        self.books[(alert.account, alert.symbol)].remove(alert)
+        self._forget(alert)
+        return alert
+
+    def remove_target(self, target: str) -> None:
+        """Remove websocket alerts of the closed consumer (webhook alerts stay)"""
+        for alert in [alert for alert in self.alerts.values() if alert.target == target and not alert.webhook]:
+            self.remove(alert.id)
+
+    def on_tick(self, account: str, symbol: str, price: float) -> typ.List[Alert]:
+        """Pop the alerts of the instrument fired by the new price"""
+        if (book := self.books.get((account, symbol))) is None:
+            return []
+        with metrics.timer('ws_stage_duration_seconds', stage='alerts'):
+            fired = book.trigger(price)
+        for alert in fired:
+            del self.alerts[alert.id]
+            self._forget(alert)
+        return fired
+
+    async def deliver(self, alert: Alert, price: float, timestamp: typ.Optional[str]) -> None:
+        event = alert.event(price, timestamp)
+        metrics.inc('alerts_fired_total', delivery='webhook' if alert.webhook else 'websocket')
+        if alert.webhook:
+            asyncio.get_running_loop().run_in_executor(None, _post_webhook_, alert.webhook, event)
+        elif alert.target:
+            await get_channel_layer().send(alert.target, {'type': 'send_alert', 'alert': event})
+
+    async def listen(self) -> None:
+        channel_layer = get_channel_layer()
+        while True:
+            event = await channel_layer.receive(self._channel)
+            message = event.get('message')
+            if event.get('type') != 'send_message' or not isinstance(message, (Tick, dict)) \
+                    or message.get('price') is None:
+                continue
+            for alert in self.on_tick(message['account'], message['symbol'], message['price']):
+                await self.deliver(alert, message['price'], message.get('timestamp'))
+
+    async def _ensure_listening(self, account: str) -> None:
+        channel_layer = get_channel_layer()
+        if self._listener is None or self._listener.done():
+            self._channel = await channel_layer.new_channel(prefix='alerts')
+            self._listener = asyncio.create_task(self.listen())
+            for account_name in self._accounts:
+                await channel_layer.group_add(account_name, self._channel)
+        if account not in self._accounts:
+            self._accounts[account] = 0
+            await channel_layer.group_add(account, self._channel)
+            await self.coordinator.subscribe(account, DEFAULT_KEY)
+        self._accounts[account] += 1
+
+    def _forget(self, alert: Alert) -> None:
+        metrics.set_gauge('alerts_active', len(self.alerts))
+        key = (alert.account, alert.symbol)
+        if not len(self.books[key]):
+            del self.books[key]
+        self._accounts[alert.account] -= 1
+        if not self._accounts[alert.account]:
+            del self._accounts[alert.account]
+            self.coordinator.unsubscribe(alert.account, DEFAULT_KEY)
+            asyncio.get_running_loop().create_task(get_channel_layer().group_discard(alert.account, self._channel))
+
+
+def check_webhook(url: typ.Any) -> str:
+    """Check the webhook url is allowed by `ALERT_WEBHOOK_HOSTS`
+
+    :param url: webhook url
+    :return: webhook host name
+    :raise AlertError: if the url is not an allowed http(s) url
+    """
+    if not settings.ALERT_WEBHOOK_HOSTS:
+        raise AlertError('Webhook alerts are disabled (no ALERT_WEBHOOK_HOSTS are configured)')
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        raise AlertError(f'Expected an http(s) webhook url, got: {url!r}')
+    try:
+        parsed = urllib.parse.urlsplit(url)
+        # an invalid port raises ValueError as well
+        host, _ = parsed.hostname, parsed.port
+    except ValueError:
+        host = None
+    if not host or parsed.username is not None or parsed.password is not None:
+        raise AlertError(f'Expected an http(s) webhook url, got: {url!r}')
+    if not any(_is_allowed_(parsed, allowed) for allowed in settings.ALERT_WEBHOOK_HOSTS):
+        raise AlertError(f'Webhook host {host!r} is not allowed')
+    return host
+
+
+def _is_allowed_(url: urllib.parse.SplitResult, allowed: str) -> bool:
+    if not allowed.startswith(('http://', 'https://')):
+        return url.hostname == allowed.lower()
+    prefix = urllib.parse.urlsplit(allowed)
+    return (url.scheme, url.hostname, url.port) == (prefix.scheme, prefix.hostname, prefix.port) \
+        and url.path.startswith(prefix.path)
+
+
+def _is_private_(addresses: typ.Iterable[tuple]) -> bool:
+    """Check if any of the `getaddrinfo` addresses is not a public one (private, loopback, link-local etc.)"""
+    for *_, socket_address in addresses:
+        address = ipaddress.ip_address(socket_address[0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            return True
+    return False
+
+
+def _post_webhook_(url: str, event: dict) -> None:
+    started = time.perf_counter()
+    try:
+        # the host may resolve to other addresses since the alert registration
+        if _is_private_(socket.getaddrinfo(urllib.parse.urlsplit(url).hostname, None)):
+            raise AlertError(f'Webhook {url!r} resolves to a private address')
+        # redirects are not followed, they could lead to any host
+        requests.post(url, json=event, timeout=5, allow_redirects=False)
+    except (AlertError, OSError, requests.RequestException):
+        metrics.inc('alerts_webhook_errors_total')
+    metrics.observe('ws_stage_duration_seconds', time.perf_counter() - started, stage='webhook')
@@ -0,0 +1,282 @@
+import io
+import os
+import re
+import csv
+import gzip
+import datetime
+import typing as typ
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from orders.models import Account, ConditionalOrder, Order
+
+# orders table, partitioned by the order timestamp months on PostgreSQL (see the 0008 migration)
+TABLE = Order._meta.db_table
+
+# columns of the archived and the exported orders
+COLUMNS = tuple(field.column for field in Order._meta.concrete_fields)
+
+# datetime columns re-formatted on the export
+DATETIME_COLUMNS = ('timestamp', 'transact_time')
+
+ARCHIVE_NAME = re.compile(r'^orders-(\d{4})-(\d{2})\.csv\.gz$')
+PARTITION_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})(\d{{2}})$')
+# partition of the orders of the months without a partition
+DEFAULT_PARTITION = f'{TABLE}_default'
+
+
+class ArchiveError(Exception):
+    """Orders can not be archived"""
+
+
+def month_start(value: typ.Union[datetime.date, datetime.datetime]) -> datetime.datetime:
+    """Get the UTC start of the month of the date/time"""
+    if isinstance(value, datetime.datetime):
+        value = value.astimezone(datetime.timezone.utc)
+    return datetime.datetime(value.year, value.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def shift_months(month: datetime.datetime, months: int) -> datetime.datetime:
+    """Move the month start by the number of months (back for a negative one)"""
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime.datetime) -> str:
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def archive_path(directory: str, month: datetime.datetime) -> str:
+    return os.path.join(directory, f'orders-{month:%Y-%m}.csv.gz')
+
+
+def is_partitioned() -> bool:
+    """Check if the orders table is partitioned (PostgreSQL only)"""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE relname = %s', [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def get_partitions() -> typ.Dict[datetime.datetime, str]:
+    """Get the monthly partitions of the orders table by their months"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+            'WHERE parent.relname = %s',
+            [TABLE],
+        )
+        return _get_months_(name for name, in cursor.fetchall())
+
+
+def get_detached_partitions() -> typ.Dict[datetime.datetime, str]:
+    """Get the monthly partitions detached, but not archived yet (e.g. by an interrupted archiving)"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relname FROM pg_class WHERE relname LIKE %s AND relkind = 'r' AND NOT relispartition",
+            [f'{TABLE}_p%'],
+        )
+        return _get_months_(name for name, in cursor.fetchall())
+
+
+def ensure_partitions(months_ahead: int = 2) -> typ.List[str]:
+    """Create the missing partitions of the current and the next months
+
+    New orders of a month without a partition go to the default partition,
+    so this is run ahead of time (by the `archive_orders` command). The
+    orders of the month already in the default partition are moved to the
+    new partition before it is attached.
+
+    :param months_ahead: number of the next months to create the partitions of
+    :return: names of the created partitions (none if the orders table is not partitioned)
+    """
+    if not is_partitioned():
+        return []
+    existing, created = get_partitions(), []
+    month = month_start(timezone.now())
+    for _ in range(months_ahead + 1):
+        if month not in existing:
+            created.append(_create_partition_(month))
+        month = shift_months(month, 1)
+    return created
+
+
+def archive_orders(before: datetime.datetime, directory: str) -> typ.List[typ.Tuple[str, int]]:
+    """Move the orders of the months before the date to compressed CSV files
+
+    Every month goes to its own `orders-YYYY-MM.csv.gz` file with the orders
+    table columns. On PostgreSQL the month partition is detached (in its own
+    short transaction), then copied out and dropped, so the hot table is never
+    scanned, vacuumed or locked for the copy; other databases delete the
+    archived rows. A file is renamed to its final name
+    only after the orders are removed.
+
+    :param before: the orders of the months before the month of this date are archived
+    :param directory: directory of the archive files
+    :return: archive file path and number of orders of every archived month
+    :raise ArchiveError: if a month is archived already
+    """
+    cutoff = month_start(before)
+    detached = {}
+    if is_partitioned():
+        detached = get_detached_partitions()
+        months = sorted(month for month in {*get_partitions(), *detached} if month < cutoff)
+        archive = _archive_partition_
+    else:
+        months = list(Order.objects.filter(
+            timestamp__lt=cutoff,
+        ).datetimes('timestamp', 'month', tzinfo=datetime.timezone.utc))
+        archive = _archive_rows_
+
+    os.makedirs(directory, exist_ok=True)
+    archived = []
+    for month in months:
+        path = archive_path(directory, month)
+        if os.path.exists(path):
+            raise ArchiveError(f'Orders of {month:%Y-%m} are archived already to {path!r}')
+        temp_path = f'{path}.tmp'
+        try:
+            if archive is _archive_partition_ and month not in detached:
+                # committed right away, so the lock of the orders table is not held for the copy
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {partition_name(month)}')
+            with transaction.atomic():
+                with gzip.open(temp_path, 'wt', newline='') as file:
+                    count = archive(month, file)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        archived.append((path, count))
+    return archived
+
+
+def get_archives(directory: str) -> typ.Dict[datetime.datetime, str]:
+    """Get the archive files paths by their months"""
+    if not os.path.isdir(directory):
+        return {}
+    return {
+        datetime.datetime(int(match[1]), int(match[2]), 1, tzinfo=datetime.timezone.utc): os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if (match := ARCHIVE_NAME.match(name))
+    }
+
+
+def read_archived(directory: str, account: Account, since: datetime.datetime = None,
+                  until: datetime.datetime = None) -> typ.Iterator[typ.Dict[str, str]]:
+    """Read the archived orders of the account
+
+    Only the archive files of the months overlapping the period are read.
+
+    :param directory: directory of the archive files
+    :param account: account model
+    :param since: the earliest order time (inclusive)
+    :param until: the latest order time (exclusive)
+    :return: orders rows by the column names, ordered by months
+    """
+    for month, path in sorted(get_archives(directory).items()):
+        if since is not None and shift_months(month, 1) <= since or until is not None and month >= until:
+            continue
+        with gzip.open(path, 'rt', newline='') as file:
+            for row in csv.DictReader(file):
+                if row['account_id'] != str(account.id):
+                    continue
+                timestamp = parse_datetime(row['timestamp'])
+                if since is not None and timestamp < since or until is not None and timestamp >= until:
+                    continue
+                yield row
+
+
+def export_orders(account: Account, since: datetime.datetime = None, until: datetime.datetime = None,
+                  directory: str = None, using: str = 'default') -> typ.Iterator[str]:
+    """Export the archived and the current orders of the account as CSV
+
+    :param account: account model
+    :param since: the earliest order time (inclusive)
+    :param until: the latest order time (exclusive)
+    :param directory: directory of the archive files (`ORDERS_ARCHIVE_DIR` by default)
+    :param using: DB alias to read the current orders from
+    :return: CSV lines, the header first
+    """
+    directory = settings.ORDERS_ARCHIVE_DIR if directory is None else directory
+    orders = Order.objects.using(using).filter(account=account).order_by('timestamp', 'id')
+    if since is not None:
+        orders = orders.filter(timestamp__gte=since)
+    if until is not None:
+        orders = orders.filter(timestamp__lt=until)
+
+    archived = (
+        [parse_datetime(row[column]) if column in DATETIME_COLUMNS and row[column] else row[column]
+         for column in COLUMNS]
+        for row in read_archived(directory, account, since, until)
+    )
+    current = orders.values_list(*COLUMNS).iterator()
+    yield from _csv_lines_([COLUMNS])
+    yield from _csv_lines_(archived)
+    yield from _csv_lines_(current)
+
+
+def _archive_partition_(month: datetime.datetime, file: typ.TextIO) -> int:
+    name = partition_name(month)
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT count(*) FROM {name}')
+        count = cursor.fetchone()[0]
+        # conditional orders reference the orders without a DB constraint
+        cursor.execute(
+            f'UPDATE {ConditionalOrder._meta.db_table} SET order_id = NULL '
+            f'WHERE order_id IN (SELECT id FROM {name})'
+        )
+        cursor.copy_expert(f'COPY {name} ({", ".join(COLUMNS)}) TO STDOUT WITH CSV HEADER', file)
+        cursor.execute(f'DROP TABLE {name}')
+    return count
+
+
+def _create_partition_(month: datetime.datetime) -> str:
+    name, bounds = partition_name(month), [month.isoformat(), shift_months(month, 1).isoformat()]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        # attaching fails while the default partition holds orders of the month
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE "timestamp" >= %s AND "timestamp" < %s '
+            f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+            bounds,
+        )
+        cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', bounds)
+    return name
+
+
+def _archive_rows_(month: datetime.datetime, file: typ.TextIO) -> int:
+    orders = Order.objects.filter(timestamp__gte=month, timestamp__lt=shift_months(month, 1))
+    writer = csv.writer(file)
+    writer.writerow(COLUMNS)
+    count = 0
+    for row in orders.order_by('id').values_list(*COLUMNS).iterator():
+        writer.writerow(row)
+        count += 1
+    orders.delete()
+    return count
+
+
+def _get_months_(names: typ.Iterable[str]) -> typ.Dict[datetime.datetime, str]:
+    return {
+        datetime.datetime(int(match[1]), int(match[2]), 1, tzinfo=datetime.timezone.utc): name
+        for name in names
+        if (match := PARTITION_NAME.match(name))
+    }
+
+
+def _csv_lines_(rows: typ.Iterable[typ.Sequence]) -> typ.Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([value.isoformat() if isinstance(value, datetime.datetime) else value for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
@@ -0,0 +1,247 @@
+import time
+import asyncio
+import logging
+import typing as typ
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction, close_old_connections, DatabaseError
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from orders import exchange, metrics
+from orders.alerts import Alert, AlertBook, AlertType
+from orders.models import Account, ConditionalOrder, ConditionalOrderStatus, Order, get_lifecycle_fields
+from orders.positions import record_fill_change
+
+
+logger = logging.getLogger(__name__)
+
+# threads placing the fired orders (and loading the pending ones), every one keeps its own DB connection
+_pool: typ.Optional[ThreadPoolExecutor] = None
+
+
+def pending_accounts() -> typ.List[str]:
+    """Get names of the accounts with pending conditional orders"""
+    return list(
+        ConditionalOrder.objects.filter(
+            status=ConditionalOrderStatus.PENDING,
+        ).values_list('account__name', flat=True).distinct()
+    )
+
+
+def group(account_name: str) -> str:
+    """Get channel layer group of the worker evaluating the conditional orders of the account"""
+    return f'{account_name}.conditional'
+
+
+def notify_changed(account_name: str) -> None:
+    """Let the worker relaying the account feed reload its pending conditional orders once committed"""
+    transaction.on_commit(lambda: async_to_sync(get_channel_layer().group_send)(
+        group(account_name), {'type': 'conditional.changed'},
+    ))
+
+
+def load_books(account_name: str) -> typ.Dict[str, AlertBook]:
+    """Load pending conditional orders of the account into books of trigger prices
+
+    The Bitmex client of the account is built as well, so the first fired
+    order does not wait for it.
+
+    :param account_name: account name
+    :return: books by instrument symbols, entries ids are the conditional order ids
+    """
+    books = {}
+    pending = ConditionalOrder.objects.filter(
+        account__name=account_name,
+        status=ConditionalOrderStatus.PENDING,
+    ).only('id', 'symbol', 'side', 'kind', 'trigger_price')
+    for conditional_order in pending:
+        books.setdefault(conditional_order.symbol, AlertBook()).add(Alert(
+            id=conditional_order.id,
+            account=account_name,
+            symbol=conditional_order.symbol,
+            type=AlertType.ABOVE if conditional_order.fires_above else AlertType.BELOW,
+            value=conditional_order.trigger_price,
+        ))
+    if books and (account := Account.objects.filter(name=account_name).first()):
+        exchange.get_client(account)
+    return books
+
+
+def fire(conditional_order_id: int, price: float) -> typ.Optional[ConditionalOrder]:
+    """Place the market order of the triggered conditional order and record it
+
+    The conditional order is claimed with a conditional update first, so its
+    market order is placed at most once, even if several workers see the
+    trigger price (e.g. while a feed moves to another worker).
+
+    :param conditional_order_id: conditional order id
+    :param price: the last price which fired the order
+    :return: fired conditional order, None if it is not pending anymore
+    """
+    claimed = ConditionalOrder.objects.filter(
+        pk=conditional_order_id,
+        status=ConditionalOrderStatus.PENDING,
+    ).update(
+        status=ConditionalOrderStatus.TRIGGERED,
+        triggered_at=timezone.now(),
+        triggered_price=price,
+    )
+    if not claimed:
+        return None
+
+    conditional_order = ConditionalOrder.objects.select_related('account').get(pk=conditional_order_id)
+    try:
+        result = exchange.new_market_order(
+            account=conditional_order.account,
+            symbol=conditional_order.symbol,
+            volume=conditional_order.volume,
+            side=conditional_order.side,
+        )
+        with transaction.atomic():
+            order = Order.objects.create(
+                order_id=result['orderID'],
+                symbol=conditional_order.symbol,
+                volume=conditional_order.volume,
+                side=conditional_order.side,
+                price=result.get('price'),
+                account=conditional_order.account,
+                **get_lifecycle_fields(result),
+            )
+            record_fill_change(order)
+            conditional_order.order = order
+            conditional_order.save(update_fields=['order'])
+    except Exception as err:
+        # the claimed order is never left triggered without its market order or an error
+        logger.warning('Failed to place the conditional order %r: %s', conditional_order_id, err)
+        conditional_order.order = None
+        conditional_order.status = ConditionalOrderStatus.FAILED
+        conditional_order.error = str(err) or repr(err)
+        conditional_order.save(update_fields=['status', 'error'])
+    return conditional_order
+
+
+class ConditionalOrderTrigger:
+    """Fires the pending conditional orders of an account on its relayed last prices
+
+    Created by the upstream feed relay, so the orders of an account are
+    evaluated only by the worker owning its feed. The pending orders are
+    loaded once and reloaded in the background only when a conditional order
+    of the account is created or canceled (see `notify_changed`), and a frame
+    costs a bisect per instrument with orders: the relay never waits for the
+    DB or the exchange.
+
+    :param account_name: account name
+    :param retry_interval: seconds before loading the pending orders again after a DB error
+    """
+
+    def __init__(self, account_name: str, retry_interval: float = None):
+        self.account_name = account_name
+        self.retry_interval = settings.CONDITIONAL_ORDERS_RETRY if retry_interval is None else retry_interval
+        self.books: typ.Dict[str, AlertBook] = {}
+        # fired orders which may be still pending in a snapshot being loaded
+        self.firing: typ.Set[int] = set()
+        # the pending orders changed since the last load started (loaded first once listening to the changes)
+        self.stale = False
+        self._retry_at = 0.0
+        self._loader: typ.Optional[asyncio.Task] = None
+        self._listener: typ.Optional[asyncio.Task] = None
+        self._fired: typ.Set[asyncio.Task] = set()
+
+    def on_rows(self, rows: typ.Iterable[dict]) -> None:
+        """Fire the orders reached by the last prices of the upstream instrument rows"""
+        self._ensure_loaded()
+        if not self.books:
+            return
+        for row in rows:
+            if (price := row.get('lastPrice')) is None or (book := self.books.get(row.get('symbol'))) is None:
+                continue
+            for alert in book.trigger(price):
+                if alert.id not in self.firing:
+                    self.firing.add(alert.id)
+                    task = asyncio.create_task(self._fire(alert.id, price))
+                    self._fired.add(task)
+                    task.add_done_callback(self._fired.discard)
+
+    def reload(self) -> None:
+        """Load the pending orders again in the background (e.g. after one is created or canceled)"""
+        self.stale = True
+        self._ensure_loaded()
+
+    def close(self) -> None:
+        """Stop listening to the changes of the pending orders (e.g. when the feed is stopped)"""
+        if self._listener is not None:
+            self._listener.cancel()
+
+    async def load(self) -> None:
+        try:
+            books = await _run_in_pool_(load_books, self.account_name)
+        except DatabaseError as err:
+            logger.warning('Failed to load conditional orders of the account %r: %s', self.account_name, err)
+            self.stale = True
+            self._retry_at = time.monotonic() + self.retry_interval
+            return
+        self.replace_books(books)
+
+    async def listen(self) -> None:
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel(prefix='conditional')
+        await channel_layer.group_add(group(self.account_name), channel)
+        try:
+            self.reload()
+            while True:
+                event = await channel_layer.receive(channel)
+                if event.get('type') == 'conditional.changed':
+                    self.reload()
+        finally:
+            await channel_layer.group_discard(group(self.account_name), channel)
+
+    def replace_books(self, books: typ.Dict[str, AlertBook]) -> None:
+        """Evaluate the newly loaded pending orders instead of the previous ones"""
+        loaded = set()
+        for book in books.values():
+            for side in ('up', 'down'):
+                for alert in list(book.alerts[side]):
+                    loaded.add(alert.id)
+                    if alert.id in self.firing:
+                        book.remove(alert)
+        # the other fired orders are not pending in the DB anymore
+        self.firing &= loaded
+        self.books = {symbol: book for symbol, book in books.items() if len(book)}
+        metrics.set_gauge('conditional_orders_watched', sum(map(len, self.books.values())), account=self.account_name)
+
+    async def _fire(self, conditional_order_id: int, price: float) -> None:
+        started = time.perf_counter()
+        try:
+            conditional_order = await _run_in_pool_(fire, conditional_order_id, price)
+        except DatabaseError as err:
+            logger.warning('Failed to fire the conditional order %r: %s', conditional_order_id, err)
+            return
+        if conditional_order is not None:
+            metrics.inc('conditional_orders_fired_total', status=conditional_order.status)
+            metrics.observe('ws_stage_duration_seconds', time.perf_counter() - started, stage='conditional_order')
+
+    def _ensure_loaded(self) -> None:
+        if self._listener is None:
+            self._listener = asyncio.create_task(self.listen())
+        if not self.stale or self._loader is not None and not self._loader.done() or time.monotonic() < self._retry_at:
+            return
+        self.stale = False
+        self._loader = asyncio.create_task(self.load())
+
+
+async def _run_in_pool_(func: typ.Callable, *args):
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=settings.CONDITIONAL_ORDER_WORKERS, thread_name_prefix='conditional')
+    return await asyncio.get_running_loop().run_in_executor(_pool, _call_, func, *args)
+
+
+def _call_(func: typ.Callable, *args):
+    try:
+        return func(*args)
+    finally:
+        # every pool thread keeps its own DB connection
+        close_old_connections()
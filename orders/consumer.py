@@ -1,18 +1,25 @@
+import os
 import json
-import hmac
 import time
-import hashlib
+import socket
 import asyncio
 import typing as typ
-from urllib.parse import urlparse
-from collections import namedtuple, defaultdict
+from collections import namedtuple
 
-import websockets
-from channels.db import database_sync_to_async
-from websockets.client import WebSocketClientProtocol
+from django.conf import settings
+from channels.layers import get_channel_layer
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from orders import exchange, frames, metrics, orderbook, outbound, prices, signing, tape, ticks
+from orders.db import database_async
+from orders.alerts import AlertEngine, AlertError
+from orders.conditional import ConditionalOrderTrigger, pending_accounts
+from orders.delta import DeltaEncoder, MODES
+from orders.pipeline import DEFAULT_KEY, Message, Pipeline, PipelineError, apply_pipelines, get_pipeline, get_spec_key
+from orders.feeds import FeedCoordinator
 from orders.models import Account
+from orders.outbound import OutboundQueue, QueueOverflow, QueuedMessage
+from orders.throttle import SymbolThrottle
 
 
 class ReceivedDataValidationError(Exception):
@@ -20,26 +27,70 @@ class ReceivedDataValidationError(Exception):
 
 
 class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
-    # TODO: find another way to check if there are
-    #  no subscriptions left for a group (counter - is a bad way)
-    subs_per_group = defaultdict(int)
-    group_bitmex_ws: typ.Dict[str, WebSocketClientProtocol] = {}
+    bitmex_ws_url = 'wss://testnet.bitmex.com/realtime?subscribe=instrument'
+    # seconds between the relayed messages of an instrument (the newer ones are conflated)
+    upstream_throttle = settings.UPSTREAM_THROTTLE
+    outbound_queue_size = settings.OUTBOUND_QUEUE_SIZE
+    outbound_queue_policy = settings.OUTBOUND_QUEUE_POLICY
+    # close code for the clients which can not keep up with the messages rate
+    slow_consumer_close_code = 4008
+    # `accounts` value of the subscribe/unsubscribe messages for all the accounts
+    all_accounts = 'all'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        Actions = namedtuple('Actions', ('subscribe', 'unsubscribe'))
-        self.actions = Actions(subscribe='subscribe', unsubscribe='unsubscribe')
-        self.curr_subs = set()
+        Actions = namedtuple('Actions', (
+            'subscribe', 'unsubscribe', 'resync', 'alert', 'unalert', 'depth', 'undepth', 'tape', 'untape',
+        ))
+        self.actions = Actions(
+            subscribe='subscribe',
+            unsubscribe='unsubscribe',
+            resync='resync',
+            alert='alert',
+            unalert='unalert',
+            depth='depth',
+            undepth='undepth',
+            tape='tape',
+            untape='untape',
+        )
+        # transform pipeline keys by subscribed account names
+        self.curr_subs: typ.Dict[str, str] = {}
+        # channel layer group functions and symbols of the per instrument streams
+        self.streams = {
+            'depth': (orderbook.group, settings.ORDER_BOOK_SYMBOLS),
+            'tape': (tape.group, settings.TRADE_TAPE_SYMBOLS),
+        }
+        # (stream, account name, symbol) of the subscribed per instrument streams
+        self.stream_subs: typ.Set[typ.Tuple[str, str, str]] = set()
+        self.outbound = OutboundQueue(
+            maxsize=self.outbound_queue_size,
+            policy=self.outbound_queue_policy,
+        )
+        self._outbound_sender: typ.Optional[asyncio.Task] = None
+        self._evicted = False
+        # set by the first subscription in the delta mode
+        self.delta: typ.Optional[DeltaEncoder] = None
+        self._dropped_encoded = 0
 
     async def connect(self):
         await self.accept()
+        self._outbound_sender = asyncio.create_task(self._send_outbound())
 
     async def disconnect(self, code):
-        for group_name in self.curr_subs:
+        if self._outbound_sender:
+            self._outbound_sender.cancel()
+        outbound.queues.discard(self.outbound)
+        for account, pipeline_key in self.curr_subs.items():
             await self.channel_layer.group_discard(
-                group_name,
+                get_pipeline(pipeline_key).group(account),
                 self.channel_name,
             )
+            coordinator.unsubscribe(account, pipeline_key)
+        for stream, account, symbol in self.stream_subs:
+            group, _ = self.streams[stream]
+            await self.channel_layer.group_discard(group(account, symbol), self.channel_name)
+            coordinator.unsubscribe(account, DEFAULT_KEY)
+        alert_engine.remove_target(self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
         try:
@@ -48,12 +99,34 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
             return
 
         action = received_data['action']
-        account = received_data['account']
+        account = received_data.get('account')
 
-        if action == self.actions.subscribe:
-            await self._subscribe_user(account)
+        if action == self.actions.subscribe and 'accounts' in received_data:
+            await self._subscribe_users(
+                received_data['accounts'],
+                mode=received_data.get('mode'),
+                pipeline=received_data.get('pipeline'),
+            )
+        elif action == self.actions.subscribe:
+            await self._subscribe_user(
+                account,
+                mode=received_data.get('mode'),
+                pipeline=received_data.get('pipeline'),
+            )
+        elif action == self.actions.unsubscribe and 'accounts' in received_data:
+            await self._unsubscribe_users(received_data['accounts'])
         elif action == self.actions.unsubscribe:
             await self._unsubscribe_user(account)
+        elif action == self.actions.resync:
+            await self._resync_user(account)
+        elif action == self.actions.alert:
+            await self._add_alert(account, received_data)
+        elif action == self.actions.unalert:
+            await self._remove_alert(account, received_data.get('alert'))
+        elif action in (self.actions.depth, self.actions.tape):
+            await self._subscribe_stream(action, account, received_data.get('symbol'))
+        elif action in (self.actions.undepth, self.actions.untape):
+            await self._unsubscribe_stream(action[2:], account, received_data.get('symbol'))
         else:
             await self.send(
                 text_data=json.dumps({
@@ -65,6 +138,10 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
     async def _validate_received_data(self, text_data: str) -> dict:
         """Received data validation
 
+        Subscribe/unsubscribe messages may have a list of `accounts` (or "all")
+        instead of one `account`, they are checked with one DB query and
+        replaced with the existing account names.
+
         :param text_data: received data
         :return: validated data
         :raise ReceivedDataValidationError: if data is not valid
@@ -81,8 +158,9 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
 
         action = data.get('action')
         account = data.get('account')
+        accounts = data.get('accounts')
 
-        if not action or not account:
+        if not action or not (account or accounts):
             await self.send(
                 text_data=json.dumps({
                     'status': 400, 'error': f'Got unknown data format: {text_data}',
@@ -90,13 +168,18 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
             )
             raise ReceivedDataValidationError
 
-        if not isinstance(account, str) or not await self._is_account_exists(account):
+        if accounts:
+            data['accounts'] = await self._validate_accounts(action, accounts)
+        elif not isinstance(account, str) or not await self._is_account_exists(account):
             await self.send(
                 text_data=json.dumps({
                     'status': 400, 'error': f'Account {account!r} does not exists',
                 })
             )
             raise ReceivedDataValidationError
+        else:
+            # an empty `accounts` list along with the `account`
+            data.pop('accounts', None)
 
         if action not in self.actions:
             await self.send(
@@ -109,28 +192,38 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
             )
             raise ReceivedDataValidationError
 
+        if data.get('mode') is not None and data['mode'] not in MODES:
+            await self.send(
+                text_data=json.dumps({
+                    'status': 400,
+                    'error': f'Got unknown mode: {data["mode"]!r}. Available modes are: {list(MODES)}',
+                })
+            )
+            raise ReceivedDataValidationError
+
         return data
 
-    async def _subscribe_user(self, account: str) -> None:
+    async def _subscribe_user(self, account: str, mode: str = None, pipeline: dict = None) -> None:
         """Subscribe current user to bitmex instrument WS
             using needed account credentials
 
         :param account: needed account name from DB
+        :param mode: 'delta' to send only the changed fields on this connection
+        :param pipeline: spec of the fields, filters and derived values to relay
+            (see `orders.pipeline.get_spec_key`), the last prices by default
         """
-        if not (
-                group_ws := BitmexInstrumentConsumer.group_bitmex_ws.get(account)
-        ) or (
-                group_ws
-                and isinstance(group_ws, WebSocketClientProtocol)
-                and not group_ws.open
-        ):
-            await self.bitmex_connect(account_name=account)
+        try:
+            pipeline_key = get_spec_key(pipeline)
+        except PipelineError as err:
             await self.send(
                 text_data=json.dumps({
-                    'success': True, 'subscribe': 'instrument', 'account': account,
+                    'status': 400, 'error': str(err),
                 })
             )
-        elif account in self.curr_subs:
+            return
+        if mode == 'delta' and self.delta is None:
+            self.delta = DeltaEncoder()
+        if account in self.curr_subs:
             # already subscribed
             await self.send(
                 text_data=json.dumps({
@@ -139,9 +232,104 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
             )
             return
 
-        await self.channel_layer.group_add(account, self.channel_name)
-        BitmexInstrumentConsumer.subs_per_group[account] += 1
-        self.curr_subs.add(account)
+        await self.channel_layer.group_add(get_pipeline(pipeline_key).group(account), self.channel_name)
+        self.curr_subs[account] = pipeline_key
+        # the upstream feed is relayed by the worker owning the account (maybe this one)
+        await coordinator.subscribe(account, pipeline_key)
+        await self.send(
+            text_data=json.dumps({
+                'success': True, 'subscribe': 'instrument', 'account': account,
+            })
+        )
+
+    async def _validate_accounts(self, action: str, accounts: typ.Union[str, typ.List[str]]) -> typ.List[str]:
+        """Validate the accounts of a multi-account message
+
+        :param action: received action
+        :param accounts: list of account names or "all" (all the accounts to subscribe,
+            all the subscribed ones to unsubscribe)
+        :return: account names without duplicates
+        :raise ReceivedDataValidationError: if the accounts are not valid
+        """
+        if action not in (self.actions.subscribe, self.actions.unsubscribe):
+            error = f'Several accounts are supported by the {self.actions.subscribe!r} ' \
+                    f'and {self.actions.unsubscribe!r} actions only'
+        elif accounts == self.all_accounts:
+            if action == self.actions.unsubscribe:
+                return list(self.curr_subs)
+            return await self._get_account_names(None)
+        elif not isinstance(accounts, list) or not all(isinstance(account, str) for account in accounts):
+            error = f'Expected a list of account names or {self.all_accounts!r}, got: {accounts!r}'
+        else:
+            accounts = list(dict.fromkeys(accounts))
+            existing = set(await self._get_account_names(accounts))
+            if not (missed := [account for account in accounts if account not in existing]):
+                return accounts
+            error = f'Accounts {missed!r} do not exist'
+
+        await self.send(
+            text_data=json.dumps({
+                'status': 400, 'error': error,
+            })
+        )
+        raise ReceivedDataValidationError
+
+    async def _subscribe_users(self, accounts: typ.List[str], mode: str = None, pipeline: dict = None) -> None:
+        """Subscribe current user to bitmex instrument WS of several accounts at once
+
+        The groups are joined concurrently and the new demand is announced
+        to the feed workers in one message, then a single ack lists the
+        subscribed accounts and the `skipped` (already subscribed) ones.
+
+        :param accounts: existing account names
+        :param mode: 'delta' to send only the changed fields on this connection
+        :param pipeline: spec of the fields, filters and derived values to relay
+        """
+        try:
+            pipeline_key = get_spec_key(pipeline)
+        except PipelineError as err:
+            await self.send(
+                text_data=json.dumps({
+                    'status': 400, 'error': str(err),
+                })
+            )
+            return
+        if mode == 'delta' and self.delta is None:
+            self.delta = DeltaEncoder()
+
+        subscribed = [account for account in accounts if account not in self.curr_subs]
+        group = get_pipeline(pipeline_key).group
+        await asyncio.gather(*(
+            self.channel_layer.group_add(group(account), self.channel_name) for account in subscribed
+        ))
+        self.curr_subs.update(dict.fromkeys(subscribed, pipeline_key))
+        await coordinator.subscribe_many(subscribed, pipeline_key)
+        await self.send(
+            text_data=json.dumps({
+                'success': bool(subscribed), 'subscribe': 'instrument', 'accounts': subscribed,
+                'skipped': [account for account in accounts if account not in subscribed],
+            })
+        )
+
+    async def _unsubscribe_users(self, accounts: typ.List[str]) -> None:
+        """Unsubscribe current user from bitmex instrument WS of several accounts at once
+
+        :param accounts: account names
+        """
+        unsubscribed = [account for account in accounts if account in self.curr_subs]
+        pipeline_keys = [self.curr_subs.pop(account) for account in unsubscribed]
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(get_pipeline(pipeline_key).group(account), self.channel_name)
+            for account, pipeline_key in zip(unsubscribed, pipeline_keys)
+        ))
+        await self.send(
+            text_data=json.dumps({
+                'success': bool(unsubscribed), 'unsubscribe': 'instrument', 'accounts': unsubscribed,
+                'skipped': [account for account in accounts if account not in unsubscribed],
+            })
+        )
+        for account, pipeline_key in zip(unsubscribed, pipeline_keys):
+            coordinator.unsubscribe(account, pipeline_key)
 
     async def _unsubscribe_user(self, account: str) -> None:
         """Subscribe current user from bitmex instrument WS
@@ -157,109 +345,404 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
                 })
             )
             return
-        await self.channel_layer.group_discard(account, self.channel_name)
+        pipeline_key = self.curr_subs.pop(account)
+        await self.channel_layer.group_discard(get_pipeline(pipeline_key).group(account), self.channel_name)
         await self.send(
             text_data=json.dumps({
                 'success': True, 'unsubscribe': 'instrument', 'account': account,
             })
         )
-        # one more check to be sure and not raise a KeyError
-        self.curr_subs.remove(account) \
-            if account in self.curr_subs else None
-        BitmexInstrumentConsumer.subs_per_group[account] -= 1
+        coordinator.unsubscribe(account, pipeline_key)
+
+    async def _resync_user(self, account: str) -> None:
+        """Send the latest relayed messages of the account to recover from a `seq` gap
+
+        :param account: account name
+        """
+        if account not in self.curr_subs or self.delta is None:
+            await self.send(
+                text_data=json.dumps({
+                    'success': False, 'resync': 'instrument', 'account': account,
+                })
+            )
+            return
+        await self.send(text_data=json.dumps(self.delta.snapshot(account)))
+
+    async def _add_alert(self, account: str, data: dict) -> None:
+        """Register a price alert evaluated on the account instrument feed
+
+        :param account: account name
+        :param data: received data with `symbol`, `type`, `price` (or `percent`
+            for the move alerts) and optional `webhook` to POST the fired alert to
+        """
+        try:
+            alert = await alert_engine.add(
+                account=account,
+                symbol=data.get('symbol'),
+                type=data.get('type'),
+                value=data.get('percent') if 'percent' in data else data.get('price'),
+                target=self.channel_name,
+                webhook=data.get('webhook'),
+            )
+        except AlertError as err:
+            await self.send(
+                text_data=json.dumps({
+                    'status': 400, 'error': str(err),
+                })
+            )
+            return
+        await self.send(
+            text_data=json.dumps({
+                'success': True, 'alert': alert.id, 'account': account,
+            })
+        )
+
+    async def _remove_alert(self, account: str, alert_id: int) -> None:
+        """Cancel a not fired alert registered on this connection
+
+        :param account: account name
+        :param alert_id: alert id
+        """
+        alert = alert_engine.alerts.get(alert_id)
+        if alert is None or alert.account != account or alert.target != self.channel_name:
+            await self.send(
+                text_data=json.dumps({
+                    'success': False, 'unalert': alert_id, 'account': account,
+                })
+            )
+            return
+        alert_engine.remove(alert_id)
+        await self.send(
+            text_data=json.dumps({
+                'success': True, 'unalert': alert_id, 'account': account,
+            })
+        )
+
+    async def _subscribe_stream(self, stream: str, account: str, symbol: str) -> None:
+        """Subscribe current user to a per instrument stream of the account feed
+
+        The streams are kept by the worker relaying the account feed. The
+        current order book levels are sent first if this process keeps them,
+        otherwise a `pending` depth message is sent and the partial follows
+        from the worker relaying the feed (the updates before it are to be
+        skipped by the client).
+
+        :param stream: 'depth' (L2 order book updates) or 'tape' (trade summaries)
+        :param account: account name
+        :param symbol: one of the stream symbols in the settings
+        """
+        group, symbols = self.streams[stream]
+        if symbol not in symbols:
+            await self.send(
+                text_data=json.dumps({
+                    'status': 400,
+                    'error': f'The {stream} of {symbol!r} is not relayed. Available symbols are: {list(symbols)}',
+                })
+            )
+            return
+        if (stream, account, symbol) in self.stream_subs:
+            await self.send(
+                text_data=json.dumps({
+                    'success': False, 'subscribe': stream, 'account': account, 'symbol': symbol,
+                })
+            )
+            return
+
+        await self.channel_layer.group_add(group(account, symbol), self.channel_name)
+        self.stream_subs.add((stream, account, symbol))
+        await coordinator.subscribe(account, DEFAULT_KEY)
+        await self.send(
+            text_data=json.dumps({
+                'success': True, 'subscribe': stream, 'account': account, 'symbol': symbol,
+            })
+        )
+        if stream != 'depth':
+            return
+        if (book := orderbook.get_book(account, symbol)) is not None:
+            await self.send(
+                text_data=json.dumps({
+                    'account': account, 'symbol': symbol, 'depth': 'partial', **book.top(len(book)),
+                })
+            )
+            return
+        # the updates are not applicable until the partial, which is sent by the worker relaying the feed
+        # (or relayed with the updates once the upstream sends it)
+        await self.send(
+            text_data=json.dumps({
+                'account': account, 'symbol': symbol, 'depth': 'pending',
+            })
+        )
+        if not coordinator.owns(account):
+            await coordinator.request_depth(account, symbol, self.channel_name)
+
+    async def _unsubscribe_stream(self, stream: str, account: str, symbol: str) -> None:
+        """Unsubscribe current user from a per instrument stream of the account feed
+
+        :param stream: 'depth' or 'tape'
+        :param account: account name
+        :param symbol: instrument symbol
+        """
+        if (stream, account, symbol) not in self.stream_subs:
+            await self.send(
+                text_data=json.dumps({
+                    'success': False, 'unsubscribe': stream, 'account': account, 'symbol': symbol,
+                })
+            )
+            return
+        self.stream_subs.discard((stream, account, symbol))
+        group, _ = self.streams[stream]
+        await self.channel_layer.group_discard(group(account, symbol), self.channel_name)
+        await self.send(
+            text_data=json.dumps({
+                'success': True, 'unsubscribe': stream, 'account': account, 'symbol': symbol,
+            })
+        )
+        coordinator.unsubscribe(account, DEFAULT_KEY)
+
+    async def send_depth(self, event):
+        """Send the order book update right away, the updates are never conflated or dropped"""
+        await self.send(text_data=json.dumps(event['depth']))
+
+    async def send_tape(self, event):
+        """Send the trade summary right away, summaries are periodic and never conflated with the prices"""
+        await self.send(text_data=json.dumps(event['tape']))
+
+    async def send_alert(self, event):
+        """Send the fired alert right away, alerts are never conflated or dropped"""
+        await self.send(text_data=json.dumps(event['alert']))
 
     async def send_message(self, event):
+        """Queue the relayed message for the client without waiting for it,
+            so a slow client does not hold the channel layer and other clients
+        """
+        if self._evicted:
+            return
         message = event['message']
-        message = json.dumps(message) if not isinstance(message, str) else message
-        await self.send(text_data=message)
+        key = (message.get('account'), message.get('symbol')) if isinstance(message, (ticks.Tick, dict)) else None
+        if self.delta:
+            self.delta.observe(message)
+        dropped, conflated = self.outbound.dropped, self.outbound.conflated
+        try:
+            self.outbound.put(message, key=key, received_at=event.get('received_at'))
+        except QueueOverflow:
+            self._evicted = True
+            metrics.inc('ws_slow_consumers_total')
+            await self.close(code=self.slow_consumer_close_code)
+            return
+        if metrics.ENABLED:
+            metrics.inc('ws_outbound_dropped_total', self.outbound.dropped - dropped)
+            metrics.inc('ws_outbound_conflated_total', self.outbound.conflated - conflated)
+
+    async def _send_outbound(self) -> None:
+        """Send queued messages to the client one by one"""
+        while True:
+            queued: QueuedMessage = await self.outbound.get()
+            message = queued.message
+            if self.delta:
+                skipped, self._dropped_encoded = self.outbound.dropped - self._dropped_encoded, self.outbound.dropped
+                if (message := self.delta.encode(message, skipped=skipped)) is None:
+                    metrics.inc('ws_delta_suppressed_total')
+                    continue
+            message = ticks.encode(message)
+            with metrics.timer('ws_stage_duration_seconds', stage='client_send'):
+                await self.send(text_data=message)
+            lag = self.outbound.mark_sent(queued)
+            if metrics.ENABLED:
+                metrics.observe('ws_stage_duration_seconds', lag, stage='outbound_queue')
+                if queued.received_at:
+                    # from the upstream frame receiving till sending it to the client
+                    metrics.observe('ws_stage_duration_seconds', time.time() - queued.received_at, stage='total')
+                metrics.inc('ws_messages_total', direction='client')
 
     @staticmethod
-    @database_sync_to_async
+    @database_async
     def _is_account_exists(account_name: str) -> bool:
         return Account.objects.filter(name=account_name).exists()
 
     @staticmethod
-    @database_sync_to_async
-    def _get_account_by_name(account_name: str) -> Account:
-        return Account.objects.get(name=account_name)
+    @database_async
+    def _get_account_names(account_names: typ.Optional[typ.List[str]]) -> typ.List[str]:
+        """Get names of the existing accounts among the given ones (of all the accounts for None)"""
+        accounts = Account.objects.all() if account_names is None else Account.objects.filter(name__in=account_names)
+        return list(accounts.values_list('name', flat=True))
 
-    async def bitmex_connect(self, account_name: str) -> None:
-        """Connect to Bitmex instrument WS
+    @classmethod
+    async def relay_upstream(cls, account_name: str) -> None:
+        """Relay Bitmex instrument WS of the account to its subscribers (in any process)
+            until the task is cancelled
 
         :param account_name: account name from DB
         """
-        ws_url = "wss://testnet.bitmex.com/realtime?subscribe=instrument"
-
-        async def monitor_data():
-            async with websockets.connect(
-                    uri=ws_url,
-                    extra_headers=await self._generate_auth_headers(
-                        account_name=account_name,
-                        url=ws_url)
-            ) as ws:
-                BitmexInstrumentConsumer.group_bitmex_ws[account_name] = ws
-                while True:
-                    if not ws.open:
-                        if BitmexInstrumentConsumer.subs_per_group[account_name] <= 0:
-                            # Stop the loop if there is no subscribers
-                            break
+        ws_url = cls.bitmex_ws_url + ''.join(
+            [f',{orderbook.TABLE}:{symbol}' for symbol in settings.ORDER_BOOK_SYMBOLS]
+            + [f',{tape.TABLE}:{symbol}' for symbol in settings.TRADE_TAPE_SYMBOLS]
+        )
+        channel_layer = get_channel_layer()
+        # conditional orders of the account are evaluated by the worker relaying its feed
+        trigger = ConditionalOrderTrigger(account_name)
+        publisher = asyncio.create_task(cls._publish_tapes(account_name, channel_layer)) \
+            if settings.TRADE_TAPE_SYMBOLS else None
+
+        try:
+            while True:
+                # the books are consistent again after the partials of the new connection
+                orderbook.reset(account_name)
+                async with await cls._connect_upstream(account_name, ws_url) as ws:
+                    try:
+                        await cls._relay_messages(ws, account_name, channel_layer, trigger)
+                    except exchange.ConnectionClosed:
                         # Websocket is not connected. Trying to reconnect.
-                        ws = await websockets.connect(
-                            uri=ws_url,
-                            extra_headers=await self._generate_auth_headers(
-                                account_name=account_name,
-                                url=ws_url
-                            ))
+                        continue
+        finally:
+            trigger.close()
+            if publisher is not None:
+                publisher.cancel()
 
-                    message = await ws.recv()
+    @classmethod
+    async def _connect_upstream(cls, account_name: str, url: str):
+        """Connect to the Bitmex WS of the account
 
-                    try:
-                        message = json.loads(message)
-                    except json.JSONDecodeError as err:
-                        await self.send(
-                            text_data=json.dumps({
+        Recorded frames are replayed instead with `UPSTREAM_REPLAY` and the
+        received frames are recorded with `UPSTREAM_RECORD_DIR` (see orders/frames.py).
+
+        :param account_name: account name from DB
+        :param url: WS uri
+        :return: connection to use as an async context manager
+        """
+        if settings.UPSTREAM_REPLAY:
+            return frames.ReplayConnection(
+                settings.UPSTREAM_REPLAY,
+                speed=settings.UPSTREAM_REPLAY_SPEED,
+                loop=settings.UPSTREAM_REPLAY_LOOP,
+            )
+        connection = exchange.connect_ws(url, await cls._generate_auth_headers(account_name=account_name, url=url))
+        if settings.UPSTREAM_RECORD_DIR:
+            # the account names come from the DB, a name with path separators must not escape the directory
+            return frames.RecordingConnection(
+                connection,
+                os.path.join(settings.UPSTREAM_RECORD_DIR, f'{os.path.basename(account_name)}.frames'),
+                compress=settings.UPSTREAM_RECORD_COMPRESS,
+            )
+        return connection
+
+    @classmethod
+    async def _relay_messages(cls, ws, account_name: str, channel_layer,
+                              trigger: typ.Optional[ConditionalOrderTrigger] = None) -> None:
+        # the ticks are relayed as dicts through a cross-process channel layer
+        serialize = not ticks.passes_ticks(channel_layer)
+
+        async def send(group: str, message: Message, received_at: float) -> None:
+            with metrics.timer('ws_stage_duration_seconds', stage='group_send'):
+                await channel_layer.group_send(
+                    group,
+                    {
+                        'type': 'send_message',
+                        'message': ticks.as_dict(message) if serialize else message,
+                        'received_at': received_at,
+                    }
+                )
+            metrics.inc('ws_messages_total', direction='fanout')
+
+        # the instruments are throttled per symbol, the reader never waits for them
+        throttle = SymbolThrottle(cls.upstream_throttle, send)
+        try:
+            await cls._read_messages(ws, account_name, channel_layer, trigger, throttle)
+        finally:
+            throttle.close()
+
+    @classmethod
+    async def _read_messages(cls, ws, account_name: str, channel_layer,
+                             trigger: typ.Optional[ConditionalOrderTrigger], throttle: SymbolThrottle) -> None:
+        while True:
+            message = await ws.recv()
+            received_at = time.time()
+            metrics.inc('ws_messages_total', direction='upstream')
+
+            try:
+                with metrics.timer('ws_stage_duration_seconds', stage='decode'):
+                    message = json.loads(message)
+            except json.JSONDecodeError as err:
+                for pipeline_key in coordinator.pipeline_keys(account_name):
+                    await channel_layer.group_send(
+                        get_pipeline(pipeline_key).group(account_name),
+                        {
+                            'type': 'send_message',
+                            'message': {
                                 'status': 400,
                                 'error': f'Failed to decode Bitmex data. '
                                          f'Message: {message}. Err: {err}',
-                            })
-                        )
-                        continue
-                    for instrument_info in self._transform_bitmex_msg(
-                            message=message,
-                            account=account_name):
-                        await self.channel_layer.group_send(
-                            account_name,
-                            {
-                                'type': 'send_message',
-                                'message': instrument_info,
-                            }
-                        )
-                    await asyncio.sleep(2)
-
-        asyncio.create_task(monitor_data())
+                            },
+                        }
+                    )
+                continue
+            if isinstance(message, dict) and message.get('table') == orderbook.TABLE:
+                # every book update is relayed, so the books are not throttled
+                await cls._relay_depth(message, account_name, channel_layer)
+                continue
+            if isinstance(message, dict) and message.get('table') == tape.TABLE:
+                # trades are only summed up here, the summaries are published by `_publish_tapes`
+                with metrics.timer('ws_stage_duration_seconds', stage='tape'):
+                    tape.add_trades(account_name, message.get('data') or (), received_at, message.get('action'))
+                continue
+            if trigger is not None and isinstance(message, dict) and isinstance(message.get('data'), list):
+                with metrics.timer('ws_stage_duration_seconds', stage='conditional_trigger'):
+                    trigger.on_rows(message['data'])
+            with metrics.timer('ws_stage_duration_seconds', stage='transform'):
+                groups_info = cls._transform_bitmex_msg(
+                    message=message,
+                    account=account_name,
+                    pipelines=[get_pipeline(key) for key in coordinator.pipeline_keys(account_name)],
+                )
+            conflated = throttle.conflated
+            for group, instruments_info in groups_info.items():
+                for instrument_info in instruments_info:
+                    await throttle.relay(group, instrument_info, received_at)
+            if throttle.conflated > conflated:
+                metrics.inc('ws_upstream_conflated_total', throttle.conflated - conflated)
 
     @staticmethod
-    def _transform_bitmex_msg(message: dict, account: str) \
-            -> typ.List[typ.Optional[dict]]:
+    async def _relay_depth(message: dict, account_name: str, channel_layer) -> None:
+        with metrics.timer('ws_stage_duration_seconds', stage='order_book'):
+            updates = orderbook.apply_message(account_name, message)
+        for update in updates:
+            await channel_layer.group_send(
+                orderbook.group(account_name, update['symbol']),
+                {'type': 'send_depth', 'depth': update},
+            )
+            metrics.inc('ws_messages_total', direction='depth')
+
+    @staticmethod
+    async def _publish_tapes(account_name: str, channel_layer) -> None:
+        """Send the trade summaries of the account instruments every `TRADE_TAPE_INTERVAL` seconds"""
+        while True:
+            await asyncio.sleep(settings.TRADE_TAPE_INTERVAL)
+            for summary in tape.get_summaries(account_name, time.time()):
+                await channel_layer.group_send(
+                    tape.group(account_name, summary['symbol']),
+                    {'type': 'send_tape', 'tape': summary},
+                )
+
+    @staticmethod
+    def _transform_bitmex_msg(message: dict, account: str, pipelines: typ.Sequence[Pipeline]) \
+            -> typ.Dict[str, typ.List[Message]]:
         """Transform bitmex message with instrument info
 
         :param message: bitmex instrument message
         :param account: account name
-        :return: transformed message
+        :param pipelines: compiled transform pipelines of the account subscribers
+        :return: transformed messages by channel layer groups
         """
         if not message or not isinstance(message, dict) \
                 or not isinstance(message.get('data'), list):
-            return []
-        return [
-            {
-                'timestamp': instrument_info.get('timestamp'),
-                'account': account,
-                'symbol': instrument_info.get('symbol'),
-                'price': price,
-            }
-            for instrument_info in message['data']
-            if (price := instrument_info.get('lastPrice'))
-        ]
+            return {}
+        for instrument_info in message['data']:
+            if (price := instrument_info.get('lastPrice')) is not None:
+                prices.update(
+                    symbol=instrument_info.get('symbol'),
+                    price=price,
+                    timestamp=instrument_info.get('timestamp'),
+                )
+        return apply_pipelines(pipelines, message['data'], account)
 
     @staticmethod
     async def _generate_auth_headers(account_name: str, url: str) \
@@ -270,43 +753,19 @@ class BitmexInstrumentConsumer(AsyncWebsocketConsumer):
         :param url: WS uri path
         :return: an iterable of (name, value) pairs
         """
-        account = await BitmexInstrumentConsumer._get_account_by_name(
-            account_name=account_name,
-        )
+        return await signing.service.get_ws_auth_headers(account_name=account_name, url=url)
 
-        api_key = account.api_key
-        expires = int(time.time()) + 5 * 60  # 5 minutes
-        signature = BitmexInstrumentConsumer._create_bitmex_signature(
-            api_secret=account.api_secret,
-            verb='GET',
-            endpoint=url,
-            expires=expires,
-        )
 
-        return [
-            ("api-expires", str(expires)),
-            ("api-signature", signature),
-            ("api-key", api_key),
-        ]
+coordinator = FeedCoordinator(
+    worker_id=settings.FEED_WORKER_ID or f'{socket.gethostname()}-{os.getpid()}',
+    run_feed=BitmexInstrumentConsumer.relay_upstream,
+    heartbeat_interval=settings.FEED_HEARTBEAT_INTERVAL,
+    load_pinned=database_async(pending_accounts),
+)
 
-    @staticmethod
-    def _create_bitmex_signature(
-            api_secret: str, verb: str, endpoint: str, expires: int) -> str:
-        """Generates an API signature.
-        A signature is HMAC_SHA256(secret, verb + path + nonce + data), hex encoded.
-
-        :param api_secret: secret api key
-        :param verb: method e.g. 'GET'
-        :param endpoint: WS uri path
-        :param expires: unix timestamp (in seconds)
-        :return: hex encoded signature
-        """
-        verb = verb.upper()
-        path = urlparse(endpoint).path
-        message = f'{verb}{path}{expires}'.encode('utf-8')
-
-        return hmac.new(
-            key=api_secret.encode('utf-8'),
-            msg=message,
-            digestmod=hashlib.sha256
-        ).hexdigest()
+alert_engine = AlertEngine(coordinator)
+
+# outbound queues of the connected clients, read on every metrics render
+metrics.set_gauge_function('ws_outbound_queued', outbound.get_queued)
+metrics.set_gauge_function('ws_outbound_lag_seconds', outbound.get_lag)
+metrics.set_gauge_function('ws_outbound_max_lag_seconds', outbound.get_max_lag)
@@ -0,0 +1,73 @@
+import time
+import asyncio
+import functools
+import threading
+import typing as typ
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from orders import metrics
+
+
+class DatabaseExecutor:
+    """Dedicated thread pool for the DB calls of the websocket consumers
+
+    Every thread keeps its own persistent DB connection (see `CONN_MAX_AGE`),
+    so the pool size bounds the number of connections and the calls
+    do not pay for the connection setup.
+
+    :param max_workers: number of DB threads (and connections)
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.queued = 0
+        self.active = 0
+        # the counters are changed by the event loop thread and the pool threads
+        self._lock = threading.Lock()
+        self._pool: typ.Optional[ThreadPoolExecutor] = None
+
+    async def run(self, func: typ.Callable, *args, **kwargs):
+        """Run the sync function with DB access in the pool
+
+        :param func: function to call
+        :return: function result
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='consumer-db')
+        self._count(queued=1)
+        call = functools.partial(self._call, time.monotonic(), func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, call)
+
+    def _call(self, queued_at: float, func: typ.Callable, *args, **kwargs):
+        self._count(queued=-1, active=1)
+        metrics.observe('db_executor_wait_seconds', time.monotonic() - queued_at)
+        # drops only the broken connections and the ones older than CONN_MAX_AGE
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+            self._count(active=-1)
+
+    def _count(self, queued: int = 0, active: int = 0) -> None:
+        with self._lock:
+            self.queued += queued
+            self.active += active
+            metrics.set_gauge('db_executor_queued', self.queued)
+            metrics.set_gauge('db_executor_active', self.active)
+
+
+executor = DatabaseExecutor(max_workers=settings.CONSUMER_DB_WORKERS)
+
+
+def database_async(func: typ.Callable) -> typ.Callable[..., typ.Awaitable]:
+    """Make the sync function with DB access awaitable in the consumers DB pool"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await executor.run(func, *args, **kwargs)
+
+    return wrapper
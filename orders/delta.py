@@ -0,0 +1,86 @@
+import typing as typ
+
+from orders.ticks import Tick
+
+# fields identifying the instrument of a relayed message
+KEY_FIELDS = ('account', 'symbol')
+# fields sent with every delta, but not making a message a change on their own
+CONTEXT_FIELDS = ('timestamp',)
+
+MODES = ('full', 'delta')
+
+
+class DeltaEncoder:
+    """Turns relayed messages of one websocket connection into deltas
+
+    A delta has a `seq` number and only the fields changed since the last
+    message sent for the same instrument, messages without changes are not sent.
+    `seq` numbers skip the messages dropped from the outbound queue, so the
+    client sees a gap and asks for a resync (a snapshot of the latest messages).
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.suppressed = 0
+        # the last sent (i.e. known to the client) fields by instrument keys
+        self._sent: typ.Dict[tuple, dict] = {}
+        # the latest relayed message by instrument keys (including dropped/not yet sent ones)
+        self._latest: typ.Dict[tuple, dict] = {}
+
+    def observe(self, message: dict) -> None:
+        """Remember the latest relayed message for resyncs"""
+        if (key := _get_key_(message)) is not None:
+            self._latest[key] = message
+
+    def encode(self, message: dict, skipped: int = 0) -> typ.Optional[dict]:
+        """Get delta of the message to send
+
+        :param message: relayed message
+        :param skipped: number of messages dropped since the previous call
+        :return: delta or None if nothing changed
+        """
+        self.seq += skipped
+        if (key := _get_key_(message)) is None:
+            # e.g. an error, sent as is
+            return message
+
+        sent = self._sent.get(key, {})
+        changed = {
+            field: value
+            for field, value in message.items()
+            if field not in KEY_FIELDS and field not in CONTEXT_FIELDS and sent.get(field) != value
+        }
+        if not changed:
+            self.suppressed += 1
+            return None
+
+        self._sent[key] = {**sent, **changed}
+        self.seq += 1
+        return {
+            'seq': self.seq,
+            **{field: message[field] for field in KEY_FIELDS},
+            **{field: message[field] for field in CONTEXT_FIELDS if field in message},
+            **changed,
+        }
+
+    def snapshot(self, account: str) -> dict:
+        """Get the latest messages of the account and treat them as sent
+
+        :param account: account name
+        :return: resync message with the current `seq`
+        """
+        instruments = []
+        for key, message in self._latest.items():
+            if key[0] == account:
+                self._sent[key] = {
+                    field: value for field, value in message.items()
+                    if field not in KEY_FIELDS and field not in CONTEXT_FIELDS
+                }
+                instruments.append(dict(message))
+        return {'resync': True, 'seq': self.seq, 'account': account, 'instruments': instruments}
+
+
+def _get_key_(message) -> typ.Optional[tuple]:
+    if not isinstance(message, (Tick, dict)) or any(message.get(field) is None for field in KEY_FIELDS):
+        return None
+    return tuple(message[field] for field in KEY_FIELDS)
@@ -0,0 +1,205 @@
+import time
+import hashlib
+import threading
+import typing as typ
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from orders import metrics, signing
+from orders.models import Account
+
+BITMEX_TEST_MODE = settings.DEBUG
+
+# bravado errors of the Bitmex REST calls, imported on the first access (see `__getattr__`)
+HTTP_ERRORS = ('HTTPError', 'HTTPBadRequest', 'HTTPUnauthorized', 'HTTPNotFound')
+# websockets errors of the Bitmex websocket connections
+WS_ERRORS = ('ConnectionClosed',)
+
+# Bitmex clients by account names with the signers they were built with
+_clients: typ.Dict[str, typ.Tuple[signing.Signer, typ.Any]] = {}
+
+
+def __getattr__(name: str):
+    # the exchange client libraries take a while to import and many processes
+    # (migrations, admin, management commands) never call Bitmex,
+    # so they are imported on the first use only
+    if name in HTTP_ERRORS:
+        from bravado import exception
+        return getattr(exception, name)
+    if name in WS_ERRORS:
+        import websockets
+        return getattr(websockets, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def bitmex(**kwargs):
+    """Build Bitmex REST client, the `bitmex` package is imported on the first call
+
+    :param kwargs: `bitmex.bitmex` parameters
+    :return: bitmex client
+    """
+    from bitmex import bitmex as bitmex_client
+    return bitmex_client(**kwargs)
+
+
+def connect_ws(url: str, headers: typ.List[typ.Tuple[str, str]]):
+    """Connect to the Bitmex websocket, the `websockets` package is imported on the first call
+
+    :param url: WS uri
+    :param headers: extra (auth) headers
+    :return: connection to use as an async context manager
+    """
+    import websockets
+    return websockets.connect(uri=url, extra_headers=headers)
+
+
+def get_client(account: Account):
+    """Get Bitmex REST client with the account credentials
+
+    Building a client loads and parses the whole swagger spec, so the client
+    is reused until the account signer changes (i.e. the account is saved).
+
+    :param account: account model
+    :return: bitmex client
+    """
+    with metrics.timer('stage_duration_seconds', stage='client'):
+        signer = signing.service.signer_for(account)
+        cached = _clients.get(account.name)
+        if cached and cached[0] is signer:
+            return cached[1]
+
+        client = bitmex(
+            test=BITMEX_TEST_MODE,
+            api_key=account.api_key,
+            api_secret=account.api_secret,
+        )
+        http_client = client.swagger_spec.http_client
+        # sign requests with the cached pre-keyed HMAC of the account secret
+        http_client.authenticator = signing.CachedSignerAuthenticator(
+            host=http_client.authenticator.host,
+            signer=signer,
+        )
+        _clients[account.name] = (signer, client)
+        return client
+
+
+def get_result(future):
+    """Wait for the Bitmex response
+
+    :param future: bravado future of the Bitmex request
+    :return: Bitmex response
+    """
+    with metrics.timer('stage_duration_seconds', stage='exchange'):
+        return future.result()
+
+
+class SingleFlight:
+    """Shares one in-flight call between the identical concurrent calls
+
+    The first caller of a key runs the call, the ones coming while it runs
+    wait for its result (or exception) instead of repeating it. A successful
+    result is also reused for `reuse` seconds after the call completes.
+    Keys start with the account name, so the writes of an account can
+    `forget` its reused results.
+
+    :param reuse: seconds to reuse a completed call result (0 to share in-flight calls only)
+    """
+
+    def __init__(self, reuse: float = 0):
+        self.reuse = reuse
+        self._lock = threading.Lock()
+        # calls by keys with their completion time (None while in flight)
+        self._calls: typ.Dict[tuple, typ.Tuple[Future, typ.Optional[float]]] = {}
+
+    def do(self, key: tuple, func: typ.Callable[[], typ.Any]):
+        """Call the function or wait for the same call in flight
+
+        :param key: call key, the account name first
+        :param func: call to run
+        :return: call result
+        """
+        with self._lock:
+            now = time.monotonic()
+            future, completed_at = self._calls.get(key, (None, None))
+            if future is not None and (completed_at is None or now - completed_at <= self.reuse):
+                is_leader = False
+            else:
+                is_leader = True
+                for expired in [key for key, (_, completed_at) in self._calls.items()
+                                if completed_at is not None and now - completed_at > self.reuse]:
+                    del self._calls[expired]
+                future = Future()
+                self._calls[key] = (future, None)
+
+        if not is_leader:
+            metrics.inc('exchange_reads_coalesced_total')
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as err:
+            with self._lock:
+                self._calls.pop(key, None)
+            future.set_exception(err)
+            raise
+        with self._lock:
+            if self.reuse > 0:
+                self._calls[key] = (future, time.monotonic())
+            else:
+                self._calls.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def forget(self, account_name: str) -> None:
+        """Drop the reused results of the account (calls in flight stay)"""
+        with self._lock:
+            for key in [key for key, (_, completed_at) in self._calls.items()
+                        if key[0] == account_name and completed_at is not None]:
+                del self._calls[key]
+
+
+# concurrent identical exchange reads (e.g. polling dashboards) share one Bitmex request
+reads = SingleFlight(reuse=settings.EXCHANGE_READ_REUSE)
+
+
+def get_orders(account: Account, filter_: str) -> typ.List[dict]:
+    """Get account orders from Bitmex, coalescing the identical concurrent requests
+
+    :param account: account model
+    :param filter_: JSON encoded Bitmex orders filter
+    :return: orders info returned by Bitmex
+    :raise bravado.exception.HTTPError: if Bitmex rejects the request
+    """
+    def get():
+        result, _ = get_result(get_client(account).Order.Order_getOrders(filter=filter_))
+        return result
+
+    # the credentials (a digest of them) are a part of the key, so a changed secret never gets the old result
+    return reads.do((account.name, _get_fingerprint_(account), 'Order_getOrders', filter_), get)
+
+
+def new_market_order(account: Account, symbol: str, volume: int, side: str) -> dict:
+    """Place a market order with the pooled client of the account
+
+    :param account: account model
+    :param symbol: instrument symbol
+    :param volume: order quantity
+    :param side: 'Buy' or 'Sell'
+    :return: order info returned by Bitmex
+    :raise bravado.exception.HTTPError: if Bitmex rejects the order
+    """
+    client = get_client(account)
+    result, _ = get_result(client.Order.Order_new(
+        symbol=symbol,
+        orderQty=volume,
+        side=side,
+        ordType='Market',
+    ))
+    reads.forget(account.name)
+    return result
+
+
+def _get_fingerprint_(account: Account) -> str:
+    """Get a digest of the account credentials, so the secret itself is not kept in the keys"""
+    return hashlib.sha256(f'{account.api_key}:{account.api_secret}'.encode('utf-8')).hexdigest()
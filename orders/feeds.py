@@ -0,0 +1,361 @@
+import time
+import bisect
+import asyncio
+import logging
+import hashlib
+import typing as typ
+
+from django.db import DatabaseError
+from channels.layers import get_channel_layer
+
+from orders import metrics, orderbook, prices
+
+logger = logging.getLogger(__name__)
+
+# channel layer group of all the worker processes relaying upstream feeds
+WORKERS_GROUP = 'feed-workers'
+
+
+class HashRing:
+    """Consistent hashing of account names to worker ids
+
+    Every worker is placed on the ring `replicas` times, so when a worker
+    joins or leaves only its share of the accounts moves to other workers.
+
+    :param workers: initial worker ids
+    :param replicas: number of ring points per worker
+    """
+
+    def __init__(self, workers: typ.Iterable[str] = (), replicas: int = 64):
+        self.replicas = replicas
+        self._points: typ.List[int] = []
+        self._owners: typ.Dict[int, str] = {}
+        for worker in workers:
+            self.add(worker)
+
+    def __contains__(self, worker: str) -> bool:
+        return worker in self._owners.values()
+
+    @property
+    def workers(self) -> typ.Set[str]:
+        return set(self._owners.values())
+
+    def add(self, worker: str) -> None:
+        for replica in range(self.replicas):
+            point = _hash_(f'{worker}#{replica}')
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = worker
+
+    def remove(self, worker: str) -> None:
+        for replica in range(self.replicas):
+            point = _hash_(f'{worker}#{replica}')
+            if self._owners.get(point) == worker:
+                del self._owners[point]
+                del self._points[bisect.bisect_left(self._points, point)]
+
+    def owner(self, key: str) -> typ.Optional[str]:
+        """Get worker id owning the key (None if there are no workers)"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash_(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+class FeedCoordinator:
+    """Assigns upstream account feeds to the worker processes
+
+    Workers find each other with heartbeats sent to the `WORKERS_GROUP` of the
+    channel layer and place the accounts on a `HashRing` of the live workers.
+    Processes with subscribers of an account keep announcing the demand for
+    its feed, only the owner worker relays it (into the account group, which
+    reaches the subscribers of every process). On join/leave of a worker the
+    moved feeds are stopped by the old owner and started by the new one.
+    The demand also names the transform pipelines (canonical specs) the
+    subscribers need, so the owner applies only them. Accounts returned by
+    `load_pinned` (e.g. the ones with pending conditional orders) are in
+    demand on every worker without any subscribers.
+
+    With the in-memory channel layer the process is the only worker and relays all the feeds.
+
+    :param worker_id: unique id of this worker process
+    :param run_feed: coroutine function relaying the upstream feed of an account
+    :param heartbeat_interval: seconds between heartbeats and demand announcements
+    :param worker_timeout: seconds without heartbeats to consider a worker gone
+    :param load_pinned: coroutine function getting the account names to relay regardless of the subscribers
+    """
+
+    def __init__(self, worker_id: str, run_feed: typ.Callable[[str], typ.Awaitable],
+                 heartbeat_interval: float = 5, worker_timeout: float = None,
+                 load_pinned: typ.Callable[[], typ.Awaitable[typ.Iterable[str]]] = None):
+        self.worker_id = worker_id
+        self.run_feed = run_feed
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_timeout = worker_timeout or heartbeat_interval * 3
+        self.ring = HashRing([worker_id])
+        # last heartbeat time by worker ids
+        self.workers: typ.Dict[str, float] = {worker_id: time.monotonic()}
+        # number of subscribers in this process by account names and pipeline keys
+        self.subscribers: typ.Dict[str, typ.Dict[str, int]] = {}
+        # demand lease expiration time by account names (announced by any worker)
+        self.demand: typ.Dict[str, float] = {}
+        # demand lease expiration time by account names and pipeline keys
+        self.pipelines: typ.Dict[str, typ.Dict[str, float]] = {}
+        # upstream feeds relayed by this worker
+        self.feeds: typ.Dict[str, asyncio.Task] = {}
+        self.load_pinned = load_pinned
+        # account names in demand without subscribers (refreshed every heartbeat)
+        self.pinned: typ.Set[str] = set()
+        self._channel: typ.Optional[str] = None
+        self._tasks: typ.List[asyncio.Task] = []
+
+    def owns(self, account_name: str) -> bool:
+        return self.ring.owner(account_name) == self.worker_id
+
+    def pipeline_keys(self, account_name: str) -> typ.List[str]:
+        """Get pipelines needed by the subscribers of the account in any process"""
+        return list(self.pipelines.get(account_name, ()))
+
+    async def subscribe(self, account_name: str, pipeline_key: str) -> None:
+        """Count a new subscriber of the account feed in this process
+
+        :param account_name: account name
+        :param pipeline_key: canonical spec of the subscriber transform pipeline
+        """
+        await self.subscribe_many([account_name], pipeline_key)
+
+    async def subscribe_many(self, account_names: typ.Iterable[str], pipeline_key: str) -> None:
+        """Count a new subscriber of every account feed, the new demand is announced in one message
+
+        :param account_names: account names
+        :param pipeline_key: canonical spec of the subscriber transform pipeline
+        """
+        await self._ensure_started()
+        demanded = []
+        for account_name in account_names:
+            counts = self.subscribers.setdefault(account_name, {})
+            counts[pipeline_key] = counts.get(pipeline_key, 0) + 1
+            if counts[pipeline_key] == 1:
+                self._on_demand(account_name, [pipeline_key])
+                demanded.append(account_name)
+        await self._announce(demanded)
+
+    def unsubscribe(self, account_name: str, pipeline_key: str) -> None:
+        """Forget a subscriber, the feed stops when the demand lease of all the workers expires"""
+        counts = self.subscribers.get(account_name, {})
+        if counts.get(pipeline_key, 0) > 1:
+            counts[pipeline_key] -= 1
+            return
+        counts.pop(pipeline_key, None)
+        if not counts:
+            self.subscribers.pop(account_name, None)
+
+    def status(self) -> dict:
+        return {
+            'worker': self.worker_id,
+            'workers': sorted(self.workers),
+            'feeds': sorted(account_name for account_name, task in self.feeds.items() if not task.done()),
+            'subscribers': {account_name: sum(counts.values()) for account_name, counts in self.subscribers.items()},
+            'assignments': {account_name: self.ring.owner(account_name) for account_name in sorted(self.demand)},
+        }
+
+    def rebalance(self) -> None:
+        """Drop the gone workers and start/stop the feeds this worker (no longer) owns"""
+        now = time.monotonic()
+        self.workers[self.worker_id] = now
+        for worker in [worker for worker, seen_at in self.workers.items() if now - seen_at > self.worker_timeout]:
+            del self.workers[worker]
+            self.ring.remove(worker)
+        for account_name in self.pinned:
+            self.demand[account_name] = now + self.worker_timeout
+        for account_name, counts in self.subscribers.items():
+            self.demand[account_name] = now + self.worker_timeout
+            for pipeline_key in counts:
+                self.pipelines.setdefault(account_name, {})[pipeline_key] = now + self.worker_timeout
+        for account_name in [account_name for account_name, expires in self.demand.items() if expires < now]:
+            del self.demand[account_name]
+        for account_name, leases in list(self.pipelines.items()):
+            for pipeline_key in [pipeline_key for pipeline_key, expires in leases.items() if expires < now]:
+                del leases[pipeline_key]
+            if not leases:
+                del self.pipelines[account_name]
+
+        for account_name, task in list(self.feeds.items()):
+            if task.done() or account_name not in self.demand or not self.owns(account_name):
+                task.cancel()
+                del self.feeds[account_name]
+        for account_name in self.demand:
+            if self.owns(account_name) and account_name not in self.feeds:
+                self._start_feed(account_name)
+        metrics.set_gauge('ws_upstream_feeds', len(self.feeds))
+
+    async def handle(self, message: dict) -> None:
+        """Handle a coordination message of the other workers"""
+        if message['type'] == 'feed.heartbeat':
+            worker = message['worker']
+            is_new = worker not in self.workers
+            self.workers[worker] = time.monotonic()
+            if is_new:
+                self.ring.add(worker)
+                self.rebalance()
+                # let the new worker know about this one and the needed feeds right away
+                await self._heartbeat()
+                await self._announce(list(self.subscribers))
+        elif message['type'] == 'feed.demand':
+            for account_name, pipeline_keys in message['accounts'].items():
+                self._on_demand(account_name, pipeline_keys)
+        elif message['type'] == 'feed.depth_snapshot':
+            await self._send_depth(message)
+        elif message['type'] == 'feed.prices':
+            await self._send_prices(message)
+
+    async def request_depth(self, account_name: str, symbol: str, reply_to: str, levels: int = None) -> None:
+        """Ask the worker relaying the account feed for the order book partial of the instrument
+
+        The worker sends it as a `send_depth` event to the `reply_to` channel,
+        only if it keeps the book already (otherwise the partial is relayed
+        with the depth updates once the upstream sends it).
+
+        :param account_name: account name
+        :param symbol: instrument symbol
+        :param reply_to: channel name to send the partial to
+        :param levels: number of levels per side, all the levels by default
+        """
+        await get_channel_layer().group_send(WORKERS_GROUP, {
+            'type': 'feed.depth_snapshot',
+            'worker': self.worker_id,
+            'account': account_name,
+            'symbol': symbol,
+            'levels': levels,
+            'reply_to': reply_to,
+        })
+
+    async def fetch_depth(self, account_name: str, symbol: str, levels: int = None,
+                          timeout: float = 1) -> typ.Optional[dict]:
+        """Get the order book partial of the instrument from the worker relaying the account feed
+
+        :return: the partial depth message, None if no worker sent it within the timeout
+        """
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel(prefix='feed-depth')
+        await self.request_depth(account_name, symbol, channel, levels)
+        try:
+            event = await asyncio.wait_for(channel_layer.receive(channel), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return event['depth']
+
+    async def fetch_prices(self, account_name: str, timeout: float = 1) -> typ.Optional[typ.Dict[str, float]]:
+        """Get the last instrument prices relayed by the worker relaying the account feed
+
+        :return: prices by symbols, None if no worker sent them within the timeout
+        """
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel(prefix='feed-prices')
+        await channel_layer.group_send(WORKERS_GROUP, {
+            'type': 'feed.prices',
+            'worker': self.worker_id,
+            'account': account_name,
+            'reply_to': channel,
+        })
+        try:
+            event = await asyncio.wait_for(channel_layer.receive(channel), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return event['prices']
+
+    async def run(self) -> None:
+        while True:
+            if self.load_pinned is not None:
+                try:
+                    self.pinned = set(await self.load_pinned())
+                except DatabaseError as err:
+                    logger.warning('Failed to load the pinned feeds: %s', err)
+            await self._heartbeat()
+            await self._announce(list(self.subscribers))
+            self.rebalance()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def serve(self) -> None:
+        """Run as a worker process without websocket clients (e.g. for the pinned feeds)"""
+        await self._ensure_started()
+        await asyncio.gather(*self._tasks)
+
+    async def stop(self) -> None:
+        """Cancel the feeds relayed by this worker and the coordination (e.g. before the event loop is closed)"""
+        tasks = [*self.feeds.values(), *self._tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.feeds.clear()
+        self._tasks = []
+        metrics.set_gauge('ws_upstream_feeds', 0)
+
+    async def listen(self) -> None:
+        channel_layer = get_channel_layer()
+        while True:
+            await self.handle(await channel_layer.receive(self._channel))
+
+    async def _ensure_started(self) -> None:
+        if self._tasks and not any(task.done() for task in self._tasks):
+            return
+        for task in self._tasks:
+            task.cancel()
+        channel_layer = get_channel_layer()
+        self._channel = await channel_layer.new_channel(prefix='feed-worker')
+        await channel_layer.group_add(WORKERS_GROUP, self._channel)
+        self._tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.run())]
+
+    def _on_demand(self, account_name: str, pipeline_keys: typ.Iterable[str]) -> None:
+        self.demand[account_name] = expires = time.monotonic() + self.worker_timeout
+        leases = self.pipelines.setdefault(account_name, {})
+        for pipeline_key in pipeline_keys:
+            leases[pipeline_key] = expires
+        # registered right away, so concurrent subscribers never open a second upstream connection
+        if self.owns(account_name) and (account_name not in self.feeds or self.feeds[account_name].done()):
+            self._start_feed(account_name)
+
+    def _start_feed(self, account_name: str) -> None:
+        self.feeds[account_name] = asyncio.create_task(self.run_feed(account_name))
+        metrics.set_gauge('ws_upstream_feeds', len(self.feeds))
+
+    async def _send_depth(self, message: dict) -> None:
+        account_name, symbol = message['account'], message['symbol']
+        if account_name not in self.feeds or (book := orderbook.get_book(account_name, symbol)) is None:
+            return
+        await get_channel_layer().send(message['reply_to'], {
+            'type': 'send_depth',
+            'depth': {
+                'account': account_name, 'symbol': symbol, 'depth': 'partial',
+                **book.top(message.get('levels') or len(book)),
+            },
+        })
+
+    async def _send_prices(self, message: dict) -> None:
+        if message['account'] not in self.feeds:
+            return
+        await get_channel_layer().send(message['reply_to'], {
+            'type': 'send_prices',
+            'prices': {symbol: price for symbol, (price, _) in prices.last_prices.items()},
+        })
+
+    async def _heartbeat(self) -> None:
+        await get_channel_layer().group_send(WORKERS_GROUP, {
+            'type': 'feed.heartbeat',
+            'worker': self.worker_id,
+        })
+
+    async def _announce(self, account_names: typ.List[str]) -> None:
+        if account_names:
+            await get_channel_layer().group_send(WORKERS_GROUP, {
+                'type': 'feed.demand',
+                'worker': self.worker_id,
+                'accounts': {
+                    account_name: list(self.subscribers.get(account_name, ()))
+                    for account_name in account_names
+                },
+            })
+
+
+def _hash_(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
@@ -0,0 +1,219 @@
+import os
+import mmap
+import time
+import struct
+import asyncio
+import typing as typ
+
+try:
+    import zstandard
+except ImportError:
+    # frames are written uncompressed without the optional `zstandard` package
+    zstandard = None
+
+# file header: magic, format version and flags
+MAGIC = b'BMXF'
+VERSION = 1
+HEADER = struct.Struct('<4sBB')
+# record header: receive unix time and payload length, followed by the payload
+RECORD = struct.Struct('<dI')
+
+# header flags
+FLAG_ZSTD = 1
+
+
+class FrameFileError(Exception):
+    """Not a frames file or it can not be written/read"""
+
+
+class FrameWriter:
+    """Appends raw upstream frames with their receive time to a frames file
+
+    Every record is a fixed-size header (receive time and payload length)
+    followed by the payload, so the file is appended to without any index
+    and read back with a memory map. With `compress` every payload is
+    compressed with zstd on its own and records stay independent.
+
+    :param path: frames file path (appended to if it exists, after its last complete record)
+    :param compress: compress the payloads with zstd (needs the `zstandard` package)
+    """
+
+    def __init__(self, path: str, compress: bool = False):
+        if compress and zstandard is None:
+            raise FrameFileError('Compressed frames need the zstandard package: pip install zstandard')
+        self.path = path
+        self.frames = 0
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION, FLAG_ZSTD if compress else 0))
+            self.flags = FLAG_ZSTD if compress else 0
+        else:
+            with open(path, 'rb') as file:
+                self.flags = _read_header_(file.read(HEADER.size), path)
+                end = _records_end_(file)
+            if bool(self.flags & FLAG_ZSTD) != compress:
+                self._file.close()
+                raise FrameFileError(f'Can not append {"" if compress else "un"}compressed frames to {path!r}')
+            # a truncated last record (e.g. of a killed recorder) would hide the appended ones from the readers
+            self._file.truncate(end)
+        self._compressor = zstandard.ZstdCompressor() if compress else None
+
+    def write(self, frame: typ.Union[str, bytes], received_at: float) -> None:
+        payload = frame.encode('utf-8') if isinstance(frame, str) else frame
+        if self._compressor is not None:
+            payload = self._compressor.compress(payload)
+        self._file.write(RECORD.pack(received_at, len(payload)))
+        self._file.write(payload)
+        self.frames += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_frames(path: str) -> typ.Iterator[typ.Tuple[float, str]]:
+    """Read the recorded frames from a memory mapped frames file
+
+    A truncated last record (e.g. of a killed recorder) is skipped.
+
+    :param path: frames file path
+    :return: receive unix time and frame text of every record
+    :raise FrameFileError: if the file is not a frames file
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < HEADER.size:
+            raise FrameFileError(f'{path!r} is not a frames file')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            flags = _read_header_(buffer[:HEADER.size], path)
+            decompressor = None
+            if flags & FLAG_ZSTD:
+                if zstandard is None:
+                    raise FrameFileError('Compressed frames need the zstandard package: pip install zstandard')
+                decompressor = zstandard.ZstdDecompressor()
+
+            offset, size = HEADER.size, len(buffer)
+            while offset + RECORD.size <= size:
+                received_at, length = RECORD.unpack_from(buffer, offset)
+                offset += RECORD.size
+                if offset + length > size:
+                    break
+                payload = buffer[offset:offset + length]
+                offset += length
+                if decompressor is not None:
+                    payload = decompressor.decompress(payload)
+                yield received_at, payload.decode('utf-8')
+
+
+class RecordingConnection:
+    """Upstream websocket connection writing every received frame to a frames file
+
+    The frames file is opened once the connection is established, so a failed connection leaves no open file.
+
+    :param connection: websocket connection (an async context manager, e.g. `websockets.connect(...)`)
+    :param path: frames file path (see `FrameWriter`)
+    :param compress: compress the payloads with zstd
+    """
+
+    def __init__(self, connection, path: str, compress: bool = False):
+        self.connection = connection
+        self.path = path
+        self.compress = compress
+        self.writer: typ.Optional[FrameWriter] = None
+        self._ws = None
+
+    async def __aenter__(self):
+        self._ws = await self.connection.__aenter__()
+        try:
+            self.writer = FrameWriter(self.path, compress=self.compress)
+        except BaseException as err:
+            await self.connection.__aexit__(type(err), err, err.__traceback__)
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.writer.close()
+        return await self.connection.__aexit__(*exc_info)
+
+    async def recv(self) -> str:
+        frame = await self._ws.recv()
+        self.writer.write(frame, time.time())
+        return frame
+
+
+class ReplayConnection:
+    """Replays recorded frames in place of an upstream websocket connection
+
+    :param path: frames file path
+    :param speed: replay speed relative to the recording (2 for twice as fast),
+        0 to replay as fast as possible
+    :param loop: start over after the last frame instead of waiting forever
+    :raise FrameFileError: on receiving, if the looped frames file has no frames
+    """
+
+    def __init__(self, path: str, speed: float = 1, loop: bool = False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.replayed = 0
+        # number of finished passes over the frames file
+        self.passes = 0
+        self._frames: typ.Optional[typ.Iterator[typ.Tuple[float, str]]] = None
+        # (first recorded time, replay start time)
+        self._started: typ.Optional[typ.Tuple[float, float]] = None
+
+    async def __aenter__(self):
+        self._frames = read_frames(self.path)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._frames = None
+
+    async def recv(self) -> str:
+        try:
+            received_at, frame = next(self._frames)
+        except StopIteration:
+            self.passes += 1
+            if not self.loop:
+                # like a quiet upstream, until the relay is cancelled
+                await asyncio.Future()
+            self._frames, self._started = read_frames(self.path), None
+            try:
+                received_at, frame = next(self._frames)
+            except StopIteration:
+                raise FrameFileError(f'{self.path!r} has no frames to replay') from None
+
+        if self.speed:
+            now = time.monotonic()
+            if self._started is None:
+                self._started = (received_at, now)
+            delay = (received_at - self._started[0]) / self.speed - (now - self._started[1])
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self.replayed += 1
+        return frame
+
+
+def _records_end_(file: typ.BinaryIO) -> int:
+    """Get the offset after the last complete record of an open frames file"""
+    offset, size = HEADER.size, os.fstat(file.fileno()).st_size
+    while offset + RECORD.size <= size:
+        file.seek(offset)
+        _, length = RECORD.unpack(file.read(RECORD.size))
+        if offset + RECORD.size + length > size:
+            break
+        offset += RECORD.size + length
+    return offset
+
+
+def _read_header_(header: bytes, path: str) -> int:
+    if len(header) < HEADER.size:
+        raise FrameFileError(f'{path!r} is not a frames file')
+    magic, version, flags = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise FrameFileError(f'{path!r} is not a frames file of the version {VERSION}')
+    return flags
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.archive import ArchiveError, archive_orders, ensure_partitions, month_start, shift_months
+
+
+class Command(BaseCommand):
+    help = 'Move orders of the old months to compressed CSV files (detaching their PostgreSQL partitions) ' \
+           'and create the partitions of the next months'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-months', type=int, default=settings.ORDERS_HOT_MONTHS,
+            help='Number of the latest months (including the current one) which orders stay in the DB',
+        )
+        parser.add_argument(
+            '--before',
+            help='Archive the months before the month of this date (YYYY-MM-DD) instead of --keep-months',
+        )
+        parser.add_argument(
+            '--dir', default=settings.ORDERS_ARCHIVE_DIR,
+            help='Directory of the archive files',
+        )
+        parser.add_argument(
+            '--months-ahead', type=int, default=2,
+            help='Number of the next months to create the partitions of',
+        )
+
+    def handle(self, *args, **options):
+        if options['before']:
+            if (before := parse_date(options['before'])) is None:
+                raise CommandError(f'Expected a YYYY-MM-DD date, got: {options["before"]!r}')
+        else:
+            before = shift_months(month_start(timezone.now()), 1 - max(options['keep_months'], 1))
+        if not settings.POSITIONS_MATERIALIZED:
+            self.stderr.write('Positions are aggregated from the orders in the DB, '
+                              'the archived orders are not counted without POSITIONS_MATERIALIZED')
+
+        for name in ensure_partitions(options['months_ahead']):
+            self.stdout.write(f'Created the orders partition {name!r}')
+        try:
+            archived = archive_orders(before, options['dir'])
+        except ArchiveError as err:
+            raise CommandError(str(err))
+        for path, count in archived:
+            self.stdout.write(f'Archived {count} orders to {path!r}')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Account
+from orders.positions import rebuild_positions
+
+
+class Command(BaseCommand):
+    help = 'Recompute materialized positions from the orders table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('accounts', nargs='*', help='Account names (all the accounts by default)')
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.all()
+        if options['accounts']:
+            accounts = accounts.filter(name__in=options['accounts'])
+        for account in accounts:
+            rebuild_positions(account)
+            self.stdout.write(f'Rebuilt positions for the account {account.name!r}')
@@ -0,0 +1,30 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from orders.reconciler import run_reconciler
+
+
+class Command(BaseCommand):
+    help = 'Periodically sync local orders with the Bitmex exchange state'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=30,
+            help='Delay between reconciliation rounds in seconds',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='Maximum number of accounts reconciled at the same time',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Run a single reconciliation round and exit',
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(run_reconciler(
+            interval=options['interval'],
+            workers=options['workers'],
+            once=options['once'],
+        ))
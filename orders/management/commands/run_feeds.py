@@ -0,0 +1,13 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from orders.consumer import coordinator
+
+
+class Command(BaseCommand):
+    help = 'Run an upstream feeds worker without websocket clients ' \
+           '(relays the feeds of the accounts with pending conditional orders)'
+
+    def handle(self, *args, **options):
+        asyncio.run(coordinator.serve())
@@ -0,0 +1,332 @@
+import time
+import threading
+import typing as typ
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, Http404
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework.renderers import JSONRenderer
+
+ENABLED = settings.METRICS_ENABLED
+
+# number of bits for the sub-buckets of every power of two
+# (16 sub-buckets keep the relative error of recorded values below ~6%)
+SUB_BUCKET_BITS = 4
+
+# `le` bounds (in seconds) of the exported Prometheus histogram buckets
+EXPORT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+HELP = {
+    'http_request_duration_seconds': 'REST API request latency',
+    'http_requests_total': 'Number of REST API requests',
+    'stage_duration_seconds': 'REST API hot path stages latency',
+    'ws_stage_duration_seconds': 'Instrument relay stages latency',
+    'ws_messages_total': 'Number of instrument relay messages',
+    'ws_outbound_dropped_total': 'Number of messages dropped from full client outbound queues',
+    'ws_outbound_conflated_total': 'Number of messages replaced by a newer one for the same symbol',
+    'ws_upstream_conflated_total': 'Number of instrument messages merged into a newer one by the upstream throttle',
+    'ws_delta_suppressed_total': 'Number of messages not sent to delta mode clients as nothing changed',
+    'ws_outbound_queued': 'Number of messages waiting in the client outbound queues of this worker',
+    'ws_outbound_lag_seconds': 'Time the oldest queued message of the slowest client of this worker is waiting',
+    'ws_outbound_max_lag_seconds': 'Longest time a sent message waited in the outbound queue of a connected client',
+    'ws_slow_consumers_total': 'Number of clients disconnected for not keeping up with messages',
+    'ws_upstream_feeds': 'Number of upstream account feeds relayed by this worker',
+    'alerts_active': 'Number of price alerts waiting to fire',
+    'alerts_fired_total': 'Number of fired price alerts',
+    'alerts_webhook_errors_total': 'Number of price alerts not delivered to their webhooks',
+    'exchange_reads_coalesced_total': 'Number of Bitmex reads answered by an identical request in flight',
+    'conditional_orders_watched': 'Number of pending conditional orders evaluated by this worker',
+    'conditional_orders_fired_total': 'Number of fired conditional orders by the resulting status',
+    'admission_active': 'Number of REST requests calling Bitmex admitted by the admission control',
+    'admission_queued': 'Number of REST requests waiting for an admission',
+    'admission_wait_seconds': 'Time the queued REST requests waited for an admission',
+    'admission_rejected_total': 'Number of REST requests shed by the admission control by the reason',
+    'db_reads_total': 'Number of read-only requests by the DB they are routed to (with replicas only)',
+    'db_executor_queued': 'Number of consumer DB calls waiting for a free DB thread',
+    'db_executor_active': 'Number of consumer DB calls being executed',
+    'db_executor_wait_seconds': 'Time consumer DB calls wait for a free DB thread',
+}
+PREFIX = 'bitmex_orders_'
+
+Labels = typ.Tuple[typ.Tuple[str, str], ...]
+
+
+class Histogram:
+    """Latency histogram with log-linear (HDR-style) buckets
+
+    Values are recorded in microseconds into buckets whose width grows
+    with the value, so the relative error is the same for any latency.
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        index = _bucket_index_(int(seconds * 1_000_000))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self) -> typ.Tuple[typ.Dict[int, int], int, float]:
+        """Get consistent copies of the bucket counts, the count and the sum of the recorded values"""
+        with self._lock:
+            return dict(self.counts), self.count, self.sum
+
+    def percentile(self, percent: float) -> float:
+        """Get recorded value (in seconds) at the needed percentile
+
+        :param percent: percentile e.g. 99
+        :return: upper bound of the bucket with the percentile value
+        """
+        counts, count, _ = self.snapshot()
+        if not count:
+            return 0.0
+        rank = count * percent / 100
+        seen = 0
+        for index in sorted(counts):
+            seen += counts[index]
+            if seen >= rank:
+                return _bucket_upper_bound_(index) / 1_000_000
+        return _bucket_upper_bound_(max(counts)) / 1_000_000
+
+    def cumulative_counts(self, bounds: typ.Iterable[float]) -> typ.List[int]:
+        """Count recorded values not greater than every bound (in seconds)"""
+        return _cumulative_counts_(self.snapshot()[0], bounds)
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Timer:
+    """Context manager recording the elapsed time into a histogram"""
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+class GaugeFunction:
+    """Gauge which value is got from a function on every render (e.g. an aggregate of the connections)"""
+
+    def __init__(self, func: typ.Callable[[], float]):
+        self.func = func
+
+    @property
+    def value(self) -> float:
+        return self.func()
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+histograms: typ.Dict[typ.Tuple[str, Labels], Histogram] = {}
+counters: typ.Dict[typ.Tuple[str, Labels], Counter] = {}
+gauges: typ.Dict[typ.Tuple[str, Labels], typ.Union[Gauge, GaugeFunction]] = {}
+_registry_lock = threading.Lock()
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """Record a latency value into the histogram with the needed labels"""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    if (histogram := histograms.get(key)) is None:
+        with _registry_lock:
+            histogram = histograms.setdefault(key, Histogram())
+    histogram.record(seconds)
+
+
+def inc(name: str, amount: int = 1, **labels) -> None:
+    """Increase the counter with the needed labels"""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    if (counter := counters.get(key)) is None:
+        with _registry_lock:
+            counter = counters.setdefault(key, Counter())
+    counter.inc(amount)
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    """Set the current value of the gauge with the needed labels"""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    if (gauge := gauges.get(key)) is None:
+        with _registry_lock:
+            gauge = gauges.setdefault(key, Gauge())
+    gauge.set(value)
+
+
+def set_gauge_function(name: str, func: typ.Callable[[], float], **labels) -> None:
+    """Register the function getting the gauge value on every render"""
+    if not ENABLED:
+        return
+    with _registry_lock:
+        gauges[(name, tuple(sorted(labels.items())))] = GaugeFunction(func)
+
+
+def timer(name: str, **labels) -> typ.Union[Timer, _NullTimer]:
+    """Measure the time spent inside the `with` block"""
+    return Timer(name, labels) if ENABLED else NULL_TIMER
+
+
+def reset() -> None:
+    with _registry_lock:
+        histograms.clear()
+        counters.clear()
+        gauges.clear()
+
+
+def render() -> str:
+    """Render all the metrics in the Prometheus text exposition format"""
+    # request threads register new label sets meanwhile
+    with _registry_lock:
+        counter_items, gauge_items = sorted(counters.items()), sorted(gauges.items())
+        histogram_items = sorted(histograms.items())
+
+    lines = []
+    for name in sorted({name for (name, _), _ in counter_items}):
+        lines += [f'# HELP {PREFIX}{name} {HELP.get(name, name)}', f'# TYPE {PREFIX}{name} counter']
+        for (metric_name, labels), counter in counter_items:
+            if metric_name == name:
+                lines.append(f'{PREFIX}{name}{_format_labels_(labels)} {counter.value}')
+
+    for name in sorted({name for (name, _), _ in gauge_items}):
+        lines += [f'# HELP {PREFIX}{name} {HELP.get(name, name)}', f'# TYPE {PREFIX}{name} gauge']
+        for (metric_name, labels), gauge in gauge_items:
+            if metric_name == name:
+                lines.append(f'{PREFIX}{name}{_format_labels_(labels)} {gauge.value}')
+
+    for name in sorted({name for (name, _), _ in histogram_items}):
+        lines += [f'# HELP {PREFIX}{name} {HELP.get(name, name)}', f'# TYPE {PREFIX}{name} histogram']
+        for (metric_name, labels), histogram in histogram_items:
+            if metric_name != name:
+                continue
+            counts, total, seconds = histogram.snapshot()
+            for bound, count in zip(EXPORT_BUCKETS, _cumulative_counts_(counts, EXPORT_BUCKETS)):
+                lines.append(f'{PREFIX}{name}_bucket{_format_labels_(labels, le=bound)} {count}')
+            lines.append(f'{PREFIX}{name}_bucket{_format_labels_(labels, le="+Inf")} {total}')
+            lines.append(f'{PREFIX}{name}_sum{_format_labels_(labels)} {seconds}')
+            lines.append(f'{PREFIX}{name}_count{_format_labels_(labels)} {total}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Expose collected metrics for Prometheus"""
+    if not ENABLED:
+        raise Http404('Metrics are disabled')
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MetricsMiddleware:
+    """Measure REST API requests latency and the time spent in the DB"""
+
+    def __init__(self, get_response):
+        if not ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with connection.execute_wrapper(_time_db_query_):
+            response = self.get_response(request)
+        if (resolver_match := request.resolver_match) and resolver_match.url_name != 'metrics':
+            labels = {
+                'view': resolver_match.url_name or resolver_match.view_name,
+                'method': request.method,
+                'status': str(response.status_code),
+            }
+            observe('http_request_duration_seconds', time.perf_counter() - started, **labels)
+            inc('http_requests_total', **labels)
+        return response
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSON renderer measuring the response serialization time"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timer('stage_duration_seconds', stage='render'):
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+def _time_db_query_(execute, sql, params, many, context):
+    with timer('stage_duration_seconds', stage='db'):
+        return execute(sql, params, many, context)
+
+
+def _bucket_index_(value: int) -> int:
+    if (bits := value.bit_length()) <= SUB_BUCKET_BITS + 1:
+        return value
+    shift = bits - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def _bucket_upper_bound_(index: int) -> int:
+    if index < 1 << (SUB_BUCKET_BITS + 1):
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    return ((index - (shift << SUB_BUCKET_BITS) + 1) << shift) - 1
+
+
+def _cumulative_counts_(counts: typ.Dict[int, int], bounds: typ.Iterable[float]) -> typ.List[int]:
+    buckets = sorted(
+        (_bucket_upper_bound_(index) / 1_000_000, count)
+        for index, count in counts.items()
+    )
+    result, seen, position = [], 0, 0
+    for bound in bounds:
+        while position < len(buckets) and buckets[position][0] <= bound:
+            seen += buckets[position][1]
+            position += 1
+        result.append(seen)
+    return result
+
+
+def _format_labels_(labels: Labels, **extra) -> str:
+    labels = [*labels, *extra.items()]
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.6 on 2026-10-19 00:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_auto_20200531_1508'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='orders_reconciled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.0.6 on 2026-10-19 00:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_account_orders_reconciled_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='avg_price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='filled_volume',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('New', 'Order is placed'), ('PartiallyFilled', 'Order is partially filled'), ('Filled', 'Order is filled'), ('Canceled', 'Order is canceled'), ('Rejected', 'Order is rejected')], default='New', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='transact_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(status__in=('New', 'PartiallyFilled')), fields=['account'], name='order_open_account_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.6 on 2026-10-19 00:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0005_order_lifecycle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Position',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=8)),
+                ('buy_volume', models.BigIntegerField(default=0)),
+                ('buy_notional', models.FloatField(default=0)),
+                ('sell_volume', models.BigIntegerField(default=0)),
+                ('sell_notional', models.FloatField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='orders.Account')),
+            ],
+            options={
+                'unique_together': {('account', 'symbol')},
+            },
+        ),
+    ]
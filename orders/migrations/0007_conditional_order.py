@@ -0,0 +1,36 @@
+# Generated by Django 3.0.6 on 2026-10-19 00:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConditionalOrder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=8)),
+                ('volume', models.PositiveIntegerField()),
+                ('side', models.CharField(choices=[('Buy', 'Buy this order'), ('Sell', 'Sell this order')], max_length=9)),
+                ('kind', models.CharField(choices=[('Stop', 'Fire when the price moves against the order side'), ('TakeProfit', 'Fire when the price moves in favour of the order side')], max_length=16)),
+                ('trigger_price', models.FloatField()),
+                ('status', models.CharField(choices=[('Pending', 'Waiting for the trigger price'), ('Triggered', 'Market order is placed'), ('Failed', 'Market order is rejected'), ('Canceled', 'Canceled before the trigger price')], default='Pending', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('triggered_at', models.DateTimeField(blank=True, null=True)),
+                ('triggered_price', models.FloatField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='orders.Account')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='orders.Order')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='conditionalorder',
+            index=models.Index(condition=models.Q(status='Pending'), fields=['account'], name='conditional_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 3.0.6 on 2026-10-19 01:13
+
+import datetime
+
+from django.db import migrations, models
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+import django.db.models.deletion
+
+# (PostgreSQL 11+) orders are partitioned by their timestamp months, see orders/archive.py
+# (the default partition, the partitioned primary key and foreign key need PostgreSQL 11)
+MIN_PG_VERSION = 110000
+# the tables are copied with the CHECK constraints (e.g. of the positive volumes) and the defaults
+PARTITIONED_TABLE_SQL = [
+    'ALTER TABLE orders_order RENAME TO orders_order_unpartitioned',
+    'CREATE TABLE orders_order (LIKE orders_order_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+    'PARTITION BY RANGE ("timestamp")',
+    'ALTER TABLE orders_order ADD PRIMARY KEY (id, "timestamp")',
+]
+# executed after the monthly partitions are created
+PARTITION_SQL = [
+    'CREATE TABLE orders_order_default PARTITION OF orders_order DEFAULT',
+    'INSERT INTO orders_order SELECT * FROM orders_order_unpartitioned',
+    'ALTER SEQUENCE orders_order_id_seq OWNED BY orders_order.id',
+    'DROP TABLE orders_order_unpartitioned',
+]
+UNPARTITION_SQL = [
+    'CREATE TABLE orders_order_unpartitioned (LIKE orders_order INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+    'ALTER TABLE orders_order_unpartitioned ADD PRIMARY KEY (id)',
+    'INSERT INTO orders_order_unpartitioned SELECT * FROM orders_order',
+    'ALTER SEQUENCE orders_order_id_seq OWNED BY orders_order_unpartitioned.id',
+    'DROP TABLE orders_order',
+    'ALTER TABLE orders_order_unpartitioned RENAME TO orders_order',
+]
+INDEXES_SQL = [
+    'CREATE INDEX orders_order_account_id_idx ON orders_order (account_id)',
+    'CREATE INDEX order_open_account_idx ON orders_order (account_id) WHERE status IN (\'New\', \'PartiallyFilled\')',
+    'ALTER TABLE orders_order ADD CONSTRAINT orders_order_account_id_fk '
+    'FOREIGN KEY (account_id) REFERENCES orders_account (id) DEFERRABLE INITIALLY DEFERRED',
+]
+
+
+def partition_orders(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    if schema_editor.connection.pg_version < MIN_PG_VERSION:
+        raise ImproperlyConfigured(
+            f'Partitioning of the orders needs PostgreSQL 11 or newer, '
+            f'the server version is {schema_editor.connection.pg_version}'
+        )
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT min("timestamp") FROM orders_order')
+        first = cursor.fetchone()[0] or timezone.now()
+
+    # the months of the existing orders up to the next month
+    month, partitions = _month_(first), []
+    last = _next_month_(_month_(timezone.now()))
+    while month <= last:
+        end = _next_month_(month)
+        partitions.append(
+            f'CREATE TABLE orders_order_p{month:%Y%m} PARTITION OF orders_order '
+            f'FOR VALUES FROM (\'{month.isoformat()}\') TO (\'{end.isoformat()}\')'
+        )
+        month = end
+
+    for sql in PARTITIONED_TABLE_SQL + partitions + PARTITION_SQL + INDEXES_SQL:
+        schema_editor.execute(sql)
+
+
+def unpartition_orders(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for sql in UNPARTITION_SQL + INDEXES_SQL:
+        schema_editor.execute(sql)
+
+
+def _month_(value: datetime.datetime) -> datetime.datetime:
+    return value.astimezone(datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month_(month: datetime.datetime) -> datetime.datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_conditional_order'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conditionalorder',
+            name='order',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='orders.Order'),
+        ),
+        migrations.RunPython(partition_orders, unpartition_orders),
+    ]
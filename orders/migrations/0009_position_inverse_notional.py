@@ -0,0 +1,23 @@
+# Generated by Django 3.0.6 on 2026-10-19 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0008_order_partitions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='position',
+            name='buy_inverse_notional',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='sell_inverse_notional',
+            field=models.FloatField(default=0),
+        ),
+    ]
@@ -1,4 +1,7 @@
+import typing as typ
+
 from django.db import models
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext_lazy
 
 
@@ -7,6 +10,8 @@ class Account(models.Model):
     name = models.CharField(unique=True, max_length=128, null=False, blank=False)
     api_key = models.CharField(max_length=256, null=False, blank=False)
     api_secret = models.CharField(max_length=256, null=False, blank=False)
+    # the latest Bitmex order update time seen by the orders reconciler
+    orders_reconciled_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -18,16 +23,159 @@ class Side(models.TextChoices):
     SELL = 'Sell', gettext_lazy('Sell this order')
 
 
+class OrderStatus(models.TextChoices):
+    NEW = 'New', gettext_lazy('Order is placed')
+    PARTIALLY_FILLED = 'PartiallyFilled', gettext_lazy('Order is partially filled')
+    FILLED = 'Filled', gettext_lazy('Order is filled')
+    CANCELED = 'Canceled', gettext_lazy('Order is canceled')
+    REJECTED = 'Rejected', gettext_lazy('Order is rejected')
+
+
+# orders in these states are still resting on the exchange order book
+OPEN_STATUSES = (OrderStatus.NEW, OrderStatus.PARTIALLY_FILLED)
+
+# Bitmex order statuses without an own `OrderStatus` mapped to the closest one,
+# any other unknown status is taken for a resting order (see `get_lifecycle_fields`)
+STATUS_ALIASES = {
+    'PendingNew': OrderStatus.NEW,
+    'PendingReplace': OrderStatus.NEW,
+    'PendingCancel': OrderStatus.NEW,
+    'Untriggered': OrderStatus.NEW,
+    'Triggered': OrderStatus.NEW,
+    'Suspended': OrderStatus.NEW,
+    'Expired': OrderStatus.CANCELED,
+    'Stopped': OrderStatus.CANCELED,
+    'DoneForDay': OrderStatus.CANCELED,
+}
+
+# order lifecycle fields mapped to the Bitmex order fields
+LIFECYCLE_FIELDS = {
+    'status': 'ordStatus',
+    'filled_volume': 'cumQty',
+    'avg_price': 'avgPx',
+    'transact_time': 'transactTime',
+}
+
+
 class Order(models.Model):
     """Contains detailed information about orders"""
     order_id = models.CharField(max_length=128, null=False, blank=False)
     symbol = models.CharField(max_length=8, null=False, blank=False)
     volume = models.PositiveIntegerField(null=False, blank=False)
-    timestamp = models.DateTimeField(auto_now_add=False, auto_now=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
     side = models.CharField(max_length=9, blank=False, choices=Side.choices)
     price = models.FloatField(null=True, blank=False)
     account = models.ForeignKey(Account, on_delete=models.CASCADE, null=False)
+    status = models.CharField(max_length=16, default=OrderStatus.NEW, choices=OrderStatus.choices)
+    filled_volume = models.PositiveIntegerField(default=0)
+    avg_price = models.FloatField(null=True, blank=True)
+    transact_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['account'],
+                name='order_open_account_idx',
+                condition=models.Q(status__in=OPEN_STATUSES),
+            ),
+        ]
 
     def __str__(self):
         return f'{self.order_id} {self.account.name} {self.side} ' \
                f'{self.volume} {self.price} {self.symbol}'
+
+
+class Position(models.Model):
+    """Contains filled volume and notional per account symbol and side,
+        incrementally updated on the order fills
+
+    The inverse notional (volume / price) is the cost of the inverse contracts (e.g. XBTUSD) in the settlement currency.
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, null=False)
+    symbol = models.CharField(max_length=8, null=False, blank=False)
+    buy_volume = models.BigIntegerField(default=0)
+    buy_notional = models.FloatField(default=0)
+    buy_inverse_notional = models.FloatField(default=0)
+    sell_volume = models.BigIntegerField(default=0)
+    sell_notional = models.FloatField(default=0)
+    sell_inverse_notional = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('account', 'symbol')
+
+    def __str__(self):
+        return f'{self.account.name} {self.symbol} {self.buy_volume - self.sell_volume}'
+
+
+class ConditionalOrderKind(models.TextChoices):
+    STOP = 'Stop', gettext_lazy('Fire when the price moves against the order side')
+    TAKE_PROFIT = 'TakeProfit', gettext_lazy('Fire when the price moves in favour of the order side')
+
+
+class ConditionalOrderStatus(models.TextChoices):
+    PENDING = 'Pending', gettext_lazy('Waiting for the trigger price')
+    TRIGGERED = 'Triggered', gettext_lazy('Market order is placed')
+    FAILED = 'Failed', gettext_lazy('Market order is rejected')
+    CANCELED = 'Canceled', gettext_lazy('Canceled before the trigger price')
+
+
+class ConditionalOrder(models.Model):
+    """Contains market orders placed by the server when the last price reaches the trigger price"""
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, null=False)
+    symbol = models.CharField(max_length=8, null=False, blank=False)
+    volume = models.PositiveIntegerField(null=False, blank=False)
+    side = models.CharField(max_length=9, blank=False, choices=Side.choices)
+    kind = models.CharField(max_length=16, blank=False, choices=ConditionalOrderKind.choices)
+    trigger_price = models.FloatField(null=False, blank=False)
+    status = models.CharField(
+        max_length=16,
+        default=ConditionalOrderStatus.PENDING,
+        choices=ConditionalOrderStatus.choices,
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    triggered_at = models.DateTimeField(null=True, blank=True)
+    # the last price which fired the order
+    triggered_price = models.FloatField(null=True, blank=True)
+    # no DB constraint: orders are partitioned by time on PostgreSQL and their primary key is (id, timestamp)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['account'],
+                name='conditional_pending_idx',
+                condition=models.Q(status=ConditionalOrderStatus.PENDING),
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.account.name} {self.kind} {self.side} ' \
+               f'{self.volume} {self.symbol} at {self.trigger_price}'
+
+    @property
+    def fires_above(self) -> bool:
+        """Buy stops and sell take-profits fire when the price goes up to the trigger price"""
+        return (self.side == Side.BUY) == (self.kind == ConditionalOrderKind.STOP)
+
+
+def get_lifecycle_fields(order_info: dict) -> typ.Dict[str, typ.Any]:
+    """Get order lifecycle fields from the Bitmex order info
+
+    :param order_info: order info returned by Bitmex
+    :return: order model lifecycle fields which are present in the order info
+    """
+    fields = {
+        field: value
+        for field, bitmex_field in LIFECYCLE_FIELDS.items()
+        if (value := order_info.get(bitmex_field)) is not None
+    }
+    if isinstance(transact_time := fields.get('transact_time'), str):
+        fields['transact_time'] = parse_datetime(transact_time)
+    if (order_status := fields.get('status')) is not None and order_status not in OrderStatus.values:
+        # an order accepted by the exchange is always stored, whatever status it is reported with
+        order_status = STATUS_ALIASES.get(order_status, OrderStatus.NEW)
+        if order_status == OrderStatus.NEW and fields.get('filled_volume'):
+            order_status = OrderStatus.PARTIALLY_FILLED
+        fields['status'] = order_status
+    return fields
@@ -0,0 +1,164 @@
+import bisect
+import typing as typ
+
+# Bitmex table of the L2 order book
+TABLE = 'orderBookL2'
+
+# Bitmex sides by the book sides
+SIDES = {'bids': 'Buy', 'asks': 'Sell'}
+
+Levels = typ.List[typ.List[float]]
+
+
+class OrderBook:
+    """L2 order book of one instrument kept from the Bitmex `orderBookL2` messages
+
+    Price levels of every side are kept in sorted arrays (the best level
+    first) and found with a bisect. Bitmex updates and deletes levels by their
+    ids only, so the ids are mapped to the level sides and prices.
+
+    :param symbol: instrument symbol
+    """
+
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        # sort keys (-price for bids, price for asks) and sizes of the levels by Bitmex sides
+        self.keys: typ.Dict[str, typ.List[float]] = {'Buy': [], 'Sell': []}
+        self.sizes: typ.Dict[str, typ.List[float]] = {'Buy': [], 'Sell': []}
+        # (side, price) by Bitmex level ids
+        self.levels: typ.Dict[int, typ.Tuple[str, float]] = {}
+        # updates are applied only after the partial (snapshot) of the book
+        self.ready = False
+
+    def __len__(self):
+        return len(self.levels)
+
+    def apply(self, action: str, rows: typ.Iterable[dict]) -> typ.Optional[typ.Dict[str, Levels]]:
+        """Apply an `orderBookL2` message rows of this instrument
+
+        :param action: Bitmex action: 'partial', 'insert', 'update' or 'delete'
+        :param rows: Bitmex levels
+        :return: changed levels as [price, size] (size 0 for the deleted ones)
+            by the book sides, None if the book has no partial yet
+        """
+        if action == 'partial':
+            self.clear()
+            self.ready = True
+        elif not self.ready:
+            return None
+
+        changes = {'Buy': [], 'Sell': []}
+        for row in rows:
+            level_id, side = row.get('id'), row.get('side')
+            if side not in changes:
+                continue
+            if action in ('partial', 'insert'):
+                if row.get('price') is None:
+                    continue
+                if level_id in self.levels:
+                    self._remove(level_id)
+                self._set(level_id, side, row['price'], row.get('size') or 0)
+                changes[side].append([row['price'], row.get('size') or 0])
+            elif (level := self.levels.get(level_id)) is None:
+                continue
+            elif action == 'update':
+                old_side, price = level
+                if old_side != side:
+                    # the level moved to the other side of the book
+                    self._remove(level_id)
+                    changes[old_side].append([price, 0])
+                self._set(level_id, side, price, row.get('size', 0))
+                changes[side].append([price, row.get('size', 0)])
+            elif action == 'delete':
+                _, price = self._remove(level_id)
+                changes[level[0]].append([price, 0])
+        return {book_side: changes[side] for book_side, side in SIDES.items()}
+
+    def top(self, depth: int) -> typ.Dict[str, Levels]:
+        """Get the best `depth` levels of every side as [price, size]"""
+        return {
+            book_side: [
+                [abs(key), size]
+                for key, size in zip(self.keys[side][:depth], self.sizes[side][:depth])
+            ]
+            for book_side, side in SIDES.items()
+        }
+
+    def clear(self) -> None:
+        for side in SIDES.values():
+            self.keys[side].clear()
+            self.sizes[side].clear()
+        self.levels.clear()
+        self.ready = False
+
+    def _set(self, level_id: int, side: str, price: float, size: float) -> None:
+        keys, key = self.keys[side], _key_(side, price)
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            self.sizes[side][index] = size
+        else:
+            keys.insert(index, key)
+            self.sizes[side].insert(index, size)
+        self.levels[level_id] = (side, price)
+
+    def _remove(self, level_id: int) -> typ.Tuple[str, float]:
+        side, price = self.levels.pop(level_id)
+        keys, key = self.keys[side], _key_(side, price)
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index], self.sizes[side][index]
+        return side, price
+
+
+def _key_(side: str, price: float) -> float:
+    return -price if side == 'Buy' else price
+
+
+# order books maintained by the feeds relayed in this process by account names and symbols
+books: typ.Dict[typ.Tuple[str, str], OrderBook] = {}
+
+
+def group(account: str, symbol: str) -> str:
+    """Get channel layer group of the depth updates of the account instrument"""
+    return f'{account}.depth.{symbol}'
+
+
+def apply_message(account: str, message: dict) -> typ.List[dict]:
+    """Apply an `orderBookL2` message to the books of the account feed
+
+    :param account: account name
+    :param message: Bitmex message of the `orderBookL2` table
+    :return: depth updates (one per changed instrument) to relay
+    """
+    action = message.get('action')
+    rows_by_symbol: typ.Dict[str, typ.List[dict]] = {}
+    if action == 'partial' and (symbol := (message.get('filter') or {}).get('symbol')):
+        # a partial of an empty book still resets it
+        rows_by_symbol[symbol] = []
+    for row in message.get('data') or ():
+        rows_by_symbol.setdefault(row.get('symbol'), []).append(row)
+
+    updates = []
+    for symbol, rows in rows_by_symbol.items():
+        if symbol is None:
+            continue
+        book = books.get((account, symbol))
+        if book is None:
+            book = books[(account, symbol)] = OrderBook(symbol)
+        if (changes := book.apply(action, rows)) is None:
+            continue
+        updates.append({'account': account, 'symbol': symbol, 'depth': action, **changes})
+    return updates
+
+
+def get_book(account: str, symbol: str) -> typ.Optional[OrderBook]:
+    """Get the ready book of the account instrument (None if it is not maintained by this process)"""
+    book = books.get((account, symbol))
+    return book if book is not None and book.ready else None
+
+
+def reset(account: str) -> None:
+    """Invalidate the books of the account feed until the next partials (e.g. on a reconnect)"""
+    for (book_account, _), book in books.items():
+        if book_account == account:
+            book.clear()
@@ -0,0 +1,139 @@
+import time
+import weakref
+import asyncio
+import itertools
+import typing as typ
+from collections import OrderedDict
+
+
+class Policy:
+    """What to do with a new message when the outbound queue is full"""
+    # keep only the latest message per key (e.g. per symbol), drop the oldest if still full
+    CONFLATE = 'conflate'
+    # drop the oldest message
+    DROP_OLDEST = 'drop_oldest'
+    # close the slow client connection
+    DISCONNECT = 'disconnect'
+
+    ALL = (CONFLATE, DROP_OLDEST, DISCONNECT)
+
+
+class QueueOverflow(Exception):
+    """Outbound queue is full and the client has to be disconnected"""
+
+
+class QueuedMessage(typ.NamedTuple):
+    message: typ.Any
+    enqueued_at: float
+    received_at: typ.Optional[float]
+
+
+class OutboundQueue:
+    """Bounded queue of messages waiting to be sent to one websocket client
+
+    :param maxsize: maximum number of queued messages
+    :param policy: one of the `Policy` values
+    """
+
+    def __init__(self, maxsize: int, policy: str = Policy.CONFLATE):
+        if policy not in Policy.ALL:
+            raise ValueError(f'Unknown outbound queue policy: {policy!r}. Available are: {Policy.ALL}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.conflated = 0
+        self.sent = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._messages: typ.Dict[typ.Hashable, QueuedMessage] = OrderedDict()
+        # created by the first waiter, so the queue is bound to the loop it is used in
+        self._not_empty: typ.Optional[asyncio.Event] = None
+        self._keys = itertools.count()
+        queues.add(self)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, message, key: typ.Hashable = None, received_at: float = None) -> None:
+        """Queue a message without waiting
+
+        :param message: message to send
+        :param key: conflation key, the message replaces a queued one with the same key
+        :param received_at: time the message was received from the upstream
+        :raise QueueOverflow: if the queue is full and the policy is to disconnect
+        """
+        queued = QueuedMessage(message, time.monotonic(), received_at)
+        if self.policy == Policy.CONFLATE and key is not None and key in self._messages:
+            # keep the queue position, so the symbol is not starved by the others
+            self._messages[key] = queued._replace(enqueued_at=self._messages[key].enqueued_at)
+            self.conflated += 1
+            return
+
+        if len(self._messages) >= self.maxsize:
+            if self.policy == Policy.DISCONNECT:
+                raise QueueOverflow(f'Outbound queue is full ({self.maxsize} messages)')
+            self._messages.popitem(last=False)
+            self.dropped += 1
+
+        if key is None or self.policy != Policy.CONFLATE:
+            key = next(self._keys)
+        self._messages[key] = queued
+        if self._not_empty:
+            self._not_empty.set()
+
+    async def get(self) -> QueuedMessage:
+        """Wait for the oldest queued message"""
+        while not self._messages:
+            if self._not_empty is None:
+                self._not_empty = asyncio.Event()
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        _, queued = self._messages.popitem(last=False)
+        return queued
+
+    def mark_sent(self, queued: QueuedMessage) -> float:
+        """Update lag stats after the message is sent
+
+        :param queued: sent message
+        :return: time the message spent in the queue
+        """
+        self.sent += 1
+        self.last_lag = time.monotonic() - queued.enqueued_at
+        self.max_lag = max(self.max_lag, self.last_lag)
+        return self.last_lag
+
+    def lag(self) -> float:
+        """Get the time the oldest queued message is waiting (0 if the queue is empty)"""
+        for queued in self._messages.values():
+            return time.monotonic() - queued.enqueued_at
+        return 0.0
+
+    def stats(self) -> dict:
+        return {
+            'policy': self.policy,
+            'depth': len(self._messages),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'conflated': self.conflated,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+        }
+
+
+# outbound queues of the connected clients in this process
+queues: 'weakref.WeakSet[OutboundQueue]' = weakref.WeakSet()
+
+
+def get_queued() -> int:
+    """Get the number of messages queued for all the clients"""
+    return sum(len(queue) for queue in list(queues))
+
+
+def get_lag() -> float:
+    """Get the time the oldest queued message of the slowest client is waiting"""
+    return max((queue.lag() for queue in list(queues)), default=0.0)
+
+
+def get_max_lag() -> float:
+    """Get the longest time a sent message waited in the queue of a connected client"""
+    return max((queue.max_lag for queue in list(queues)), default=0.0)
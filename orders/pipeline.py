@@ -0,0 +1,180 @@
+import json
+import hashlib
+import functools
+import typing as typ
+
+from orders.ticks import Tick
+
+# fields of every relayed message
+MESSAGE_FIELDS = ('timestamp', 'account', 'symbol')
+
+# the original relayed message: the last price of every instrument
+DEFAULT_SPEC = {'fields': {'price': 'lastPrice'}}
+
+# values derived from two instrument fields: name -> (Bitmex fields, function of their values)
+DERIVED = {
+    'mid': (('bidPrice', 'askPrice'), lambda bid, ask: (bid + ask) / 2),
+    'spread': (('bidPrice', 'askPrice'), lambda bid, ask: ask - bid),
+    'basis': (('markPrice', 'indicativeSettlePrice'), lambda mark, settle: mark - settle),
+    'turnover_ratio': (('turnover24h', 'volume24h'), lambda turnover, volume: turnover / volume if volume else None),
+}
+
+SPEC_KEYS = ('fields', 'symbols', 'derived')
+
+# relayed message: a tick of the single field pipelines or a dict
+Message = typ.Union[Tick, dict]
+
+Extractor = typ.Callable[[dict, str], typ.Optional[Message]]
+
+
+class PipelineError(Exception):
+    """Invalid transform pipeline spec"""
+
+
+class Pipeline:
+    """Compiled transform of upstream instrument rows into relayed messages
+
+    :param key: canonical spec (see `get_spec_key`)
+    :param extract: function making a message of an instrument row (None to skip the row)
+    """
+
+    def __init__(self, key: str, extract: Extractor):
+        self.key = key
+        self.id = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        self.extract = extract
+
+    def group(self, account: str) -> str:
+        """Get channel layer group of the account messages made by this pipeline"""
+        return account if self.key == DEFAULT_KEY else f'{account}.{self.id}'
+
+    def apply(self, rows: typ.Iterable[dict], account: str) -> typ.List[Message]:
+        extract = self.extract
+        return [message for row in rows if (message := extract(row, account)) is not None]
+
+
+def get_spec_key(spec: typ.Optional[dict]) -> str:
+    """Validate the pipeline spec and get its canonical form
+
+    Spec example (all the keys are optional):
+
+        {"fields": {"price": "lastPrice", "mark": "markPrice"},  # or a list of Bitmex fields
+         "symbols": ["XBTUSD"],
+         "derived": ["mid", "spread"]}
+
+    :param spec: pipeline spec, None for the default one
+    :return: canonical spec (the same for the equal specs)
+    :raise PipelineError: if the spec is not valid
+    """
+    if spec is None:
+        return DEFAULT_KEY
+    if not isinstance(spec, dict) or set(spec) - set(SPEC_KEYS):
+        raise PipelineError(f'Expected a pipeline spec with any of the keys: {list(SPEC_KEYS)}')
+
+    fields = spec.get('fields', {} if spec.get('derived') else DEFAULT_SPEC['fields'])
+    if isinstance(fields, list):
+        fields = {field: field for field in fields}
+    if not isinstance(fields, dict) or not all(
+            isinstance(name, str) and isinstance(source, str) for name, source in fields.items()
+    ):
+        raise PipelineError('Expected pipeline fields as a list of Bitmex fields or a mapping of names to them')
+
+    derived = spec.get('derived', [])
+    if not isinstance(derived, list) or any(name not in DERIVED for name in derived):
+        raise PipelineError(f'Got unknown derived values: {derived!r}. Available are: {list(DERIVED)}')
+
+    symbols = spec.get('symbols')
+    if symbols is not None and (not isinstance(symbols, list) or not all(isinstance(s, str) for s in symbols)):
+        raise PipelineError('Expected pipeline symbols as a list of instrument symbols')
+
+    if clashes := (set(fields) | set(derived)) & set(MESSAGE_FIELDS):
+        raise PipelineError(f'Pipeline fields can not be named as the message fields: {sorted(clashes)}')
+    if not fields and not derived:
+        raise PipelineError('Expected at least one pipeline field or derived value')
+
+    return json.dumps(
+        {'fields': fields, 'symbols': sorted(set(symbols)) if symbols else None, 'derived': sorted(set(derived))},
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def get_pipeline(key: str) -> Pipeline:
+    """Get compiled pipeline of the canonical spec (compiled once per spec)
+
+    The spec is turned into a specialized extractor closure,
+    so a row costs only the lookups of the fields the subscribers need.
+    """
+    spec = json.loads(key)
+    symbols = frozenset(spec['symbols'] or ())
+    if len(spec['fields']) == 1 and not spec['derived']:
+        # the most common case (e.g. the default pipeline)
+        [(name, source)] = spec['fields'].items()
+        return Pipeline(key, _get_tick_extractor_(name, source, symbols))
+    fields = tuple(spec['fields'].items())
+    derived = tuple((name, *DERIVED[name][0], DERIVED[name][1]) for name in spec['derived'])
+    return Pipeline(key, _get_extractor_(fields, derived, symbols))
+
+
+def apply_pipelines(pipelines: typ.Sequence[Pipeline], rows: typ.Iterable[dict],
+                    account: str) -> typ.Dict[str, typ.List[Message]]:
+    """Make messages of every pipeline in one pass over the upstream rows
+
+    :param pipelines: compiled pipelines of the account subscriptions
+    :param rows: upstream instrument rows
+    :param account: account name
+    :return: messages by channel layer groups
+    """
+    extractors = [(pipeline.group(account), pipeline.extract, []) for pipeline in pipelines]
+    for row in rows:
+        for _, extract, messages in extractors:
+            if (message := extract(row, account)) is not None:
+                messages.append(message)
+    return {group: messages for group, _, messages in extractors if messages}
+
+
+def _get_tick_extractor_(name: str, source: str, symbols: typ.FrozenSet[str]) -> Extractor:
+    """Make extractor of one field: it skips the row without the field right away
+    and makes a compact tick instead of a dict
+    """
+    if symbols:
+        def extract(row: dict, account: str) -> typ.Optional[Tick]:
+            get = row.get
+            if get('symbol') not in symbols or (value := get(source)) is None:
+                return None
+            return Tick(get('timestamp'), account, get('symbol'), name, value)
+    else:
+        def extract(row: dict, account: str) -> typ.Optional[Tick]:
+            get = row.get
+            if (value := get(source)) is None:
+                return None
+            return Tick(get('timestamp'), account, get('symbol'), name, value)
+    return extract
+
+
+def _get_extractor_(fields: typ.Tuple[typ.Tuple[str, str], ...],
+                    derived: typ.Tuple[typ.Tuple[str, str, str, typ.Callable], ...],
+                    symbols: typ.FrozenSet[str]) -> Extractor:
+    """Make extractor of several fields and derived values
+
+    :param fields: message field names and their Bitmex fields
+    :param derived: derived value names, their two Bitmex fields and functions of their values
+    :param symbols: symbols of the relayed rows (all of them if empty)
+    """
+    def extract(row: dict, account: str) -> typ.Optional[dict]:
+        get = row.get
+        if symbols and get('symbol') not in symbols:
+            return None
+        message = {'timestamp': get('timestamp'), 'account': account, 'symbol': get('symbol')}
+        for name, source in fields:
+            if (value := get(source)) is not None:
+                message[name] = value
+        for name, first, second, derive in derived:
+            if (x := get(first)) is not None and (y := get(second)) is not None \
+                    and (value := derive(x, y)) is not None:
+                message[name] = value
+        return message if len(message) > len(MESSAGE_FIELDS) else None
+    return extract
+
+
+DEFAULT_KEY = get_spec_key(DEFAULT_SPEC)
@@ -0,0 +1,169 @@
+import typing as typ
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum, FloatField, ExpressionWrapper
+
+from orders import prices
+from orders.models import Account, Order, Position, Side
+
+POSITION_FIELDS = (
+    'buy_volume', 'buy_notional', 'buy_inverse_notional', 'sell_volume', 'sell_notional', 'sell_inverse_notional',
+)
+
+
+def aggregate_positions(account: Account) -> typ.Dict[str, typ.Dict[str, float]]:
+    """Sum filled volume and notional per symbol and side of the account orders in the DB
+
+    :param account: account model
+    :return: position fields per symbol
+    """
+    rows = Order.objects.filter(
+        account=account,
+        filled_volume__gt=0,
+        avg_price__isnull=False,
+    ).values('symbol', 'side').annotate(
+        volume=Sum('filled_volume'),
+        notional=Sum(ExpressionWrapper(F('filled_volume') * F('avg_price'), output_field=FloatField())),
+        inverse_notional=Sum(ExpressionWrapper(F('filled_volume') * 1.0 / F('avg_price'), output_field=FloatField())),
+    ).order_by()
+
+    positions = {}
+    for row in rows:
+        position = positions.setdefault(row['symbol'], dict.fromkeys(POSITION_FIELDS, 0))
+        side = 'buy' if row['side'] == Side.BUY else 'sell'
+        position[f'{side}_volume'] += row['volume']
+        position[f'{side}_notional'] += row['notional']
+        position[f'{side}_inverse_notional'] += row['inverse_notional']
+    return positions
+
+
+def materialized_positions(account: Account) -> typ.Dict[str, typ.Dict[str, float]]:
+    """Get incrementally maintained position fields per symbol of the account"""
+    return {
+        row.pop('symbol'): row
+        for row in Position.objects.filter(account=account).values('symbol', *POSITION_FIELDS)
+    }
+
+
+def get_positions(account: Account, mark_prices: typ.Mapping[str, float] = None) -> typ.List[dict]:
+    """Get net volume, buy/sell VWAPs and mark-to-market P&L per symbol of the account
+
+    P&L is both realized and unrealized. It is linear: net volume * mark price - net notional,
+    except for the `INVERSE_SYMBOLS` (e.g. XBTUSD) which P&L is in the settlement currency:
+    net inverse notional - net volume / mark price, i.e. net volume * (1 / entry price - 1 / mark price).
+    The break-even price is the mark price at which this P&L is zero (net notional / net volume,
+    net volume / net inverse notional of the inverse contracts), it is not an average fill price
+    and can be negative after partial closes.
+
+    :param account: account model
+    :param mark_prices: mark prices by symbols, the prices relayed by this process by default
+    :return: positions sorted by symbol
+    """
+    if settings.POSITIONS_MATERIALIZED:
+        positions = materialized_positions(account)
+    else:
+        positions = aggregate_positions(account)
+
+    result = []
+    for symbol, position in sorted(positions.items()):
+        net_volume = position['buy_volume'] - position['sell_volume']
+        if symbol in settings.INVERSE_SYMBOLS:
+            # the inverse notional is subtracted, so the linear formulas below give the inverse P&L
+            net_notional = position['sell_inverse_notional'] - position['buy_inverse_notional']
+        else:
+            net_notional = position['buy_notional'] - position['sell_notional']
+        mark_price = prices.get_price(symbol) if mark_prices is None else mark_prices.get(symbol)
+        if not net_volume:
+            pnl = -net_notional
+        elif mark_price is not None:
+            pnl = _mark_to_market_(symbol, net_volume, mark_price) - net_notional
+        else:
+            pnl = None
+        result.append({
+            'symbol': symbol,
+            'net_volume': net_volume,
+            'buy_volume': position['buy_volume'],
+            'sell_volume': position['sell_volume'],
+            'buy_vwap': position['buy_notional'] / position['buy_volume'] if position['buy_volume'] else None,
+            'sell_vwap': position['sell_notional'] / position['sell_volume'] if position['sell_volume'] else None,
+            'break_even_price': _get_break_even_price_(symbol, net_volume, net_notional),
+            'mark_price': mark_price,
+            'pnl': pnl,
+        })
+    return result
+
+
+def record_fill_change(order: Order, old_filled_volume: int = 0, old_avg_price: float = None) -> None:
+    """Apply the order fill change to the materialized position
+
+    :param order: saved order with the new fill
+    :param old_filled_volume: order filled volume before the change
+    :param old_avg_price: order average fill price before the change
+    """
+    if not settings.POSITIONS_MATERIALIZED:
+        return
+    volume = order.filled_volume - old_filled_volume
+    notional = order.filled_volume * (order.avg_price or 0) - old_filled_volume * (old_avg_price or 0)
+    inverse_notional = (order.filled_volume / order.avg_price if order.avg_price else 0) \
+        - (old_filled_volume / old_avg_price if old_avg_price else 0)
+    if not volume and not notional:
+        return
+
+    side = 'buy' if order.side == Side.BUY else 'sell'
+    increments = {
+        f'{side}_volume': F(f'{side}_volume') + volume,
+        f'{side}_notional': F(f'{side}_notional') + notional,
+        f'{side}_inverse_notional': F(f'{side}_inverse_notional') + inverse_notional,
+    }
+    positions = Position.objects.filter(account_id=order.account_id, symbol=order.symbol)
+    if positions.update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            Position.objects.create(
+                account_id=order.account_id,
+                symbol=order.symbol,
+                **{
+                    f'{side}_volume': volume,
+                    f'{side}_notional': notional,
+                    f'{side}_inverse_notional': inverse_notional,
+                },
+            )
+    except IntegrityError:
+        # created by a concurrent fill
+        positions.update(**increments)
+
+
+def record_order_removal(order: Order) -> None:
+    """Reverse the fills of the order being deleted in the materialized position"""
+    if not order.filled_volume:
+        return
+    old_filled_volume, old_avg_price = order.filled_volume, order.avg_price
+    order.filled_volume, order.avg_price = 0, None
+    record_fill_change(order, old_filled_volume, old_avg_price)
+
+
+def rebuild_positions(account: Account) -> None:
+    """Recompute materialized positions of the account from its orders"""
+    with transaction.atomic():
+        Position.objects.filter(account=account).delete()
+        Position.objects.bulk_create(
+            Position(account=account, symbol=symbol, **fields)
+            for symbol, fields in aggregate_positions(account).items()
+        )
+
+
+def _mark_to_market_(symbol: str, net_volume: float, mark_price: float) -> float:
+    if symbol in settings.INVERSE_SYMBOLS:
+        # the value of the inverse contracts falls as the price rises
+        return -net_volume / mark_price
+    return net_volume * mark_price
+
+
+def _get_break_even_price_(symbol: str, net_volume: float, net_notional: float) -> typ.Optional[float]:
+    if not net_volume:
+        return None
+    if symbol in settings.INVERSE_SYMBOLS:
+        return -net_volume / net_notional if net_notional else None
+    return net_notional / net_volume
@@ -0,0 +1,15 @@
+import typing as typ
+
+# the latest relayed instrument prices (symbol -> (price, timestamp)) of this process
+last_prices: typ.Dict[str, typ.Tuple[float, typ.Optional[str]]] = {}
+
+
+def update(symbol: str, price: float, timestamp: typ.Optional[str] = None) -> None:
+    last_prices[symbol] = (price, timestamp)
+
+
+def get_price(symbol: str) -> typ.Optional[float]:
+    """Get the latest relayed price of the symbol (None if it was not relayed yet)"""
+    if (last_price := last_prices.get(symbol)) is None:
+        return None
+    return last_price[0]
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import datetime
+import typing as typ
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction, close_old_connections
+from django.utils.dateparse import parse_datetime
+
+from orders import exchange
+from orders.models import Account, Order, LIFECYCLE_FIELDS, get_lifecycle_fields
+from orders.positions import record_fill_change
+
+
+logger = logging.getLogger(__name__)
+
+# maximum page size allowed by Bitmex for the Order_getOrders call
+PAGE_SIZE = 500
+
+
+class ReconcileStats(typ.NamedTuple):
+    created: int = 0
+    updated: int = 0
+
+
+def iter_exchange_orders(client, start_time: typ.Optional[datetime.datetime],
+                         page_size: int = PAGE_SIZE) -> typ.Iterator[dict]:
+    """Page through all the account orders updated since the start time
+
+    :param client: bitmex client for the account
+    :param start_time: orders update time watermark (all the orders if None)
+    :param page_size: number of orders per one Bitmex request
+    :return: orders info from the oldest to the newest update
+    """
+    params = {'count': page_size, 'reverse': False}
+    if start_time:
+        params['startTime'] = start_time
+    start = 0
+    while True:
+        page, _ = client.Order.Order_getOrders(start=start, **params).result()
+        yield from page
+        if len(page) < page_size:
+            break
+        start += page_size
+
+
+def apply_exchange_orders(account: Account, exchange_orders: typ.Iterable[dict]) -> ReconcileStats:
+    """Diff exchange orders against the local ones and apply the changes in bulk
+
+    :param account: account the orders belong to
+    :param exchange_orders: orders info from Bitmex ordered by update time
+    :return: number of created and updated local orders
+    """
+    latest = {}
+    watermark = account.orders_reconciled_at
+    for order_info in exchange_orders:
+        latest[order_info['orderID']] = order_info
+        if (timestamp := _to_datetime_(order_info.get('timestamp'))) and \
+                (watermark is None or timestamp > watermark):
+            watermark = timestamp
+    if not latest:
+        return ReconcileStats()
+
+    local = {
+        order.order_id: order
+        for order in Order.objects.filter(account=account, order_id__in=list(latest))
+    }
+    synced_fields = ['volume', 'price', *LIFECYCLE_FIELDS]
+    to_create, to_update = [], []
+    old_fills = {}
+    for order_id, order_info in latest.items():
+        fields = {
+            'volume': order_info.get('orderQty') or 0,
+            'price': order_info.get('price'),
+            **get_lifecycle_fields(order_info),
+        }
+        if (order := local.get(order_id)) is None:
+            to_create.append(Order(
+                order_id=order_id,
+                symbol=order_info.get('symbol'),
+                side=order_info.get('side'),
+                account=account,
+                **fields,
+            ))
+        elif any(getattr(order, field) != value for field, value in fields.items()):
+            old_fills[order_id] = (order.filled_volume, order.avg_price)
+            for field, value in fields.items():
+                setattr(order, field, value)
+            to_update.append(order)
+
+    with transaction.atomic():
+        Order.objects.bulk_create(to_create)
+        Order.objects.bulk_update(to_update, fields=synced_fields)
+        for order in to_create:
+            record_fill_change(order)
+        for order in to_update:
+            record_fill_change(order, *old_fills[order.order_id])
+        account.orders_reconciled_at = watermark
+        account.save(update_fields=['orders_reconciled_at'])
+    return ReconcileStats(created=len(to_create), updated=len(to_update))
+
+
+def reconcile_account(account: Account, page_size: int = PAGE_SIZE) -> ReconcileStats:
+    """Sync local orders of an account with the exchange state
+
+    :param account: account to reconcile
+    :param page_size: number of orders per one Bitmex request
+    :return: number of created and updated local orders
+    """
+    # the pooled client, building one loads the whole swagger spec
+    exchange_orders = iter_exchange_orders(
+        client=exchange.get_client(account),
+        start_time=account.orders_reconciled_at,
+        page_size=page_size,
+    )
+    return apply_exchange_orders(account=account, exchange_orders=exchange_orders)
+
+
+def _reconcile_account_in_thread_(account: Account) -> typ.Optional[ReconcileStats]:
+    try:
+        return reconcile_account(account)
+    except exchange.HTTPError as err:
+        logger.warning('Failed to reconcile orders for the account %r: %s', account.name, err)
+    except Exception:
+        # e.g. a connection error or timeout, or a DB error, the other accounts are reconciled anyway
+        logger.exception('Failed to reconcile orders for the account %r', account.name)
+    finally:
+        # every pool thread keeps its own DB connection
+        close_old_connections()
+
+
+async def reconcile_accounts(accounts: typ.Iterable[Account], workers: int) \
+        -> typ.Dict[str, typ.Optional[ReconcileStats]]:
+    """Reconcile several accounts concurrently on a pool of worker threads
+
+    :param accounts: accounts to reconcile
+    :param workers: maximum number of accounts reconciled at the same time
+    :return: reconcile stats per account name (None if reconciliation failed)
+    """
+    accounts = list(accounts)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconciler') as pool:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, _reconcile_account_in_thread_, account)
+            for account in accounts
+        ))
+    return {account.name: stats for account, stats in zip(accounts, results)}
+
+
+async def run_reconciler(interval: float, workers: int, once: bool = False) -> None:
+    """Reconcile all the accounts every `interval` seconds
+
+    :param interval: delay between reconciliation rounds in seconds
+    :param workers: maximum number of accounts reconciled at the same time
+    :param once: stop after the first round
+    """
+    while True:
+        try:
+            accounts = await asyncio.get_running_loop().run_in_executor(None, _get_all_accounts_)
+            for account_name, stats in (await reconcile_accounts(accounts, workers=workers)).items():
+                if stats and any(stats):
+                    logger.info('Reconciled orders for the account %r: %s', account_name, stats)
+        except Exception:
+            # a failed round (e.g. the DB is unavailable) never stops the reconciler
+            logger.exception('Failed to reconcile orders')
+        if once:
+            break
+        await asyncio.sleep(interval)
+
+
+def _get_all_accounts_() -> typ.List[Account]:
+    try:
+        return list(Account.objects.all())
+    finally:
+        close_old_connections()
+
+
+def _to_datetime_(value: typ.Union[str, datetime.datetime, None]) -> typ.Optional[datetime.datetime]:
+    return parse_datetime(value) if isinstance(value, str) else value
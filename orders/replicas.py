@@ -0,0 +1,81 @@
+import random
+import contextlib
+import contextvars
+import typing as typ
+
+from django.conf import settings
+from django.core.cache import cache
+
+from orders import metrics
+
+# DB alias of the reads of the current read-only request, None for the primary
+_read_alias: contextvars.ContextVar[typ.Optional[str]] = contextvars.ContextVar('read_alias', default=None)
+
+
+class ReplicaRouter:
+    """Routes the reads of the read-only paths to the DB replicas
+
+    Reads go to a replica only inside `replica_reads`, so the write paths
+    (including their reads, e.g. `select_for_update`) always stay on the
+    primary. Migrations are applied to the primary only.
+    """
+
+    @staticmethod
+    def db_for_read(model, **hints) -> typ.Optional[str]:
+        return _read_alias.get()
+
+    @staticmethod
+    def db_for_write(model, **hints) -> str:
+        return 'default'
+
+    @staticmethod
+    def allow_relation(obj1, obj2, **hints) -> bool:
+        return True
+
+    @staticmethod
+    def allow_migrate(db, app_label, model_name=None, **hints) -> bool:
+        return db == 'default'
+
+
+def get_read_alias(account_name: str) -> str:
+    """Get DB alias for the read-only queries of the account
+
+    A replica may lag behind the primary up to `REPLICA_STALENESS` seconds,
+    so the accounts with orders written during this time are read from the
+    primary (read-your-writes).
+
+    :param account_name: account name
+    :return: DB alias of a random replica, 'default' if there are none or the account is pinned to the primary
+    """
+    if not settings.DATABASE_REPLICAS:
+        return 'default'
+    if cache.get(_written_key_(account_name)):
+        metrics.inc('db_reads_total', database='primary')
+        return 'default'
+    metrics.inc('db_reads_total', database='replica')
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+def record_write(account_name: str) -> None:
+    """Pin the reads of the account to the primary until the replicas catch up with its orders writes"""
+    if settings.DATABASE_REPLICAS and settings.REPLICA_STALENESS > 0:
+        cache.set(_written_key_(account_name), True, timeout=settings.REPLICA_STALENESS)
+
+
+@contextlib.contextmanager
+def replica_reads(account_name: str) -> typ.Iterator[str]:
+    """Route the reads inside the block to a replica (see `get_read_alias`)
+
+    :param account_name: account name which data is read
+    :return: DB alias the reads go to
+    """
+    alias = get_read_alias(account_name)
+    token = _read_alias.set(None if alias == 'default' else alias)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+def _written_key_(account_name: str) -> str:
+    return f'orders-written:{account_name}'
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from orders.models import Order
+from orders.models import Order, ConditionalOrder
 
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -11,5 +11,33 @@ class OrderSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         rep = super(OrderSerializer, self).to_representation(instance)
-        rep['account'] = instance.account.name
+        # reuse the already fetched account to not query it for every order
+        account = self.context.get('account') or instance.account
+        rep['account'] = account.name
+        return rep
+
+
+class ConditionalOrderSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ConditionalOrder
+        fields = '__all__'
+        read_only_fields = ('status', 'created_at', 'triggered_at', 'triggered_price', 'order', 'error')
+
+    def validate_trigger_price(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('Expected a positive trigger price')
+        return value
+
+    def validate_volume(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('Expected a positive volume')
+        return value
+
+    def to_representation(self, instance):
+        rep = super(ConditionalOrderSerializer, self).to_representation(instance)
+        account = self.context.get('account') or instance.account
+        rep['account'] = account.name
+        # the exchange order id of the placed market order
+        rep['order'] = instance.order.order_id if instance.order_id else None
         return rep
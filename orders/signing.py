@@ -0,0 +1,194 @@
+import hmac
+import time
+import asyncio
+import hashlib
+import typing as typ
+from urllib.parse import urlparse
+
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+
+from orders.db import executor
+from orders.models import Account
+
+Headers = typ.List[typ.Tuple[str, str]]
+
+
+class Signer:
+    """Bitmex request signer with the HMAC pre-keyed by the account secret
+
+    A signature is HMAC_SHA256(secret, verb + path + expires + data), hex encoded.
+    The keyed HMAC is only copied for every signature, so the key is not set up again.
+    """
+
+    def __init__(self, api_key: str, api_secret: str):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.loaded_at = time.monotonic()
+        self._hmac = hmac.new(key=api_secret.encode('utf-8'), digestmod=hashlib.sha256)
+
+    def sign(self, verb: str, path: str, expires: int, data: str = '') -> str:
+        """Generate hex encoded signature
+
+        :param verb: method e.g. 'GET'
+        :param path: url path with the query string
+        :param expires: unix timestamp (in seconds)
+        :param data: request body
+        :return: hex encoded signature
+        """
+        signature = self._hmac.copy()
+        signature.update(f'{verb.upper()}{path}{expires}{data}'.encode('utf-8'))
+        return signature.hexdigest()
+
+    def matches(self, account: Account) -> bool:
+        return (self.api_key, self.api_secret) == (account.api_key, account.api_secret)
+
+
+class CachedSignerAuthenticator:
+    """Bravado authenticator signing the REST requests with a cached `Signer`
+
+    Signs the requests with the `expires` scheme as the Bitmex
+    `APIKeyAuthenticator` does, but does not subclass it, so signing
+    does not import bravado.
+    """
+
+    # seconds the signed requests are valid for (a grace period for a clock skew)
+    expires_in = 5
+
+    def __init__(self, host: str, signer: Signer):
+        self.host = host
+        self.signer = signer
+
+    @staticmethod
+    def matches(url: str) -> bool:
+        # the swagger spec is loaded without the credentials
+        return 'swagger.json' not in url
+
+    def apply(self, request):
+        """Add the auth headers to the `requests.Request`"""
+        expires = int(round(time.time()) + self.expires_in)
+        request.headers['api-expires'] = str(expires)
+        request.headers['api-key'] = self.signer.api_key
+        prepared = request.prepare()
+        request.headers['api-signature'] = self.generate_signature(
+            self.signer.api_secret, request.method, prepared.path_url, expires, prepared.body or '',
+        )
+        return request
+
+    def generate_signature(self, secret, verb, url, nonce, data):
+        parsed_url = urlparse(url)
+        path = f'{parsed_url.path}?{parsed_url.query}' if parsed_url.query else parsed_url.path
+        return self.signer.sign(verb=verb, path=path, expires=nonce, data=data)
+
+
+class SigningService:
+    """Caches account signers and websocket auth headers
+
+    Websocket auth headers are reused while their `api-expires` is far enough
+    and re-signed (without the DB) before it comes, so a reconnect storm
+    needs neither DB queries nor new signatures.
+
+    :param lifetime: seconds the signed auth headers are valid for
+    :param refresh_margin: re-sign auth headers which expire in less seconds
+    :param signer_max_age: seconds to trust a signer loaded from the DB
+        (other processes may change the account secret)
+    """
+
+    def __init__(self, lifetime: int = 5 * 60, refresh_margin: int = 60, signer_max_age: int = 10 * 60):
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.signer_max_age = signer_max_age
+        self._signers: typ.Dict[str, Signer] = {}
+        self._headers: typ.Dict[typ.Tuple[str, str, str], typ.Tuple[int, Headers]] = {}
+        self._refresher: typ.Optional[asyncio.Task] = None
+
+    def signer_for(self, account: Account) -> Signer:
+        """Get cached signer for the already fetched account"""
+        signer = self._signers.get(account.name)
+        if signer is None or not signer.matches(account):
+            signer = self._signers[account.name] = Signer(account.api_key, account.api_secret)
+        return signer
+
+    def authenticator_for(self, account: Account, host: str) -> CachedSignerAuthenticator:
+        return CachedSignerAuthenticator(host=host, signer=self.signer_for(account))
+
+    def get_signer(self, account_name: str) -> Signer:
+        """Get signer for the account name, loading the account from the DB if needed
+
+        :raise Account.DoesNotExist: if the account does not exist
+        """
+        signer = self._signers.get(account_name)
+        if signer is None or time.monotonic() - signer.loaded_at > self.signer_max_age:
+            signer = self.signer_for(Account.objects.get(name=account_name))
+            signer.loaded_at = time.monotonic()
+        return signer
+
+    def warm(self) -> None:
+        """Load signers of all the accounts with one query"""
+        for account in Account.objects.all():
+            self.signer_for(account)
+
+    def forget(self, account_name: str) -> None:
+        self._signers.pop(account_name, None)
+        for key in [key for key in self._headers if key[0] == account_name]:
+            del self._headers[key]
+
+    async def get_ws_auth_headers(self, account_name: str, url: str, verb: str = 'GET') -> Headers:
+        """Get websocket auth headers, reusing the still valid ones
+
+        :param account_name: account name from DB
+        :param url: WS uri
+        :param verb: method e.g. 'GET'
+        :return: an iterable of (name, value) pairs
+        """
+        self._ensure_refresher()
+        key = (account_name, verb, urlparse(url).path)
+        cached = self._headers.get(key)
+        if cached and cached[0] - time.time() > self.refresh_margin:
+            return cached[1]
+
+        if (signer := self._signers.get(account_name)) is None or \
+                time.monotonic() - signer.loaded_at > self.signer_max_age:
+            signer = await executor.run(self.get_signer, account_name)
+        return self._sign_headers(key, signer)
+
+    def refresh_expiring(self) -> int:
+        """Re-sign cached auth headers which are about to expire
+
+        :return: number of re-signed headers
+        """
+        refreshed = 0
+        for key, (expires, _) in list(self._headers.items()):
+            if expires - time.time() <= self.refresh_margin and (signer := self._signers.get(key[0])):
+                self._sign_headers(key, signer)
+                refreshed += 1
+        return refreshed
+
+    async def run_refresher(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_margin / 2)
+            self.refresh_expiring()
+
+    def _ensure_refresher(self) -> None:
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.create_task(self.run_refresher())
+
+    def _sign_headers(self, key: typ.Tuple[str, str, str], signer: Signer) -> Headers:
+        _, verb, path = key
+        expires = int(time.time()) + self.lifetime
+        headers = [
+            ('api-expires', str(expires)),
+            ('api-signature', signer.sign(verb=verb, path=path, expires=expires)),
+            ('api-key', signer.api_key),
+        ]
+        self._headers[key] = (expires, headers)
+        return headers
+
+
+service = SigningService()
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def _forget_changed_account_(sender, instance: Account, **kwargs) -> None:
+    service.forget(instance.name)
@@ -0,0 +1,159 @@
+import datetime
+import typing as typ
+from array import array
+
+# Bitmex table of the executed trades
+TABLE = 'trade'
+
+# rolling windows lengths in seconds by their names
+WINDOWS = {'1s': 1, '1m': 60, '1h': 3600}
+
+# summed values of the trades
+FIELDS = ('buy_volume', 'sell_volume', 'notional', 'trades')
+
+
+class TradeTape:
+    """Rolling trade statistics of one instrument
+
+    Trades are summed into per-second buckets of a fixed-size ring buffer
+    holding the longest window. Every window keeps running totals, a trade
+    is added to them and the buckets leaving a window are subtracted, so
+    both a trade and a summary cost O(number of windows).
+
+    :param symbol: instrument symbol
+    :param windows: windows lengths in seconds by their names
+    """
+
+    def __init__(self, symbol: str, windows: typ.Dict[str, int] = None):
+        self.symbol = symbol
+        self.windows = windows or WINDOWS
+        self.size = max(self.windows.values())
+        self.buckets = {field: array('d', bytes(8 * self.size)) for field in FIELDS}
+        self.totals = {name: dict.fromkeys(FIELDS, 0.0) for name in self.windows}
+        # unix second of the current bucket
+        self.second: typ.Optional[int] = None
+
+    def add(self, side: str, size: float, price: float, traded_at: float) -> bool:
+        """Add an executed trade to the bucket of its second
+
+        :param side: taker side: 'Buy' or 'Sell'
+        :param size: trade quantity
+        :param price: trade price
+        :param traded_at: unix time of the trade
+        :return: False if the trade is older than the longest window (not added)
+        """
+        second = int(traded_at)
+        if self.second is None or second > self.second:
+            self.advance(second)
+        elif self.second - second >= self.size:
+            return False
+        index = second % self.size
+        values = (size, 0, size * price, 1) if side == 'Buy' else (0, size, size * price, 1)
+        for field, value in zip(FIELDS, values):
+            self.buckets[field][index] += value
+            for name, length in self.windows.items():
+                # a late trade is counted only by the windows which still hold its second
+                if self.second - second < length:
+                    self.totals[name][field] += value
+        return True
+
+    def advance(self, second: int) -> None:
+        """Move the windows to the second (never back)"""
+        if self.second is None or second - self.second >= self.size:
+            self.clear()
+            self.second = second
+            return
+        for current in range(self.second + 1, second + 1):
+            for name, length in self.windows.items():
+                leaving, totals = (current - length) % self.size, self.totals[name]
+                for field in FIELDS:
+                    totals[field] -= self.buckets[field][leaving]
+            # the bucket which left the longest window
+            index = current % self.size
+            for field in FIELDS:
+                self.buckets[field][index] = 0.0
+        self.second = max(self.second, second)
+
+    def clear(self) -> None:
+        for buckets in self.buckets.values():
+            buckets[:] = array('d', bytes(8 * self.size))
+        for totals in self.totals.values():
+            totals.update(dict.fromkeys(FIELDS, 0.0))
+
+    def summary(self, now: float) -> typ.Dict[str, typ.Dict[str, typ.Optional[float]]]:
+        """Get volume, number of trades, VWAP and buy/sell imbalance of every window
+
+        :param now: unix time
+        :return: statistics by window names
+        """
+        if self.second is not None:
+            self.advance(int(now))
+        summary = {}
+        for name, totals in self.totals.items():
+            # the running totals may drift slightly below zero
+            buy, sell = max(totals['buy_volume'], 0), max(totals['sell_volume'], 0)
+            volume = buy + sell
+            summary[name] = {
+                'volume': volume,
+                'trades': round(totals['trades']),
+                'vwap': totals['notional'] / volume if volume else None,
+                'imbalance': (buy - sell) / volume if volume else None,
+            }
+        return summary
+
+
+# trade tapes of the feeds relayed in this process by account names and symbols
+tapes: typ.Dict[typ.Tuple[str, str], TradeTape] = {}
+
+
+def group(account: str, symbol: str) -> str:
+    """Get channel layer group of the trade summaries of the account instrument"""
+    return f'{account}.tape.{symbol}'
+
+
+def add_trades(account: str, rows: typ.Iterable[dict], received_at: float, action: str = 'insert') -> int:
+    """Add the trades of a Bitmex `trade` message to the tapes of the account feed
+
+    The partial of the table holds the last trades before the subscription
+    (sent again on every reconnect), they are not counted as received now.
+
+    :param account: account name
+    :param rows: Bitmex trades
+    :param received_at: unix time the message was received at, the time of the trades without a timestamp
+    :param action: Bitmex action of the message, the 'partial' trades are skipped
+    :return: number of added trades
+    """
+    if action == 'partial':
+        return 0
+    added = 0
+    # the trades of a message mostly share the timestamp
+    timestamp, traded_at = None, received_at
+    for row in rows:
+        if (symbol := row.get('symbol')) is None or row.get('size') is None or row.get('price') is None:
+            continue
+        if row.get('timestamp') != timestamp:
+            timestamp = row.get('timestamp')
+            traded_at = _parse_timestamp_(timestamp, received_at)
+        if (tape := tapes.get((account, symbol))) is None:
+            tape = tapes[(account, symbol)] = TradeTape(symbol)
+        added += tape.add(row.get('side'), row['size'], row['price'], traded_at)
+    return added
+
+
+def get_summaries(account: str, now: float) -> typ.List[dict]:
+    """Get the current summaries of the account tapes"""
+    return [
+        {'account': account, 'symbol': symbol, 'tape': tape.summary(now)}
+        for (tape_account, symbol), tape in tapes.items()
+        if tape_account == account
+    ]
+
+
+def _parse_timestamp_(timestamp: typ.Optional[str], default: float) -> float:
+    """Get unix time of a Bitmex timestamp (e.g. `2020-05-30T12:00:00.000Z`)"""
+    if not isinstance(timestamp, str):
+        return default
+    try:
+        return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return default
@@ -1,16 +1,59 @@
+import io
+import os
+import csv
+import copy
+import sys
 import json
+import time
+import socket
+import weakref
+import tempfile
+import asyncio
+import threading
+import datetime
+import typing as typ
+import subprocess
 from unittest import mock
 import urllib.parse as urlparse
 from urllib.parse import urlencode
 
 from django.urls import reverse
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils.dateparse import parse_datetime
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
 from rest_framework.views import status
 from rest_framework.test import APITestCase, APIClient
+from channels.layers import InMemoryChannelLayer
 from bravado.exception import HTTPUnauthorized, HTTPNotFound, HTTPBadRequest
-
-from orders.models import Account, Order, Side
+from requests import Request
+from BitMEXAPIKeyAuthenticator import APIKeyAuthenticator
+
+from orders import archive, conditional, exchange, frames, metrics, orderbook, outbound, replicas, tape, ticks
+from orders.admission import AdmissionController, Overloaded, Priority
+from orders.exchange import SingleFlight
+from orders.replicas import ReplicaRouter
+from orders.consumer import BitmexInstrumentConsumer, coordinator as feed_coordinator
+from orders.outbound import OutboundQueue, Policy, QueueOverflow
+from orders.throttle import SymbolThrottle
+from orders.signing import CachedSignerAuthenticator, Signer, SigningService
+from orders.db import DatabaseExecutor
+from orders.feeds import HashRing, FeedCoordinator
+from orders.delta import DeltaEncoder
+from orders.alerts import Alert, AlertBook, AlertEngine, AlertError, AlertType, _post_webhook_, check_webhook
+from orders.pipeline import DEFAULT_KEY, PipelineError, apply_pipelines, get_pipeline, get_spec_key
+from orders.models import (
+    Account, Order, OrderStatus, Position, Side, ConditionalOrder, ConditionalOrderKind, ConditionalOrderStatus,
+    get_lifecycle_fields,
+)
+from orders.conditional import ConditionalOrderTrigger, fire, load_books
+from orders.positions import get_positions, rebuild_positions
+from orders.views import Orders
 from orders.serializers import OrderSerializer
+from benchmarks.run import bench_ws_fanout
+from orders.reconciler import (
+    ReconcileStats, apply_exchange_orders, reconcile_account, reconcile_accounts, run_reconciler,
+)
 
 
 def _add_query_parameters_to_url(url: str, params: dict) -> str:
@@ -50,6 +93,13 @@ class SideTest(TestCase):
         self.assertIsInstance(order.side, str)
         self.assertEqual(str(order.side), SideTest.side_case)
 
+    def test_timestamp_is_not_changed_on_save(self):
+        timestamp = self.order.timestamp
+        self.order.price = 321
+        self.order.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.timestamp, timestamp)
+
 
 class BaseViewTest(APITestCase):
     client = APIClient()
@@ -123,6 +173,63 @@ class OrdersViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data, serialized.data)
 
+    def test_several_orders_for_account(self):
+        for order_id in ('1', '2'):
+            Order.objects.create(
+                order_id=order_id,
+                symbol='XBTUSD',
+                volume=1,
+                side=Side.BUY,
+                price=123,
+                account=self.account,
+            )
+
+        response = self.client.get(reverse("orders"), {'account': self.account_name})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([order['order_id'] for order in response.data], ['1', '2'])
+
+    def test_open_orders_for_account(self):
+        for order_id, order_status in (('1', OrderStatus.NEW), ('2', OrderStatus.PARTIALLY_FILLED),
+                                       ('3', OrderStatus.FILLED), ('4', OrderStatus.CANCELED)):
+            Order.objects.create(
+                order_id=order_id,
+                symbol='XBTUSD',
+                volume=1,
+                side=Side.BUY,
+                price=123,
+                account=self.account,
+                status=order_status,
+            )
+
+        response = self.client.get(reverse("orders"), {'account': self.account_name, 'status': 'open'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(order['order_id'] for order in response.data), ['1', '2'])
+        self.assertEqual({order['account'] for order in response.data}, {self.account_name})
+
+    def test_orders_with_exact_status(self):
+        Order.objects.create(
+            order_id='1',
+            symbol='XBTUSD',
+            volume=1,
+            side=Side.BUY,
+            price=123,
+            account=self.account,
+            status=OrderStatus.FILLED,
+        )
+
+        response = self.client.get(reverse("orders"), {'account': self.account_name, 'status': 'Filled'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([order['order_id'] for order in response.data], ['1'])
+
+    def test_orders_with_unknown_status(self):
+        response = self.client.get(reverse("orders"), {'account': self.account_name, 'status': 'unknown'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('unknown', response.data['error'])
+
     def test_create_order_without_account_parameter(self):
         response = self.client.post(reverse("orders"))
 
@@ -142,7 +249,7 @@ class OrdersViewTest(BaseViewTest):
         self.assertIn('error', response.data)
         self.assertIn(account_name, response.data['error'])
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_create_order_bad_account_credentials(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_new.return_value. \
@@ -158,7 +265,7 @@ class OrdersViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_create_order_not_found(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_new.return_value. \
@@ -174,7 +281,7 @@ class OrdersViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_create_order_bad_request(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_new.return_value. \
@@ -190,7 +297,7 @@ class OrdersViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_create_order_without_mandatory_fields(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_new.return_value. \
@@ -206,7 +313,7 @@ class OrdersViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_create_order_not_valid_data(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_new.return_value. \
@@ -227,7 +334,7 @@ class OrdersViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('order_id', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_create_order_valid_data(self, mock_bitmex):
         order_id = '123-123'
         mock_result = mock.MagicMock()
@@ -255,6 +362,135 @@ class OrdersViewTest(BaseViewTest):
         self.assertEqual(order_id, response.data['order_id'])
         self.assertTrue(Order.objects.filter(id=response.data['id']).exists())
 
+    @mock.patch('orders.views.exchange.new_market_order', return_value={'orderID': '1', 'ordStatus': 'PendingNew'})
+    def test_create_order_with_pending_status(self, _):
+        url = _add_query_parameters_to_url(reverse('orders'), {'account': self.account_name})
+        response = self.client.post(url, self.base_post_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Order.objects.get(order_id='1').status, OrderStatus.NEW)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_create_order_lifecycle_fields(self, mock_bitmex):
+        mock_result = mock.MagicMock()
+        mock_result.Order.Order_new.return_value. \
+            result.return_value = {
+                'orderID': '123-123',
+                'price': 9000.5,
+                'ordStatus': 'Filled',
+                'cumQty': 1,
+                'avgPx': 9000.5,
+                'transactTime': '2020-06-01T10:00:00.000Z',
+            }, ''
+        mock_bitmex.return_value = mock_result
+
+        url = _add_query_parameters_to_url(
+            reverse("orders"),
+            {'account': self.account_name},
+        )
+        response = self.client.post(
+            url,
+            data=json.dumps(self.base_post_data),
+            follow=True,
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get(id=response.data['id'])
+        self.assertEqual(order.status, OrderStatus.FILLED)
+        self.assertEqual(order.filled_volume, 1)
+        self.assertEqual(order.avg_price, 9000.5)
+        self.assertEqual(
+            order.transact_time,
+            datetime.datetime(2020, 6, 1, 10, tzinfo=datetime.timezone.utc),
+        )
+
+    def test_amend_orders_without_account_parameter(self):
+        response = self.client.patch(reverse("orders"), data=[], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('account', response.data['error'])
+
+    def test_amend_orders_not_a_list(self):
+        url = _add_query_parameters_to_url(
+            reverse("orders"),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data={'order_id': '123'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('error', response.data)
+
+    def test_amend_orders_without_order_id(self):
+        url = _add_query_parameters_to_url(
+            reverse("orders"),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data=[{'price': 1}], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('order_id', response.data['error'])
+
+    def test_amend_orders_not_an_object(self):
+        url = _add_query_parameters_to_url(
+            reverse("orders"),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data=[{'order_id': '123', 'price': 1}, '456'], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('index 1', response.data['error'])
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_amend_not_existing_orders(self, mock_bitmex):
+        url = _add_query_parameters_to_url(
+            reverse("orders"),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data=[{'order_id': '123', 'price': 1}], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('123', response.data['error'])
+        mock_bitmex.return_value.Order.Order_amendBulk.assert_not_called()
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_amend_orders(self, mock_bitmex):
+        for order_id in ('1-1', '2-2'):
+            Order.objects.create(
+                order_id=order_id,
+                symbol='XBTUSD',
+                volume=1,
+                side=Side.BUY,
+                price=123,
+                account=self.account,
+            )
+        mock_result = mock.MagicMock()
+        mock_result.Order.Order_amendBulk.return_value. \
+            result.return_value = [
+                {'orderID': '1-1', 'orderQty': 5, 'price': 100.0},
+                {'orderID': '2-2', 'orderQty': 1, 'price': 200.0},
+            ], mock.MagicMock()
+        mock_bitmex.return_value = mock_result
+
+        url = _add_query_parameters_to_url(
+            reverse("orders"),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(
+            url,
+            data=[{'order_id': '1-1', 'volume': 5, 'price': 100}, {'order_id': '2-2', 'price': 200}],
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            json.loads(mock_result.Order.Order_amendBulk.call_args.kwargs['orders']),
+            [{'orderID': '1-1', 'orderQty': 5, 'price': 100}, {'orderID': '2-2', 'price': 200}],
+        )
+        self.assertEqual(Order.objects.get(order_id='1-1').volume, 5)
+        self.assertEqual(Order.objects.get(order_id='1-1').price, 100.0)
+        self.assertEqual(Order.objects.get(order_id='2-2').price, 200.0)
+
 
 class OrderDetailViewTest(BaseViewTest):
 
@@ -281,7 +517,7 @@ class OrderDetailViewTest(BaseViewTest):
         self.assertIn('error', response.data)
         self.assertIn(account_name, response.data['error'])
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_get_order_bad_account_credentials(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_getOrders.return_value.\
@@ -297,7 +533,7 @@ class OrderDetailViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_get_order_empty_response_from_bitmex(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_getOrders.return_value. \
@@ -313,7 +549,7 @@ class OrderDetailViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_get_order_good_response_from_bitmex(self, mock_bitmex):
         expected_data = [{
             'test_key1': 'test_value1',
@@ -356,7 +592,7 @@ class OrderDetailViewTest(BaseViewTest):
         self.assertIn('error', response.data)
         self.assertIn(account_name, response.data['error'])
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_delete_order_not_found(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_cancel.return_value.\
@@ -372,7 +608,7 @@ class OrderDetailViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_delete_order_bad_account_credentials(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_cancel.return_value.\
@@ -388,7 +624,7 @@ class OrderDetailViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_delete_not_existing_order(self, mock_bitmex):
         mock_result = mock.MagicMock()
         mock_result.Order.Order_cancel.return_value. \
@@ -404,7 +640,7 @@ class OrderDetailViewTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertIn('error', response.data)
 
-    @mock.patch('orders.views.bitmex')
+    @mock.patch('orders.exchange.bitmex')
     def test_delete_order(self, mock_bitmex):
         order_id = '123-123-123-123'
         Order.objects.create(
@@ -429,3 +665,2079 @@ class OrderDetailViewTest(BaseViewTest):
 
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertFalse(Order.objects.filter(order_id=order_id).exists())
+
+    def test_amend_order_without_account_parameter(self):
+        response = self.client.patch(reverse(
+            "order-detail",
+            kwargs={'order_id': 'some order_id'},
+        ))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('error', response.data)
+        self.assertIn('account', response.data['error'])
+
+    def test_amend_order_without_fields_to_amend(self):
+        url = _add_query_parameters_to_url(
+            reverse("order-detail", kwargs={'order_id': 'some order_id'}),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data={'symbol': 'XBTUSD'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('error', response.data)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_amend_not_existing_order(self, mock_bitmex):
+        url = _add_query_parameters_to_url(
+            reverse("order-detail", kwargs={'order_id': 'some order_id'}),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data={'price': 100}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('error', response.data)
+        mock_bitmex.return_value.Order.Order_amend.assert_not_called()
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_amend_order_bad_request(self, mock_bitmex):
+        order_id = '123-123-123-123'
+        Order.objects.create(
+            order_id=order_id,
+            symbol='XBTUSD',
+            volume=1,
+            side=Side.BUY,
+            price=123,
+            account=self.account,
+        )
+        mock_result = mock.MagicMock()
+        mock_result.Order.Order_amend.return_value. \
+            result.side_effect = HTTPBadRequest(mock.MagicMock())
+        mock_bitmex.return_value = mock_result
+
+        url = _add_query_parameters_to_url(
+            reverse("order-detail", kwargs={'order_id': order_id}),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data={'price': 100}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Order.objects.get(order_id=order_id).price, 123)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_amend_order(self, mock_bitmex):
+        order_id = '123-123-123-123'
+        Order.objects.create(
+            order_id=order_id,
+            symbol='XBTUSD',
+            volume=1,
+            side=Side.BUY,
+            price=123,
+            account=self.account,
+        )
+        mock_result = mock.MagicMock()
+        mock_result.Order.Order_amend.return_value. \
+            result.return_value = {'orderID': order_id, 'orderQty': 2, 'price': 100.0}, mock.MagicMock()
+        mock_bitmex.return_value = mock_result
+
+        url = _add_query_parameters_to_url(
+            reverse("order-detail", kwargs={'order_id': order_id}),
+            {'account': self.account_name},
+        )
+        response = self.client.patch(url, data={'volume': 2, 'price': 100}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_result.Order.Order_amend.assert_called_once_with(orderID=order_id, orderQty=2, price=100)
+        self.assertEqual(response.data['volume'], 2)
+        self.assertEqual(response.data['price'], 100.0)
+        order = Order.objects.get(order_id=order_id)
+        self.assertEqual(order.volume, 2)
+        self.assertEqual(order.price, 100.0)
+
+
+class OrdersFanOutViewTest(BaseViewTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.another_account = Account.objects.create(
+            name='another_account',
+            api_key='another api key',
+            api_secret='another secret key',
+        )
+
+    @staticmethod
+    def _order_new(symbol, orderQty, side, ordType):
+        future = mock.MagicMock()
+        if orderQty > 5:
+            future.result.side_effect = HTTPBadRequest(mock.MagicMock())
+        else:
+            future.result.return_value = (
+                {'orderID': f'order-{orderQty}', 'price': 9000.0, 'ordStatus': 'Filled',
+                 'cumQty': orderQty, 'avgPx': 9000.0},
+                mock.MagicMock(),
+            )
+        return future
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_same_volume_for_all_accounts(self, mock_bitmex):
+        mock_bitmex.return_value.Order.Order_new.side_effect = [
+            self._order_new('XBTUSD', 1, 'Buy', 'Market'),
+            self._order_new('XBTUSD', 2, 'Buy', 'Market'),
+        ]
+
+        response = self.client.post(reverse('orders-fanout'), data={
+            'symbol': 'XBTUSD', 'side': 'Buy', 'volume': 1,
+            'accounts': [self.account.name, self.another_account.name],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(set(response.data), {self.account.name, self.another_account.name})
+        self.assertEqual(mock_bitmex.return_value.Order.Order_new.call_count, 2)
+        self.assertEqual(
+            {call.kwargs['orderQty'] for call in mock_bitmex.return_value.Order.Order_new.call_args_list},
+            {1},
+        )
+        self.assertEqual(Order.objects.filter(account=self.another_account).count(), 1)
+        self.assertEqual(response.data[self.account.name]['order']['account'], self.account.name)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_volumes_per_account_with_failure(self, mock_bitmex):
+        mock_bitmex.return_value.Order.Order_new.side_effect = self._order_new
+
+        response = self.client.post(reverse('orders-fanout'), data={
+            'symbol': 'XBTUSD', 'side': 'Buy',
+            'accounts': {self.account.name: 3, self.another_account.name: 10},
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data[self.account.name]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(response.data[self.account.name]['order']['volume'], 3)
+        self.assertEqual(response.data[self.another_account.name]['status'], status.HTTP_400_BAD_REQUEST)
+        self.assertIn('error', response.data[self.another_account.name])
+        self.assertEqual(list(Order.objects.values_list('account__name', 'status')), [(self.account.name, 'Filled')])
+
+    def test_not_existing_account(self):
+        response = self.client.post(reverse('orders-fanout'), data={
+            'symbol': 'XBTUSD', 'side': 'Buy', 'volume': 1,
+            'accounts': [self.account.name, 'not existing'],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('not existing', response.data['error'])
+
+    def test_without_volume(self):
+        response = self.client.post(reverse('orders-fanout'), data={
+            'symbol': 'XBTUSD', 'side': 'Buy', 'accounts': [self.account.name],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('volume', response.data['error'])
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_connection_error_of_one_account(self, mock_bitmex):
+        def order_new(symbol, orderQty, side, ordType):
+            if orderQty == 2:
+                raise ConnectionError('Connection reset by peer')
+            return self._order_new(symbol, orderQty, side, ordType)
+
+        mock_bitmex.return_value.Order.Order_new.side_effect = order_new
+
+        response = self.client.post(reverse('orders-fanout'), data={
+            'symbol': 'XBTUSD', 'side': 'Buy',
+            'accounts': {self.account.name: 1, self.another_account.name: 2},
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data[self.account.name]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(response.data[self.another_account.name]['status'], status.HTTP_502_BAD_GATEWAY)
+        self.assertEqual(list(Order.objects.values_list('account__name', flat=True)), [self.account.name])
+
+    def test_not_string_account_names(self):
+        response = self.client.post(reverse('orders-fanout'), data={
+            'symbol': 'XBTUSD', 'side': 'Buy', 'volume': 1, 'accounts': [self.account.name, ['nested']],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ReconcilerTest(TestCase):
+
+    def setUp(self) -> None:
+        self.account = Account.objects.create(
+            name='test',
+            api_key='test api key',
+            api_secret='test secret key',
+        )
+
+    def _create_order(self, order_id: str, **kwargs) -> Order:
+        return Order.objects.create(**{
+            'order_id': order_id,
+            'symbol': 'XBTUSD',
+            'volume': 1,
+            'side': Side.BUY,
+            'price': 123,
+            'account': self.account,
+            **kwargs,
+        })
+
+    def test_apply_exchange_orders(self):
+        self._create_order('changed')
+        self._create_order('unchanged')
+        self._create_order('canceled')
+        exchange_orders = [
+            {'orderID': 'changed', 'orderQty': 2, 'price': 100.0, 'ordStatus': 'New',
+             'timestamp': '2020-06-01T10:00:00.000Z'},
+            {'orderID': 'unchanged', 'orderQty': 1, 'price': 123.0, 'ordStatus': 'New',
+             'timestamp': '2020-06-01T10:00:01.000Z'},
+            {'orderID': 'canceled', 'orderQty': 1, 'price': 123.0, 'ordStatus': 'Canceled',
+             'timestamp': '2020-06-01T10:00:03.000Z'},
+            {'orderID': 'new', 'symbol': 'XBTUSD', 'side': 'Sell', 'orderQty': 3, 'price': 99.5,
+             'ordStatus': 'New', 'timestamp': '2020-06-01T10:00:02.000Z'},
+        ]
+
+        stats = apply_exchange_orders(self.account, exchange_orders)
+
+        self.assertEqual(stats, ReconcileStats(created=1, updated=2))
+        self.assertEqual(Order.objects.get(order_id='changed').volume, 2)
+        self.assertEqual(Order.objects.get(order_id='canceled').status, OrderStatus.CANCELED)
+        self.assertEqual(Order.objects.get(order_id='new').side, Side.SELL)
+        self.account.refresh_from_db()
+        self.assertEqual(
+            self.account.orders_reconciled_at,
+            datetime.datetime(2020, 6, 1, 10, 0, 3, tzinfo=datetime.timezone.utc),
+        )
+
+    def test_unknown_exchange_statuses_are_mapped(self):
+        for ord_status, cum_qty, expected in (
+                ('PendingNew', 0, OrderStatus.NEW), ('PendingCancel', 2, OrderStatus.PARTIALLY_FILLED),
+                ('Expired', 0, OrderStatus.CANCELED), ('DoneForDay', 1, OrderStatus.CANCELED),
+                ('SomethingNew', 0, OrderStatus.NEW), ('Filled', 3, OrderStatus.FILLED),
+        ):
+            with self.subTest(ord_status=ord_status):
+                fields = get_lifecycle_fields({'ordStatus': ord_status, 'cumQty': cum_qty})
+                self.assertEqual(fields['status'], expected)
+
+    def test_apply_no_exchange_orders(self):
+        self.assertEqual(apply_exchange_orders(self.account, []), ReconcileStats())
+        self.account.refresh_from_db()
+        self.assertIsNone(self.account.orders_reconciled_at)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_reconcile_account_pages_from_watermark(self, mock_bitmex):
+        watermark = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+        self.account.orders_reconciled_at = watermark
+        pages = [
+            [{'orderID': '1', 'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 1, 'ordStatus': 'New'},
+             {'orderID': '2', 'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 1, 'ordStatus': 'New'}],
+            [{'orderID': '3', 'symbol': 'XBTUSD', 'side': 'Buy', 'orderQty': 1, 'ordStatus': 'New'}],
+        ]
+        mock_get_orders = mock_bitmex.return_value.Order.Order_getOrders
+        mock_get_orders.return_value.result.side_effect = [(page, mock.MagicMock()) for page in pages]
+
+        stats = reconcile_account(self.account, page_size=2)
+
+        self.assertEqual(stats.created, 3)
+        self.assertEqual(
+            [call.kwargs['start'] for call in mock_get_orders.call_args_list],
+            [0, 2],
+        )
+        self.assertEqual(mock_get_orders.call_args.kwargs['startTime'], watermark)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_reconcile_account_reuses_client(self, mock_bitmex):
+        mock_bitmex.return_value.Order.Order_getOrders.return_value.result.return_value = ([], mock.MagicMock())
+
+        reconcile_account(self.account)
+        reconcile_account(self.account)
+
+        mock_bitmex.assert_called_once()
+
+    @mock.patch('orders.reconciler.reconcile_account')
+    def test_reconcile_accounts_in_pool(self, mock_reconcile_account):
+        another_account = Account.objects.create(
+            name='another_account',
+            api_key='test api key',
+            api_secret='test secret key',
+        )
+        mock_reconcile_account.return_value = ReconcileStats(created=1)
+
+        results = asyncio.run(reconcile_accounts([self.account, another_account], workers=2))
+
+        self.assertEqual(results, {
+            'test': ReconcileStats(created=1),
+            'another_account': ReconcileStats(created=1),
+        })
+
+    @mock.patch('orders.reconciler.reconcile_account')
+    def test_failed_account_does_not_stop_others(self, mock_reconcile_account):
+        another_account = Account.objects.create(name='another_account', api_key='key', api_secret='secret')
+        mock_reconcile_account.side_effect = [ConnectionError('connection reset'), ReconcileStats(created=1)]
+
+        with self.assertLogs('orders.reconciler', 'ERROR'):
+            results = asyncio.run(reconcile_accounts([self.account, another_account], workers=1))
+
+        self.assertEqual(results, {'test': None, 'another_account': ReconcileStats(created=1)})
+
+    @mock.patch('orders.reconciler._get_all_accounts_', side_effect=RuntimeError('DB is unavailable'))
+    def test_failed_round_does_not_stop_reconciler(self, _):
+        with self.assertLogs('orders.reconciler', 'ERROR'):
+            asyncio.run(run_reconciler(interval=0, workers=1, once=True))
+
+
+class MetricsTest(BaseViewTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        metrics.reset()
+
+    def test_histogram_percentiles(self):
+        histogram = metrics.Histogram()
+        for millis in range(1, 101):
+            histogram.record(millis / 1000)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.05 * 0.07)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.099 * 0.07)
+        self.assertEqual(histogram.cumulative_counts([0.0005, 0.0105, 1]), [0, 10, 100])
+
+    def test_disabled_metrics_are_not_recorded(self):
+        with mock.patch.object(metrics, 'ENABLED', False):
+            metrics.observe('stage_duration_seconds', 0.1, stage='db')
+            metrics.inc('http_requests_total')
+            self.assertIs(metrics.timer('stage_duration_seconds'), metrics.NULL_TIMER)
+
+        self.assertEqual(metrics.histograms, {})
+        self.assertEqual(metrics.counters, {})
+
+    @mock.patch.object(outbound, 'queues', weakref.WeakSet())
+    def test_outbound_lag_is_exported(self):
+        queue = OutboundQueue(maxsize=10)
+        queue.put(1, received_at=time.time())
+        queue.put(2)
+        queue.max_lag = 0.5
+        with mock.patch.object(metrics, 'ENABLED', True):
+            metrics.set_gauge_function('ws_outbound_queued', outbound.get_queued)
+            metrics.set_gauge_function('ws_outbound_max_lag_seconds', outbound.get_max_lag)
+        rendered = metrics.render()
+
+        self.assertIn('# TYPE bitmex_orders_ws_outbound_queued gauge', rendered)
+        self.assertIn('bitmex_orders_ws_outbound_queued 2', rendered)
+        self.assertIn('bitmex_orders_ws_outbound_max_lag_seconds 0.5', rendered)
+        self.assertGreater(queue.lag(), 0)
+
+    def test_render(self):
+        with mock.patch.object(metrics, 'ENABLED', True):
+            metrics.observe('stage_duration_seconds', 0.002, stage='db')
+            metrics.inc('ws_messages_total', 2, direction='upstream')
+
+        rendered = metrics.render()
+        self.assertIn('# TYPE bitmex_orders_stage_duration_seconds histogram', rendered)
+        self.assertIn('bitmex_orders_stage_duration_seconds_bucket{stage="db",le="0.001"} 0', rendered)
+        self.assertIn('bitmex_orders_stage_duration_seconds_bucket{stage="db",le="0.0025"} 1', rendered)
+        self.assertIn('bitmex_orders_stage_duration_seconds_count{stage="db"} 1', rendered)
+        self.assertIn('bitmex_orders_ws_messages_total{direction="upstream"} 2', rendered)
+
+    def test_render_while_recording(self):
+        stop = threading.Event()
+
+        def record():
+            number = 0
+            while not stop.is_set():
+                metrics.observe('stage_duration_seconds', number / 1e6, stage=str(number % 100))
+                metrics.inc('ws_messages_total', direction=str(number % 100))
+                number += 1
+
+        with mock.patch.object(metrics, 'ENABLED', True):
+            threads = [threading.Thread(target=record) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            try:
+                for _ in range(20):
+                    metrics.render()
+                    metrics.histograms[('stage_duration_seconds', (('stage', '0'),))].percentile(99)
+            finally:
+                stop.set()
+                for thread in threads:
+                    thread.join()
+
+    def test_metrics_view(self):
+        with mock.patch.object(metrics, 'ENABLED', False):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_404_NOT_FOUND)
+        with mock.patch.object(metrics, 'ENABLED', True):
+            response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    def test_middleware_measures_requests(self):
+        request = RequestFactory().get(reverse("orders"), {'account': self.account_name, 'status': 'open'})
+        request.resolver_match = mock.MagicMock(url_name='orders')
+        with mock.patch.object(metrics, 'ENABLED', True):
+            middleware = metrics.MetricsMiddleware(Orders.as_view())
+            middleware(request)
+
+        labels = (('method', 'GET'), ('status', '200'), ('view', 'orders'))
+        self.assertEqual(metrics.counters[('http_requests_total', labels)].value, 1)
+        self.assertIn(('stage_duration_seconds', (('stage', 'account_lookup'),)), metrics.histograms)
+        self.assertIn(('stage_duration_seconds', (('stage', 'db'),)), metrics.histograms)
+
+
+class OutboundQueueTest(TestCase):
+
+    @staticmethod
+    def _drain(queue: OutboundQueue) -> list:
+        async def drain():
+            return [(await queue.get()).message for _ in range(len(queue))]
+        return asyncio.run(drain())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(maxsize=1, policy='unknown')
+
+    def test_conflate_to_latest_per_key(self):
+        queue = OutboundQueue(maxsize=10, policy=Policy.CONFLATE)
+        queue.put({'symbol': 'XBTUSD', 'price': 1}, key='XBTUSD')
+        queue.put({'symbol': 'ETHUSD', 'price': 2}, key='ETHUSD')
+        queue.put({'symbol': 'XBTUSD', 'price': 3}, key='XBTUSD')
+
+        self.assertEqual(queue.conflated, 1)
+        self.assertEqual(self._drain(queue), [
+            {'symbol': 'XBTUSD', 'price': 3},
+            {'symbol': 'ETHUSD', 'price': 2},
+        ])
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(maxsize=2, policy=Policy.DROP_OLDEST)
+        for number in range(4):
+            queue.put(number, key='XBTUSD')
+
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(self._drain(queue), [2, 3])
+
+    def test_disconnect(self):
+        queue = OutboundQueue(maxsize=1, policy=Policy.DISCONNECT)
+        queue.put(1)
+        with self.assertRaises(QueueOverflow):
+            queue.put(2)
+
+    def test_lag_stats(self):
+        queue = OutboundQueue(maxsize=1)
+        queue.put(1)
+        queued = asyncio.run(queue.get())
+        queue.mark_sent(queued)
+
+        stats = queue.stats()
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual(stats['depth'], 0)
+        self.assertGreaterEqual(stats['max_lag'], stats['last_lag'])
+
+
+class ConsumerOutboundTest(TestCase):
+
+    def _consumer(self, policy: str, maxsize: int) -> BitmexInstrumentConsumer:
+        consumer = BitmexInstrumentConsumer(scope={'type': 'websocket'})
+        consumer.send = mock.AsyncMock()
+        consumer.close = mock.AsyncMock()
+        consumer.outbound = OutboundQueue(maxsize=maxsize, policy=policy)
+        return consumer
+
+    def test_messages_are_sent_from_queue(self):
+        consumer = self._consumer(Policy.CONFLATE, maxsize=10)
+        message = {'timestamp': 't', 'account': 'test', 'symbol': 'XBTUSD', 'price': 1}
+
+        async def relay():
+            await consumer.send_message({'type': 'send_message', 'message': message})
+            sender = asyncio.create_task(consumer._send_outbound())
+            await asyncio.sleep(0)
+            sender.cancel()
+
+        asyncio.run(relay())
+        consumer.send.assert_awaited_once_with(text_data=json.dumps(message))
+        self.assertEqual(consumer.outbound.sent, 1)
+
+    def test_slow_consumer_is_disconnected(self):
+        consumer = self._consumer(Policy.DISCONNECT, maxsize=1)
+
+        async def relay():
+            for price in range(3):
+                await consumer.send_message({
+                    'type': 'send_message',
+                    'message': {'account': 'test', 'symbol': 'XBTUSD', 'price': price},
+                })
+
+        asyncio.run(relay())
+        consumer.close.assert_awaited_once_with(code=consumer.slow_consumer_close_code)
+        consumer.send.assert_not_awaited()
+
+    def test_delta_mode_suppresses_unchanged_prices(self):
+        consumer = self._consumer(Policy.CONFLATE, maxsize=10)
+        consumer.delta = DeltaEncoder()
+
+        async def relay():
+            sender = asyncio.create_task(consumer._send_outbound())
+            for timestamp, price in enumerate([1, 1, 2]):
+                await consumer.send_message({
+                    'type': 'send_message',
+                    'message': {'timestamp': str(timestamp), 'account': 'test', 'symbol': 'XBTUSD', 'price': price},
+                })
+                await asyncio.sleep(0)
+            sender.cancel()
+
+        asyncio.run(relay())
+        self.assertEqual(
+            [json.loads(call.kwargs['text_data']) for call in consumer.send.await_args_list],
+            [
+                {'seq': 1, 'account': 'test', 'symbol': 'XBTUSD', 'timestamp': '0', 'price': 1},
+                {'seq': 2, 'account': 'test', 'symbol': 'XBTUSD', 'timestamp': '2', 'price': 2},
+            ],
+        )
+        self.assertEqual(consumer.delta.suppressed, 1)
+
+
+class DeltaEncoderTest(TestCase):
+
+    def test_only_changed_fields_are_sent(self):
+        encoder = DeltaEncoder()
+        message = {'timestamp': '1', 'account': 'test', 'symbol': 'XBTUSD', 'price': 1, 'volume': 10}
+
+        self.assertEqual(encoder.encode(message)['seq'], 1)
+        self.assertIsNone(encoder.encode({**message, 'timestamp': '2'}))
+        self.assertEqual(
+            encoder.encode({**message, 'timestamp': '3', 'volume': 11}),
+            {'seq': 2, 'account': 'test', 'symbol': 'XBTUSD', 'timestamp': '3', 'volume': 11},
+        )
+        self.assertEqual(encoder.encode({**message, 'symbol': 'ETHUSD'})['price'], 1)
+
+    def test_dropped_messages_make_gap_and_resync(self):
+        encoder = DeltaEncoder()
+        encoder.encode({'account': 'test', 'symbol': 'XBTUSD', 'price': 1})
+        for price in (2, 3):
+            encoder.observe({'account': 'test', 'symbol': 'XBTUSD', 'price': price})
+        encoder.observe({'account': 'other', 'symbol': 'XBTUSD', 'price': 5})
+
+        self.assertEqual(encoder.encode({'account': 'test', 'symbol': 'ETHUSD', 'price': 7}, skipped=2)['seq'], 4)
+        self.assertEqual(encoder.snapshot('test'), {
+            'resync': True, 'seq': 4, 'account': 'test',
+            'instruments': [{'account': 'test', 'symbol': 'XBTUSD', 'price': 3}],
+        })
+        self.assertIsNone(encoder.encode({'account': 'test', 'symbol': 'XBTUSD', 'price': 3}))
+
+    def test_messages_without_instrument_are_sent_as_is(self):
+        error = {'status': 400, 'error': 'Failed to decode Bitmex data.'}
+        self.assertEqual(DeltaEncoder().encode(error), error)
+
+
+class PipelineTest(TestCase):
+    rows = [
+        {'symbol': 'XBTUSD', 'lastPrice': 9500.5, 'bidPrice': 9500, 'askPrice': 9501, 'timestamp': 't'},
+        {'symbol': 'ETHUSD', 'markPrice': 240.1, 'timestamp': 't'},
+        {'symbol': '.EVOL7D', 'fairPrice': 5.48, 'timestamp': 't'},
+    ]
+
+    def test_default_pipeline(self):
+        self.assertEqual(get_pipeline(get_spec_key(None)).apply(self.rows, 'test'), [
+            {'timestamp': 't', 'account': 'test', 'symbol': 'XBTUSD', 'price': 9500.5},
+        ])
+        self.assertEqual(get_pipeline(DEFAULT_KEY).group('test'), 'test')
+
+    def test_fields_filters_and_derived_values(self):
+        pipeline = get_pipeline(get_spec_key({
+            'fields': {'last': 'lastPrice', 'mark': 'markPrice'},
+            'symbols': ['XBTUSD', 'ETHUSD'],
+            'derived': ['spread', 'mid'],
+        }))
+
+        self.assertEqual(pipeline.apply(self.rows, 'test'), [
+            {'timestamp': 't', 'account': 'test', 'symbol': 'XBTUSD', 'last': 9500.5, 'mid': 9500.5, 'spread': 1},
+            {'timestamp': 't', 'account': 'test', 'symbol': 'ETHUSD', 'mark': 240.1},
+        ])
+        self.assertNotEqual(pipeline.group('test'), 'test')
+
+    def test_single_field_with_symbols(self):
+        pipeline = get_pipeline(get_spec_key({'fields': {'mark': 'markPrice'}, 'symbols': ['ETHUSD']}))
+
+        self.assertEqual(pipeline.apply(self.rows + [{'symbol': 'XBTUSD', 'markPrice': 1}], 'test'), [
+            {'timestamp': 't', 'account': 'test', 'symbol': 'ETHUSD', 'mark': 240.1},
+        ])
+
+    def test_equal_specs_are_compiled_once(self):
+        first = get_pipeline(get_spec_key({'fields': ['markPrice', 'lastPrice'], 'symbols': ['B', 'A']}))
+        second = get_pipeline(get_spec_key({'symbols': ['A', 'B'], 'fields': ['markPrice', 'lastPrice']}))
+        self.assertIs(first, second)
+
+    def test_invalid_specs(self):
+        for spec in ({'fields': 'lastPrice'}, {'derived': ['unknown']}, {'fields': {'symbol': 'lastPrice'}},
+                     {'fields': []}, {'unknown': 1}, ['lastPrice']):
+            with self.subTest(spec=spec), self.assertRaises(PipelineError):
+                get_spec_key(spec)
+
+    def test_apply_pipelines_in_one_pass(self):
+        pipelines = [get_pipeline(DEFAULT_KEY), get_pipeline(get_spec_key({'fields': ['markPrice']}))]
+        groups = apply_pipelines(pipelines, self.rows, 'test')
+
+        self.assertEqual(list(groups), ['test', pipelines[1].group('test')])
+        self.assertEqual([message['symbol'] for message in groups[pipelines[1].group('test')]], ['ETHUSD'])
+
+
+class TickTest(TestCase):
+
+    def test_tick_is_read_only_message(self):
+        row = json.loads('{"symbol": "XBTUSD", "lastPrice": 9500.5, "timestamp": "t"}')
+        tick = get_pipeline(DEFAULT_KEY).extract(row, 'test')
+
+        self.assertIsInstance(tick, ticks.Tick)
+        self.assertEqual(tick, {'timestamp': 't', 'account': 'test', 'symbol': 'XBTUSD', 'price': 9500.5})
+        self.assertEqual((tick['price'], tick.get('symbol'), tick.get('mark')), (9500.5, 'XBTUSD', None))
+        self.assertIs(tick.symbol, sys.intern('XBTUSD'))
+        self.assertIs(copy.deepcopy({'message': tick})['message'], tick)
+        with self.assertRaises(KeyError):
+            tick['mark']
+        with self.assertRaises(AttributeError):
+            tick.mark = 1
+
+    def test_encoding_is_the_same_as_json(self):
+        for value in (9500.5, 1, -0.0, 1e-07, None, True, float('nan'), float('inf'), 'Ω "quoted"', [1, 2]):
+            with self.subTest(value=value):
+                tick = ticks.Tick('2020-05-30T12:00:00.000Z', 'tést', None, 'price', value)
+                self.assertEqual(ticks.encode(tick), json.dumps(dict(tick)))
+                self.assertIs(tick.encode(), tick.encode())
+        self.assertEqual(ticks.encode({'error': 'e'}), '{"error": "e"}')
+        self.assertEqual(ticks.encode('{}'), '{}')
+
+    def test_ticks_are_relayed_as_dicts_through_other_layers(self):
+        frame = json.dumps({'table': 'instrument', 'action': 'update', 'data': [
+            {'symbol': 'XBTUSD', 'lastPrice': 9500.5, 'timestamp': 't'},
+        ]})
+
+        for channel_layer, relayed_type in ((InMemoryChannelLayer(), ticks.Tick), (mock.MagicMock(), dict)):
+            with self.subTest(channel_layer=channel_layer):
+                ws = mock.MagicMock(recv=mock.AsyncMock(side_effect=[frame, EOFError]))
+                with mock.patch.object(channel_layer, 'group_send', mock.AsyncMock()) as group_send, \
+                        mock.patch('orders.consumer.coordinator') as coordinator, \
+                        mock.patch.object(BitmexInstrumentConsumer, 'upstream_throttle', 0):
+                    coordinator.pipeline_keys.return_value = [DEFAULT_KEY]
+                    with self.assertRaises(EOFError):
+                        asyncio.run(BitmexInstrumentConsumer._relay_messages(ws, 'test', channel_layer))
+
+                message = group_send.await_args.args[1]['message']
+                self.assertIs(type(message), relayed_type)
+                self.assertEqual(message, {'timestamp': 't', 'account': 'test', 'symbol': 'XBTUSD', 'price': 9500.5})
+
+
+class SymbolThrottleTest(TestCase):
+
+    def test_messages_are_conflated_per_symbol(self):
+        sent = []
+
+        async def send(group, message, received_at):
+            sent.append((group, dict(message), received_at))
+
+        async def relay():
+            throttle = SymbolThrottle(0.05, send)
+            await throttle.relay('prices', {'symbol': 'XBTUSD', 'price': 1}, 1.0)
+            await throttle.relay('prices', {'symbol': 'ETHUSD', 'price': 10}, 1.0)
+            await throttle.relay('prices', {'symbol': 'XBTUSD', 'price': 2}, 2.0)
+            await throttle.relay('prices', {'symbol': 'XBTUSD', 'mark': 3}, 3.0)
+            await throttle.relay('prices', {'status': 400, 'error': 'e'}, 3.0)
+            self.assertEqual(len(sent), 3)
+            await asyncio.sleep(0.1)
+            throttle.close()
+            return throttle
+
+        throttle = asyncio.run(relay())
+
+        self.assertEqual(sent, [
+            ('prices', {'symbol': 'XBTUSD', 'price': 1}, 1.0),
+            ('prices', {'symbol': 'ETHUSD', 'price': 10}, 1.0),
+            ('prices', {'status': 400, 'error': 'e'}, 3.0),
+            ('prices', {'symbol': 'XBTUSD', 'price': 2, 'mark': 3}, 3.0),
+        ])
+        self.assertEqual(throttle.conflated, 1)
+
+    def test_depth_is_not_delayed_by_instruments(self):
+        upstream = [
+            json.dumps({'table': 'instrument', 'action': 'update', 'data': [{'symbol': 'XBTUSD', 'lastPrice': 1}]}),
+            json.dumps(OrderBookTest.partial),
+        ]
+        ws = mock.MagicMock(recv=mock.AsyncMock(side_effect=[*upstream, EOFError]))
+        channel_layer = mock.MagicMock(group_send=mock.AsyncMock())
+
+        with mock.patch('orders.consumer.coordinator') as coordinator, \
+                mock.patch.object(BitmexInstrumentConsumer, 'upstream_throttle', 3600), \
+                self.assertRaises(EOFError):
+            coordinator.pipeline_keys.return_value = [DEFAULT_KEY]
+            asyncio.run(asyncio.wait_for(BitmexInstrumentConsumer._relay_messages(ws, 'test', channel_layer), 1))
+        orderbook.books.clear()
+
+        self.assertEqual([call.args[1]['type'] for call in channel_layer.group_send.await_args_list],
+                         ['send_message', 'send_depth'])
+
+
+class SigningTest(TestCase):
+    ws_url = 'wss://testnet.bitmex.com/realtime?subscribe=instrument'
+
+    def setUp(self) -> None:
+        self.account = Account.objects.create(
+            name='test',
+            api_key='test api key',
+            api_secret='test secret key',
+        )
+        self.service = SigningService(lifetime=300, refresh_margin=60)
+
+    def test_signature_is_compatible_with_bitmex(self):
+        signer = Signer(self.account.api_key, self.account.api_secret)
+        authenticator = APIKeyAuthenticator('host', self.account.api_key, self.account.api_secret)
+
+        for _ in range(2):
+            self.assertEqual(
+                signer.sign('post', '/api/v1/order?x=1', 1518064236, '{"symbol":"XBTUSD"}'),
+                authenticator.generate_signature(
+                    self.account.api_secret, 'POST', '/api/v1/order?x=1', 1518064236, '{"symbol":"XBTUSD"}',
+                ),
+            )
+
+    def test_cached_signer_authenticator_signs_as_bitmex(self):
+        signer = Signer(self.account.api_key, self.account.api_secret)
+        requests = [
+            Request('POST', 'https://testnet.bitmex.com/api/v1/order?x=1', data='{"symbol":"XBTUSD"}')
+            for _ in range(2)
+        ]
+        with mock.patch('time.time', return_value=1518064231):
+            CachedSignerAuthenticator('host', signer).apply(requests[0])
+            APIKeyAuthenticator('host', self.account.api_key, self.account.api_secret).apply(requests[1])
+
+        self.assertEqual(requests[0].headers, requests[1].headers)
+
+    def test_ws_auth_headers_are_reused_without_db(self):
+        self.service.warm()
+
+        with self.assertNumQueries(0):
+            headers = asyncio.run(self.service.get_ws_auth_headers('test', self.ws_url))
+            self.assertIs(asyncio.run(self.service.get_ws_auth_headers('test', self.ws_url)), headers)
+
+        headers = dict(headers)
+        self.assertEqual(headers['api-key'], self.account.api_key)
+        self.assertEqual(
+            headers['api-signature'],
+            Signer(self.account.api_key, self.account.api_secret).sign(
+                'GET', '/realtime', int(headers['api-expires']),
+            ),
+        )
+
+    def test_expiring_headers_are_refreshed(self):
+        self.service.warm()
+        with mock.patch('orders.signing.time.time', return_value=1000):
+            headers = dict(asyncio.run(self.service.get_ws_auth_headers('test', self.ws_url)))
+        with mock.patch('orders.signing.time.time', return_value=1000 + 300 - 30):
+            self.assertEqual(self.service.refresh_expiring(), 1)
+            refreshed = dict(asyncio.run(self.service.get_ws_auth_headers('test', self.ws_url)))
+
+        self.assertEqual(int(headers['api-expires']), 1300)
+        self.assertEqual(int(refreshed['api-expires']), 1000 + 300 - 30 + 300)
+
+    def test_changed_account_is_forgotten(self):
+        signer = self.service.signer_for(self.account)
+        self.assertIs(self.service.signer_for(self.account), signer)
+
+        self.account.api_secret = 'new secret key'
+        self.assertIsNot(self.service.signer_for(self.account), signer)
+
+        with mock.patch('orders.signing.service', self.service):
+            self.account.save()
+        self.assertNotIn(self.account.name, self.service._signers)
+
+
+class DatabaseExecutorTest(TestCase):
+
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def test_run_in_pool(self):
+        executor = DatabaseExecutor(max_workers=2)
+        seen = []
+
+        def call(value):
+            seen.append((value, executor.active))
+            return value * 2
+
+        async def run_calls():
+            return await asyncio.gather(*(executor.run(call, value) for value in range(4)))
+
+        with mock.patch.object(metrics, 'ENABLED', True):
+            self.assertEqual(asyncio.run(run_calls()), [0, 2, 4, 6])
+
+        self.assertEqual(sorted(value for value, _ in seen), [0, 1, 2, 3])
+        self.assertTrue(all(1 <= active <= 2 for _, active in seen))
+        self.assertEqual((executor.queued, executor.active), (0, 0))
+        self.assertEqual(metrics.gauges[('db_executor_queued', ())].value, 0)
+        self.assertEqual(metrics.histograms[('db_executor_wait_seconds', ())].count, 4)
+
+    def test_counters_do_not_drift(self):
+        executor = DatabaseExecutor(max_workers=8)
+
+        async def run_calls():
+            await asyncio.gather(*(executor.run(lambda: None) for _ in range(500)))
+
+        with mock.patch.object(metrics, 'ENABLED', True):
+            asyncio.run(run_calls())
+
+        self.assertEqual((executor.queued, executor.active), (0, 0))
+        self.assertEqual(metrics.gauges[('db_executor_active', ())].value, 0)
+
+
+class PositionsTest(BaseViewTest):
+
+    def _create_order(self, order_id: str, side: str, filled_volume: int, avg_price: float, **kwargs) -> Order:
+        order = Order.objects.create(**{
+            'order_id': order_id,
+            'symbol': 'XBTUSD',
+            'volume': filled_volume,
+            'side': side,
+            'account': self.account,
+            'status': OrderStatus.FILLED,
+            'filled_volume': filled_volume,
+            'avg_price': avg_price,
+            **kwargs,
+        })
+        return order
+
+    def _create_fills(self) -> None:
+        self._create_order('1', Side.BUY, 10, 100.0)
+        self._create_order('2', Side.BUY, 30, 120.0)
+        self._create_order('3', Side.SELL, 20, 130.0)
+        self._create_order('4', Side.BUY, 0, None, status=OrderStatus.NEW)
+        self._create_order('5', Side.SELL, 5, 50.0, symbol='ETHUSD')
+
+    @override_settings(INVERSE_SYMBOLS=[])
+    @mock.patch('orders.prices.last_prices', {'XBTUSD': (140.0, None)})
+    def test_get_positions(self):
+        self._create_fills()
+
+        response = self.client.get(reverse('positions'), {'account': self.account.name})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [
+            {'symbol': 'ETHUSD', 'net_volume': -5, 'buy_volume': 0, 'sell_volume': 5, 'buy_vwap': None,
+             'sell_vwap': 50.0, 'break_even_price': 50.0, 'mark_price': None, 'pnl': None},
+            # 10 * 100 + 30 * 120 - 20 * 130 = 2000 for the net 20
+            {'symbol': 'XBTUSD', 'net_volume': 20, 'buy_volume': 40, 'sell_volume': 20, 'buy_vwap': 115.0,
+             'sell_vwap': 130.0, 'break_even_price': 100.0, 'mark_price': 140.0, 'pnl': 800.0},
+        ])
+
+    @override_settings(INVERSE_SYMBOLS=[])
+    def test_get_positions_closed(self):
+        self._create_order('1', Side.BUY, 10, 100.0)
+        self._create_order('2', Side.SELL, 10, 110.0)
+
+        self.assertEqual(get_positions(self.account)[0]['pnl'], 100.0)
+
+    @override_settings(INVERSE_SYMBOLS=['XBTUSD'])
+    def test_get_positions_inverse(self):
+        self._create_order('1', Side.BUY, 20, 100.0)
+        self._create_order('2', Side.SELL, 10, 125.0)
+
+        [position] = get_positions(self.account, mark_prices={'XBTUSD': 200.0})
+
+        # 20 / 100 - 10 / 125 - 10 / 200 XBT, i.e. 10 * (1 / 100 - 1 / 200) + 10 * (1 / 100 - 1 / 125)
+        self.assertAlmostEqual(position['pnl'], 0.07)
+        self.assertAlmostEqual(position['break_even_price'], 1 / 0.012)
+        self.assertEqual(position['mark_price'], 200.0)
+
+    @mock.patch('orders.prices.last_prices', {'XBTUSD': (140.0, None)})
+    def test_get_positions_marked_to_prices_of_other_worker(self):
+        self._create_order('1', Side.BUY, 10, 100.0)
+
+        with mock.patch('orders.views.coordinator') as coordinator:
+            coordinator.owns.return_value = False
+            coordinator.fetch_prices = mock.AsyncMock(return_value={'XBTUSD': 200.0})
+            response = self.client.get(reverse('positions'), {'account': self.account.name})
+
+        self.assertEqual(response.data[0]['mark_price'], 200.0)
+        coordinator.fetch_prices.assert_awaited_once_with(self.account.name, timeout=mock.ANY)
+
+    def test_get_positions_account_not_found(self):
+        response = self.client.get(reverse('positions'), {'account': 'unknown'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(POSITIONS_MATERIALIZED=True)
+    @mock.patch('orders.prices.last_prices', {'XBTUSD': (140.0, None)})
+    def test_materialized_positions(self):
+        self._create_fills()
+        with override_settings(POSITIONS_MATERIALIZED=False):
+            aggregated = get_positions(self.account)
+        self.assertEqual(get_positions(self.account), [])
+
+        rebuild_positions(self.account)
+
+        self.assertEqual(Position.objects.filter(account=self.account).count(), 2)
+        self.assertEqual(get_positions(self.account), aggregated)
+
+    @override_settings(POSITIONS_MATERIALIZED=True)
+    @mock.patch('orders.exchange.bitmex')
+    def test_materialized_position_updated_on_amend(self, mock_bitmex):
+        order = self._create_order('1', Side.BUY, 0, None, status=OrderStatus.NEW, volume=10)
+        mock_bitmex.return_value.Order.Order_amend.return_value.result.return_value = ({
+            'orderID': '1', 'orderQty': 10, 'price': 101.0,
+            'ordStatus': 'PartiallyFilled', 'cumQty': 4, 'avgPx': 100.0,
+        }, mock.MagicMock())
+
+        response = self.client.patch(
+            f'{reverse("order-detail", kwargs={"order_id": order.order_id})}?account={self.account.name}',
+            data={'price': 101.0},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        position = Position.objects.get(account=self.account, symbol='XBTUSD')
+        self.assertEqual((position.buy_volume, position.buy_notional), (4, 400.0))
+
+    @override_settings(POSITIONS_MATERIALIZED=True, INVERSE_SYMBOLS=[])
+    @mock.patch('orders.exchange.bitmex')
+    def test_materialized_position_updated_on_delete(self, _):
+        self._create_fills()
+        rebuild_positions(self.account)
+
+        response = self.client.delete(
+            f'{reverse("order-detail", kwargs={"order_id": "2"})}?account={self.account.name}',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        materialized = get_positions(self.account)
+        with override_settings(POSITIONS_MATERIALIZED=False):
+            self.assertEqual(materialized, get_positions(self.account))
+        self.assertEqual(materialized[1]['buy_volume'], 10)
+
+
+class HashRingTest(TestCase):
+
+    def test_owner_is_stable_and_only_moved_keys_change(self):
+        accounts = [f'account-{number}' for number in range(1000)]
+        ring = HashRing(['worker-1', 'worker-2', 'worker-3'])
+        before = {account: ring.owner(account) for account in accounts}
+
+        self.assertEqual(set(before.values()), {'worker-1', 'worker-2', 'worker-3'})
+        self.assertTrue(all(list(before.values()).count(worker) > 200 for worker in ring.workers))
+
+        ring.add('worker-4')
+        after = {account: ring.owner(account) for account in accounts}
+        moved = [account for account in accounts if before[account] != after[account]]
+        self.assertTrue(all(after[account] == 'worker-4' for account in moved))
+        self.assertLess(len(moved), 400)
+
+        ring.remove('worker-4')
+        self.assertEqual({account: ring.owner(account) for account in accounts}, before)
+
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing().owner('test'))
+
+
+class FeedCoordinatorTest(TestCase):
+
+    def _coordinator(self, worker_id: str = 'worker-1') -> FeedCoordinator:
+        self.started = []
+
+        async def run_feed(account_name):
+            self.started.append(account_name)
+            await asyncio.sleep(3600)
+
+        return FeedCoordinator(worker_id=worker_id, run_feed=run_feed, heartbeat_interval=3600)
+
+    def test_concurrent_subscribers_start_one_feed(self):
+        coordinator = self._coordinator()
+
+        async def subscribe():
+            await asyncio.gather(*(coordinator.subscribe('test', DEFAULT_KEY) for _ in range(5)))
+            await asyncio.sleep(0)
+            return coordinator.status()
+
+        feed_status = asyncio.run(subscribe())
+
+        self.assertEqual(self.started, ['test'])
+        self.assertEqual(feed_status['feeds'], ['test'])
+        self.assertEqual(feed_status['subscribers'], {'test': 5})
+
+    def test_batch_subscribe_announces_demand_once(self):
+        coordinator = self._coordinator()
+
+        async def subscribe():
+            with mock.patch.object(coordinator, '_announce', mock.AsyncMock()) as announce:
+                await coordinator.subscribe('first', DEFAULT_KEY)
+                await coordinator.subscribe_many(['first', 'second', 'third'], DEFAULT_KEY)
+            await asyncio.sleep(0)
+            return announce
+
+        announce = asyncio.run(subscribe())
+
+        self.assertEqual(announce.await_args_list, [mock.call(['first']), mock.call(['second', 'third'])])
+        self.assertEqual(coordinator.status()['subscribers'], {'first': 2, 'second': 1, 'third': 1})
+        self.assertEqual(sorted(self.started), ['first', 'second', 'third'])
+
+    def test_feeds_move_to_joined_worker(self):
+        coordinator = self._coordinator()
+        accounts = [f'account-{number}' for number in range(20)]
+
+        async def join():
+            for account_name in accounts:
+                coordinator._on_demand(account_name, [DEFAULT_KEY])
+            await coordinator.handle({'type': 'feed.heartbeat', 'worker': 'worker-2'})
+            return set(coordinator.feeds)
+
+        with mock.patch.object(coordinator, '_heartbeat', mock.AsyncMock()), \
+                mock.patch.object(coordinator, '_announce', mock.AsyncMock()):
+            feeds = asyncio.run(join())
+
+        self.assertEqual(feeds, {account for account in accounts if coordinator.ring.owner(account) == 'worker-1'})
+        self.assertTrue(0 < len(feeds) < len(accounts))
+
+    def test_gone_worker_feeds_are_taken_over(self):
+        coordinator = self._coordinator()
+        coordinator.ring.add('worker-2')
+        coordinator.workers['worker-2'] = coordinator.workers['worker-1'] - coordinator.worker_timeout - 1
+        account_name = next(
+            f'account-{number}' for number in range(100)
+            if coordinator.ring.owner(f'account-{number}') == 'worker-2'
+        )
+
+        async def take_over():
+            coordinator.subscribers[account_name] = {DEFAULT_KEY: 1}
+            coordinator.rebalance()
+            return set(coordinator.feeds)
+
+        self.assertEqual(asyncio.run(take_over()), {account_name})
+        self.assertEqual(coordinator.status()['workers'], ['worker-1'])
+
+    def test_pinned_accounts_are_relayed_without_subscribers(self):
+        coordinator = self._coordinator()
+
+        async def pin():
+            coordinator.pinned = {'test'}
+            coordinator.rebalance()
+            coordinator.pinned = set()
+            return set(coordinator.feeds)
+
+        self.assertEqual(asyncio.run(pin()), {'test'})
+        self.assertIn('test', coordinator.status()['assignments'])
+
+
+class AlertBookTest(TestCase):
+
+    @staticmethod
+    def _alert(alert_id: int, type: str, value: float) -> Alert:
+        return Alert(alert_id, 'test', 'XBTUSD', type, value)
+
+    def test_thresholds(self):
+        book = AlertBook()
+        for alert_id, (type, value) in enumerate([
+            (AlertType.ABOVE, 110), (AlertType.ABOVE, 120), (AlertType.BELOW, 90), (AlertType.BELOW, 80),
+        ]):
+            book.add(self._alert(alert_id, type, value))
+
+        self.assertEqual(book.trigger(100), [])
+        self.assertEqual([alert.id for alert in book.trigger(115)], [0])
+        self.assertEqual(sorted(alert.id for alert in book.trigger(79)), [2, 3])
+        self.assertEqual(len(book), 1)
+
+    def test_cross_and_move_are_placed_on_the_first_price(self):
+        book = AlertBook()
+        cross = self._alert(1, AlertType.CROSS, 100)
+        move = self._alert(2, AlertType.MOVE, 10)
+        book.add(cross)
+        book.add(move)
+
+        self.assertEqual(book.trigger(105), [])
+        self.assertEqual(book.trigger(100), [cross])
+        # 10% down from 105
+        self.assertEqual(book.trigger(94.4), [move])
+        self.assertEqual(len(book), 0)
+        self.assertEqual(book.levels, {'up': [], 'down': []})
+
+    def test_removed_alert_does_not_fire(self):
+        book = AlertBook()
+        alerts = [self._alert(alert_id, AlertType.ABOVE, 110) for alert_id in range(3)]
+        for alert in alerts:
+            book.add(alert)
+        book.remove(alerts[1])
+
+        self.assertEqual(book.trigger(110), [alerts[0], alerts[2]])
+
+    def test_many_alerts(self):
+        book = AlertBook()
+        for alert_id in range(10000):
+            book.add(self._alert(alert_id, AlertType.ABOVE, 1000 + alert_id))
+
+        self.assertEqual(book.trigger(999), [])
+        self.assertEqual(len(book.trigger(1009.5)), 10)
+        self.assertEqual(len(book), 9990)
+
+
+class AlertEngineTest(TestCase):
+
+    def setUp(self) -> None:
+        self.coordinator = mock.MagicMock(subscribe=mock.AsyncMock())
+        self.engine = AlertEngine(self.coordinator)
+
+    def test_fired_alert_is_delivered_to_consumer(self):
+        channel_layer = mock.MagicMock(new_channel=mock.AsyncMock(return_value='alerts!1'),
+                                       group_add=mock.AsyncMock(), group_discard=mock.AsyncMock(),
+                                       send=mock.AsyncMock(), receive=mock.AsyncMock(side_effect=asyncio.Future))
+
+        async def fire():
+            await self.engine.add('test', 'XBTUSD', AlertType.ABOVE, 110, target='consumer!1')
+            self.assertEqual(self.engine.on_tick('test', 'XBTUSD', 100), [])
+            fired = self.engine.on_tick('test', 'XBTUSD', 111)
+            await self.engine.deliver(fired[0], 111, 't')
+            self.engine._listener.cancel()
+
+        with mock.patch('orders.alerts.get_channel_layer', return_value=channel_layer):
+            asyncio.run(fire())
+
+        self.coordinator.subscribe.assert_awaited_once_with('test', DEFAULT_KEY)
+        self.coordinator.unsubscribe.assert_called_once_with('test', DEFAULT_KEY)
+        channel_layer.send.assert_awaited_once_with('consumer!1', {'type': 'send_alert', 'alert': {
+            'alert': 1, 'account': 'test', 'symbol': 'XBTUSD', 'type': 'above', 'value': 110,
+            'price': 111, 'timestamp': 't',
+        }})
+        self.assertEqual(self.engine.alerts, {})
+
+    def test_invalid_alerts(self):
+        for kwargs in ({'type': 'unknown', 'value': 1}, {'type': AlertType.ABOVE, 'value': -1},
+                       {'type': AlertType.ABOVE, 'value': 1, 'webhook': 'ftp://host'}):
+            with self.subTest(kwargs=kwargs), self.assertRaises(AlertError):
+                asyncio.run(self.engine.add('test', 'XBTUSD', **kwargs))
+
+    @override_settings(ALERT_WEBHOOK_HOSTS=['hooks.example.com', 'https://example.com/alerts/'])
+    def test_webhook_allowlist(self):
+        for url, allowed in (('https://hooks.example.com/x', True), ('https://example.com/alerts/1', True),
+                             ('https://example.com/admin', False), ('https://example.com.evil.net/alerts/', False),
+                             ('http://example.com/alerts/1', False), ('https://user@hooks.example.com/', False),
+                             ('http://169.254.169.254/latest/meta-data/', False), ('ftp://hooks.example.com', False)):
+            with self.subTest(url=url):
+                if allowed:
+                    self.assertEqual(check_webhook(url), urlparse.urlsplit(url).hostname)
+                else:
+                    with self.assertRaises(AlertError):
+                        check_webhook(url)
+
+        with override_settings(ALERT_WEBHOOK_HOSTS=[]), self.assertRaises(AlertError):
+            check_webhook('https://hooks.example.com/x')
+
+    @override_settings(ALERT_WEBHOOK_HOSTS=['hooks.example.com'])
+    def test_webhook_resolving_to_private_address(self):
+        for address in ('127.0.0.1', '10.0.0.5', '169.254.169.254', '::1', 'fe80::1%eth0'):
+            addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 0))]
+            getaddrinfo = mock.AsyncMock(return_value=addresses)
+            with self.subTest(address=address), \
+                    mock.patch('asyncio.base_events.BaseEventLoop.getaddrinfo', getaddrinfo), \
+                    self.assertRaises(AlertError):
+                asyncio.run(self.engine.add('test', 'XBTUSD', AlertType.ABOVE, 1, webhook='https://hooks.example.com/'))
+
+        with mock.patch('orders.alerts.socket.getaddrinfo', return_value=addresses), \
+                mock.patch('orders.alerts.requests.post') as mock_post:
+            _post_webhook_('https://hooks.example.com/', {'alert': 1})
+        mock_post.assert_not_called()
+
+
+class ConditionalOrderTest(BaseViewTest):
+
+    def _conditional_order(self, **kwargs) -> ConditionalOrder:
+        return ConditionalOrder.objects.create(**{
+            'account': self.account, 'symbol': 'XBTUSD', 'side': Side.SELL, 'volume': 2,
+            'kind': ConditionalOrderKind.STOP, 'trigger_price': 9000, **kwargs,
+        })
+
+    def test_trigger_direction(self):
+        for side, kind, fires_above in ((Side.BUY, ConditionalOrderKind.STOP, True),
+                                        (Side.SELL, ConditionalOrderKind.STOP, False),
+                                        (Side.BUY, ConditionalOrderKind.TAKE_PROFIT, False),
+                                        (Side.SELL, ConditionalOrderKind.TAKE_PROFIT, True)):
+            with self.subTest(side=side, kind=kind):
+                self.assertEqual(ConditionalOrder(side=side, kind=kind).fires_above, fires_above)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_fire_places_market_order_once(self, mock_bitmex):
+        mock_bitmex.return_value.Order.Order_new.return_value.result.return_value = (
+            {'orderID': 'stop-1', 'price': 8990.0, 'ordStatus': 'Filled', 'cumQty': 2, 'avgPx': 8990.0},
+            mock.MagicMock(),
+        )
+        conditional_order = self._conditional_order()
+
+        fired = fire(conditional_order.id, 8995)
+
+        self.assertEqual(fired.status, ConditionalOrderStatus.TRIGGERED)
+        self.assertEqual(fired.triggered_price, 8995)
+        self.assertEqual(fired.order.order_id, 'stop-1')
+        self.assertEqual(fired.order.status, OrderStatus.FILLED)
+        mock_bitmex.return_value.Order.Order_new.assert_called_once_with(
+            symbol='XBTUSD', orderQty=2, side=Side.SELL, ordType='Market',
+        )
+        self.assertIsNone(fire(conditional_order.id, 8990))
+        self.assertEqual(Order.objects.count(), 1)
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_rejected_order_fails(self, mock_bitmex):
+        mock_bitmex.return_value.Order.Order_new.return_value.result.side_effect = HTTPBadRequest(mock.MagicMock())
+        conditional_order = self._conditional_order()
+
+        fired = fire(conditional_order.id, 8995)
+
+        self.assertEqual(fired.status, ConditionalOrderStatus.FAILED)
+        self.assertTrue(fired.error)
+        self.assertFalse(Order.objects.exists())
+
+    @mock.patch('orders.exchange.bitmex')
+    def test_response_without_order_id_fails(self, mock_bitmex):
+        mock_bitmex.return_value.Order.Order_new.return_value.result.return_value = (
+            {'ordStatus': 'New'}, mock.MagicMock(),
+        )
+        conditional_order = self._conditional_order()
+
+        fire(conditional_order.id, 8995)
+
+        conditional_order.refresh_from_db()
+        self.assertEqual(conditional_order.status, ConditionalOrderStatus.FAILED)
+        self.assertIn('orderID', conditional_order.error)
+        self.assertIsNone(conditional_order.order)
+        self.assertFalse(Order.objects.exists())
+
+    def test_trigger_fires_reached_orders_on_relayed_rows(self):
+        stop = self._conditional_order()
+        take_profit = self._conditional_order(kind=ConditionalOrderKind.TAKE_PROFIT, trigger_price=9500)
+        self._conditional_order(status=ConditionalOrderStatus.CANCELED, trigger_price=9100)
+        trigger = ConditionalOrderTrigger(self.account.name)
+        with mock.patch('orders.exchange.bitmex'):
+            books = load_books(self.account.name)
+
+        async def run_in_pool(func, *args):
+            return func(*args)
+
+        async def never_answered(**kwargs):
+            await asyncio.Future()
+
+        # the books are not reloaded while the trigger is not listening to the changes
+        channel_layer = mock.MagicMock(new_channel=never_answered)
+
+        async def relay():
+            trigger.replace_books(books)
+            trigger.on_rows([{'symbol': 'XBTUSD', 'lastPrice': 9200}, {'symbol': 'ETHUSD', 'lastPrice': 1}])
+            trigger.on_rows([{'symbol': 'XBTUSD', 'lastPrice': 8999}])
+            trigger.on_rows([{'symbol': 'XBTUSD', 'lastPrice': 8000}])
+            await asyncio.sleep(0)
+
+        with mock.patch('orders.conditional._run_in_pool_', run_in_pool), \
+                mock.patch('orders.conditional.get_channel_layer', return_value=channel_layer), \
+                mock.patch('orders.conditional.fire') as mock_fire:
+            asyncio.run(relay())
+
+        mock_fire.assert_called_once_with(stop.id, 8999)
+        self.assertEqual(trigger.firing, {stop.id})
+        self.assertEqual(len(trigger.books['XBTUSD']), 1)
+        self.assertEqual(trigger.books['XBTUSD'].alerts['up'][0].id, take_profit.id)
+
+    def test_trigger_reloads_only_changed_orders(self):
+        trigger = ConditionalOrderTrigger(self.account.name)
+        channel_layer = InMemoryChannelLayer()
+
+        async def run_in_pool(func, *args):
+            return func(*args)
+
+        async def relay():
+            for _ in range(5):
+                trigger.on_rows([{'symbol': 'XBTUSD', 'lastPrice': 9200}])
+                await asyncio.sleep(0.01)
+            loaded = mock_load_books.call_count
+            await channel_layer.group_send(conditional.group(self.account.name), {'type': 'conditional.changed'})
+            await asyncio.sleep(0.01)
+            trigger.on_rows([{'symbol': 'XBTUSD', 'lastPrice': 9200}])
+            await asyncio.sleep(0.01)
+            trigger.close()
+            return loaded
+
+        with mock.patch('orders.conditional._run_in_pool_', run_in_pool), \
+                mock.patch('orders.conditional.get_channel_layer', return_value=channel_layer), \
+                mock.patch('orders.conditional.load_books', return_value={}) as mock_load_books:
+            loaded = asyncio.run(relay())
+
+        # once listening to the changes, then once per change
+        self.assertEqual(loaded, 1)
+        self.assertEqual(mock_load_books.call_count, 2)
+
+    def test_changes_are_notified(self):
+        url = _add_query_parameters_to_url(reverse('conditional-orders'), {'account': self.account_name})
+        with mock.patch('orders.conditional.notify_changed') as mock_notify:
+            response = self.client.post(url, data={
+                'symbol': 'XBTUSD', 'side': 'Buy', 'volume': 1, 'kind': 'Stop', 'trigger_price': 9500,
+            }, format='json')
+            self.client.delete(_add_query_parameters_to_url(
+                reverse('conditional-order-detail', kwargs={'pk': response.data['id']}), {'account': self.account_name},
+            ))
+
+        self.assertEqual(mock_notify.call_args_list, [mock.call(self.account_name)] * 2)
+
+    def test_create_and_list(self):
+        url = _add_query_parameters_to_url(reverse('conditional-orders'), {'account': self.account_name})
+        response = self.client.post(url, data={
+            'symbol': 'XBTUSD', 'side': 'Buy', 'volume': 1, 'kind': 'Stop', 'trigger_price': 9500,
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], ConditionalOrderStatus.PENDING)
+        self.assertEqual(response.data['account'], self.account_name)
+        self.assertIsNone(response.data['order'])
+
+        response = self.client.get(reverse('conditional-orders'), {'account': self.account_name, 'status': 'Pending'})
+        self.assertEqual([item['trigger_price'] for item in response.data], [9500])
+
+    def test_create_invalid(self):
+        url = _add_query_parameters_to_url(reverse('conditional-orders'), {'account': self.account_name})
+        response = self.client.post(url, data={
+            'symbol': 'XBTUSD', 'side': 'Buy', 'volume': 1, 'kind': 'Limit', 'trigger_price': -1,
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {'kind', 'trigger_price'})
+
+    def test_cancel_only_pending(self):
+        pending = self._conditional_order()
+        triggered = self._conditional_order(status=ConditionalOrderStatus.TRIGGERED)
+
+        response = self.client.delete(_add_query_parameters_to_url(
+            reverse('conditional-order-detail', kwargs={'pk': pending.id}), {'account': self.account_name},
+        ))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, ConditionalOrderStatus.CANCELED)
+
+        response = self.client.delete(_add_query_parameters_to_url(
+            reverse('conditional-order-detail', kwargs={'pk': triggered.id}), {'account': self.account_name},
+        ))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn('error', response.data)
+
+
+class SingleFlightTest(TestCase):
+
+    def test_concurrent_identical_calls_share_one_call(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ['order']
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do(('test', 'get'), call)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flight.do(('test', 'get'), call)))
+                     for _ in range(4)]
+        for follower in followers:
+            follower.start()
+        # followers are waiting for the leader call
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['order']] * 5)
+        # nothing is reused without the reuse window
+        flight.do(('test', 'get'), call)
+        self.assertEqual(len(calls), 2)
+
+    def test_errors_are_not_reused(self):
+        flight = SingleFlight(reuse=60)
+
+        with self.assertRaises(HTTPNotFound):
+            flight.do(('test', 'get'), mock.Mock(side_effect=HTTPNotFound(mock.MagicMock())))
+        self.assertEqual(flight.do(('test', 'get'), lambda: 'order'), 'order')
+
+    def test_reused_result_is_forgotten_on_write(self):
+        flight = SingleFlight(reuse=60)
+        call = mock.Mock(side_effect=['old', 'new'])
+
+        self.assertEqual(flight.do(('test', 'get'), call), 'old')
+        self.assertEqual(flight.do(('test', 'get'), call), 'old')
+        flight.forget('another')
+        self.assertEqual(flight.do(('test', 'get'), call), 'old')
+        flight.forget('test')
+        self.assertEqual(flight.do(('test', 'get'), call), 'new')
+
+    @mock.patch('orders.exchange.get_client')
+    def test_orders_of_changed_secret_are_not_reused(self, mock_get_client):
+        mock_get_client.return_value.Order.Order_getOrders.return_value.result.side_effect = [
+            (['old'], mock.MagicMock()), (['new'], mock.MagicMock()),
+        ]
+        account = Account(name='test', api_key='key', api_secret='old secret')
+
+        with mock.patch('orders.exchange.reads', SingleFlight(reuse=60)):
+            self.assertEqual(exchange.get_orders(account, '{}'), ['old'])
+            account.api_secret = 'new secret'
+            self.assertEqual(exchange.get_orders(account, '{}'), ['new'])
+
+
+class OrderBookTest(TestCase):
+
+    partial = {
+        'table': 'orderBookL2', 'action': 'partial', 'filter': {'symbol': 'XBTUSD'},
+        'data': [
+            {'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell', 'size': 10, 'price': 101.0},
+            {'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell', 'size': 20, 'price': 100.5},
+            {'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy', 'size': 30, 'price': 100.0},
+            {'symbol': 'XBTUSD', 'id': 4, 'side': 'Buy', 'size': 40, 'price': 99.5},
+        ],
+    }
+
+    def tearDown(self) -> None:
+        orderbook.books.clear()
+
+    def test_levels_are_kept_by_ids(self):
+        book = orderbook.OrderBook('XBTUSD')
+        book.apply('partial', self.partial['data'])
+
+        self.assertEqual(book.top(1), {'bids': [[100.0, 30]], 'asks': [[100.5, 20]]})
+        changes = book.apply('insert', [{'id': 5, 'side': 'Buy', 'size': 5, 'price': 100.25}])
+        self.assertEqual(changes, {'bids': [[100.25, 5]], 'asks': []})
+        book.apply('update', [{'id': 2, 'side': 'Sell', 'size': 25}, {'id': 99, 'side': 'Sell', 'size': 1}])
+        changes = book.apply('delete', [{'id': 1, 'side': 'Sell'}])
+        self.assertEqual(changes, {'bids': [], 'asks': [[101.0, 0]]})
+
+        self.assertEqual(book.top(10), {
+            'bids': [[100.25, 5], [100.0, 30], [99.5, 40]],
+            'asks': [[100.5, 25]],
+        })
+
+    def test_level_moves_to_other_side(self):
+        book = orderbook.OrderBook('XBTUSD')
+        book.apply('partial', self.partial['data'])
+
+        changes = book.apply('update', [{'id': 2, 'side': 'Buy', 'size': 7}])
+
+        self.assertEqual(changes, {'bids': [[100.5, 7]], 'asks': [[100.5, 0]]})
+        self.assertEqual(book.top(1), {'bids': [[100.5, 7]], 'asks': [[101.0, 10]]})
+
+    def test_updates_before_partial_are_skipped(self):
+        update = {'table': 'orderBookL2', 'action': 'update', 'data': [{'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell',
+                                                                        'size': 1}]}
+
+        self.assertEqual(orderbook.apply_message('test', update), [])
+        [partial] = orderbook.apply_message('test', self.partial)
+        self.assertEqual(partial['depth'], 'partial')
+        self.assertEqual(len(partial['asks']), 2)
+        self.assertEqual(orderbook.apply_message('test', update), [{
+            'account': 'test', 'symbol': 'XBTUSD', 'depth': 'update', 'bids': [], 'asks': [[101.0, 1]],
+        }])
+
+        orderbook.reset('test')
+        self.assertIsNone(orderbook.get_book('test', 'XBTUSD'))
+
+    def test_depth_is_relayed_to_symbol_group(self):
+        channel_layer = mock.MagicMock(group_send=mock.AsyncMock())
+
+        asyncio.run(BitmexInstrumentConsumer._relay_depth(self.partial, 'test', channel_layer))
+
+        group, event = channel_layer.group_send.await_args.args
+        self.assertEqual(group, 'test.depth.XBTUSD')
+        self.assertEqual(event['type'], 'send_depth')
+        self.assertEqual(event['depth']['bids'], [[100.0, 30], [99.5, 40]])
+
+    def test_depth_snapshot_is_sent_by_relaying_worker(self):
+        orderbook.apply_message('test', self.partial)
+        channel_layer = mock.MagicMock(group_send=mock.AsyncMock(), send=mock.AsyncMock())
+        owner = FeedCoordinator(worker_id='worker-1', run_feed=mock.AsyncMock())
+        other = FeedCoordinator(worker_id='worker-2', run_feed=mock.AsyncMock())
+        owner.feeds['test'] = mock.MagicMock()
+
+        async def request():
+            await other.request_depth('test', 'XBTUSD', 'consumer!1', levels=1)
+            _, message = channel_layer.group_send.await_args.args
+            await other.handle(message)
+            await owner.handle(message)
+
+        with mock.patch('orders.feeds.get_channel_layer', return_value=channel_layer):
+            asyncio.run(request())
+
+        channel_layer.send.assert_awaited_once_with('consumer!1', {'type': 'send_depth', 'depth': {
+            'account': 'test', 'symbol': 'XBTUSD', 'depth': 'partial', 'bids': [[100.0, 30]], 'asks': [[100.5, 20]],
+        }})
+
+    @mock.patch('orders.prices.last_prices', {'XBTUSD': (100.0, None)})
+    def test_prices_are_sent_by_relaying_worker(self):
+        owner = FeedCoordinator(worker_id='worker-1', run_feed=mock.AsyncMock())
+        other = FeedCoordinator(worker_id='worker-2', run_feed=mock.AsyncMock())
+        owner.feeds['test'] = mock.MagicMock()
+
+        channel_layer = InMemoryChannelLayer()
+
+        async def fetch():
+            await channel_layer.group_add('feed-workers', 'worker!1')
+            task = asyncio.create_task(other.fetch_prices('test', timeout=5))
+            await owner.handle(await channel_layer.receive('worker!1'))
+            return await task
+
+        with mock.patch('orders.feeds.get_channel_layer', return_value=channel_layer):
+            self.assertEqual(asyncio.run(fetch()), {'XBTUSD': 100.0})
+
+    @override_settings(ORDER_BOOK_SYMBOLS=['XBTUSD'])
+    def test_consumer_requests_depth_of_other_worker(self):
+        consumer = BitmexInstrumentConsumer(scope={'type': 'websocket'})
+        consumer.channel_name = 'consumer!1'
+        consumer.channel_layer = mock.MagicMock(group_add=mock.AsyncMock())
+        consumer.send = mock.AsyncMock()
+
+        with mock.patch('orders.consumer.coordinator') as coordinator:
+            coordinator.subscribe, coordinator.request_depth = mock.AsyncMock(), mock.AsyncMock()
+            coordinator.owns.return_value = False
+            asyncio.run(consumer._subscribe_stream('depth', 'test', 'XBTUSD'))
+
+        replies = [json.loads(call.kwargs['text_data']) for call in consumer.send.await_args_list]
+        self.assertEqual(replies[1], {'account': 'test', 'symbol': 'XBTUSD', 'depth': 'pending'})
+        coordinator.request_depth.assert_awaited_once_with('test', 'XBTUSD', 'consumer!1')
+
+
+@override_settings(ORDER_BOOK_SYMBOLS=['XBTUSD'])
+class DepthViewTest(BaseViewTest):
+
+    def tearDown(self) -> None:
+        orderbook.books.clear()
+
+    def test_top_levels(self):
+        orderbook.apply_message(self.account_name, OrderBookTest.partial)
+
+        response = self.client.get(reverse('depth'), {'account': self.account_name, 'symbol': 'XBTUSD', 'levels': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'account': self.account_name, 'symbol': 'XBTUSD', 'bids': [[100.0, 30]], 'asks': [[100.5, 20]],
+        })
+
+    def test_not_kept_book(self):
+        response = self.client.get(reverse('depth'), {'account': self.account_name, 'symbol': 'XBTUSD'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('XBTUSD', response.data['error'])
+
+    def test_invalid_levels(self):
+        response = self.client.get(reverse('depth'), {'account': self.account_name, 'symbol': 'XBTUSD', 'levels': 'x'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(FEED_DEPTH_TIMEOUT=60)
+    def test_unknown_symbol_is_not_waited_for(self):
+        with mock.patch('orders.views.coordinator') as coordinator:
+            coordinator.owns.return_value = False
+            response = self.client.get(reverse('depth'), {'account': self.account_name, 'symbol': 'ETHUSD'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('ETHUSD', response.data['error'])
+        coordinator.fetch_depth.assert_not_called()
+
+
+class TradeTapeTest(TestCase):
+
+    def tearDown(self) -> None:
+        tape.tapes.clear()
+
+    def test_windows_roll(self):
+        trade_tape = tape.TradeTape('XBTUSD')
+        trade_tape.add('Buy', 30, 100.0, traded_at=1000.2)
+        trade_tape.add('Sell', 10, 104.0, traded_at=1000.7)
+        trade_tape.add('Buy', 10, 110.0, traded_at=1030.0)
+
+        summary = trade_tape.summary(now=1030.5)
+        self.assertEqual(summary['1s'], {'volume': 10, 'trades': 1, 'vwap': 110.0, 'imbalance': 1.0})
+        self.assertEqual(summary['1m']['trades'], 3)
+        self.assertEqual(summary['1m']['volume'], 50)
+        self.assertAlmostEqual(summary['1m']['vwap'], (3000 + 1040 + 1100) / 50)
+        self.assertAlmostEqual(summary['1m']['imbalance'], (40 - 10) / 50)
+
+        # the first trades leave the minute window, but not the hour one
+        summary = trade_tape.summary(now=1070.0)
+        self.assertEqual(summary['1s']['trades'], 0)
+        self.assertIsNone(summary['1s']['vwap'])
+        self.assertEqual(summary['1m']['trades'], 1)
+        self.assertEqual(summary['1h']['trades'], 3)
+
+        summary = trade_tape.summary(now=1000 + 3600 * 2)
+        self.assertEqual(summary['1h'], {'volume': 0, 'trades': 0, 'vwap': None, 'imbalance': None})
+
+    def test_late_trades_are_added_to_their_second(self):
+        trade_tape = tape.TradeTape('XBTUSD', windows={'1s': 1, '5s': 5})
+        trade_tape.add('Buy', 1, 100.0, traded_at=10.0)
+        trade_tape.add('Sell', 1, 100.0, traded_at=9.0)
+
+        self.assertFalse(trade_tape.add('Sell', 1, 100.0, traded_at=5.0))
+        self.assertEqual(trade_tape.summary(now=10.0)['1s']['trades'], 1)
+        self.assertEqual(trade_tape.summary(now=10.0)['5s']['trades'], 2)
+        self.assertEqual(trade_tape.summary(now=13.0)['5s']['trades'], 2)
+        self.assertEqual(trade_tape.summary(now=14.0)['5s']['trades'], 1)
+        self.assertEqual(trade_tape.summary(now=15.0)['5s']['trades'], 0)
+
+    def test_trades_are_bucketed_by_their_timestamps(self):
+        # a burst of frames received late after a reconnect
+        tape.add_trades('test', [
+            {'symbol': 'XBTUSD', 'side': 'Buy', 'size': 1, 'price': 100.0, 'timestamp': '1970-01-01T00:01:40.000Z'},
+            {'symbol': 'XBTUSD', 'side': 'Buy', 'size': 2, 'price': 100.0, 'timestamp': '1970-01-01T00:02:50.500Z'},
+            {'symbol': 'XBTUSD', 'side': 'Buy', 'size': 3, 'price': 100.0},
+        ], received_at=171.0)
+
+        [summary] = tape.get_summaries('test', now=171.0)
+        self.assertEqual(summary['tape']['1s']['volume'], 3)
+        self.assertEqual(summary['tape']['1m']['volume'], 5)
+        self.assertEqual(summary['tape']['1h']['volume'], 6)
+
+    def test_summaries_per_account_instrument(self):
+        added = tape.add_trades('test', [
+            {'symbol': 'XBTUSD', 'side': 'Buy', 'size': 1, 'price': 100.0},
+            {'symbol': 'ETHUSD', 'side': 'Sell', 'size': 2, 'price': 10.0},
+            {'symbol': 'ETHUSD', 'side': 'Sell'},
+        ], received_at=100.0)
+        tape.add_trades('another', [{'symbol': 'XBTUSD', 'side': 'Buy', 'size': 1, 'price': 100.0}], 100.0)
+
+        summaries = tape.get_summaries('test', now=100.0)
+        self.assertEqual(added, 2)
+        self.assertEqual({summary['symbol'] for summary in summaries}, {'XBTUSD', 'ETHUSD'})
+        self.assertEqual(tape.group('test', 'XBTUSD'), 'test.tape.XBTUSD')
+
+    def test_partial_trades_are_skipped(self):
+        trades = [{'symbol': 'XBTUSD', 'side': 'Buy', 'size': 1, 'price': 100.0}]
+
+        self.assertEqual(tape.add_trades('test', trades * 3, 100.0, action='partial'), 0)
+        self.assertEqual(tape.add_trades('test', trades, 100.0, action='insert'), 1)
+
+        [summary] = tape.get_summaries('test', now=100.0)
+        self.assertEqual(summary['tape']['1h']['trades'], 1)
+
+    @override_settings(TRADE_TAPE_SYMBOLS=['XBTUSD'])
+    def test_consumer_subscribes_to_tape(self):
+        consumer = BitmexInstrumentConsumer(scope={'type': 'websocket'})
+        consumer.channel_name = 'consumer!1'
+        consumer.channel_layer = mock.MagicMock(group_add=mock.AsyncMock(), group_discard=mock.AsyncMock())
+        consumer.send = mock.AsyncMock()
+
+        async def subscribe():
+            await consumer._subscribe_stream('tape', 'test', 'ETHUSD')
+            await consumer._subscribe_stream('tape', 'test', 'XBTUSD')
+            await consumer._unsubscribe_stream('tape', 'test', 'XBTUSD')
+
+        with mock.patch('orders.consumer.coordinator') as coordinator:
+            coordinator.subscribe = mock.AsyncMock()
+            asyncio.run(subscribe())
+
+        replies = [json.loads(call.kwargs['text_data']) for call in consumer.send.await_args_list]
+        self.assertEqual(replies[0]['status'], 400)
+        self.assertEqual(replies[1], {'success': True, 'subscribe': 'tape', 'account': 'test', 'symbol': 'XBTUSD'})
+        self.assertEqual(replies[2]['unsubscribe'], 'tape')
+        consumer.channel_layer.group_add.assert_awaited_once_with('test.tape.XBTUSD', 'consumer!1')
+        coordinator.unsubscribe.assert_called_once_with('test', DEFAULT_KEY)
+
+
+class FramesTest(TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'test.frames')
+
+    def test_frames_are_appended_and_read_back(self):
+        with frames.FrameWriter(self.path) as writer:
+            writer.write('{"table": "instrument"}', received_at=10.0)
+        with frames.FrameWriter(self.path) as writer:
+            writer.write(b'{"table": "trade"}', received_at=10.5)
+        # a truncated record of a killed recorder
+        with open(self.path, 'ab') as file:
+            file.write(frames.RECORD.pack(11.0, 100) + b'{"tab')
+
+        self.assertEqual(list(frames.read_frames(self.path)), [
+            (10.0, '{"table": "instrument"}'),
+            (10.5, '{"table": "trade"}'),
+        ])
+
+    def test_truncated_record_is_dropped_on_append(self):
+        with frames.FrameWriter(self.path) as writer:
+            writer.write('{"table": "instrument"}', received_at=10.0)
+        with open(self.path, 'ab') as file:
+            file.write(frames.RECORD.pack(11.0, 100) + b'{"tab')
+        with frames.FrameWriter(self.path) as writer:
+            writer.write('{"table": "trade"}', received_at=12.0)
+
+        self.assertEqual(list(frames.read_frames(self.path)), [
+            (10.0, '{"table": "instrument"}'),
+            (12.0, '{"table": "trade"}'),
+        ])
+
+    def test_replay_of_empty_recording(self):
+        frames.FrameWriter(self.path).close()
+
+        async def replay():
+            async with frames.ReplayConnection(self.path, speed=0, loop=True) as ws:
+                await ws.recv()
+
+        with self.assertRaises(frames.FrameFileError):
+            asyncio.run(replay())
+
+    def test_not_frames_file(self):
+        with open(self.path, 'w') as file:
+            file.write('{"table": "instrument"}\n')
+
+        with self.assertRaises(frames.FrameFileError):
+            list(frames.read_frames(self.path))
+        with self.assertRaises(frames.FrameFileError):
+            frames.FrameWriter(self.path)
+
+    def test_recording_and_replay_connections(self):
+        upstream = mock.MagicMock(__aenter__=mock.AsyncMock(), __aexit__=mock.AsyncMock())
+        upstream.__aenter__.return_value.recv = mock.AsyncMock(side_effect=['first', 'second'])
+        replay = frames.ReplayConnection(self.path, speed=0)
+
+        async def record_and_replay():
+            async with frames.RecordingConnection(upstream, self.path) as ws:
+                recorded = [await ws.recv(), await ws.recv()]
+            async with replay as ws:
+                replayed = [await ws.recv(), await ws.recv()]
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(ws.recv(), timeout=0.01)
+            return recorded, replayed
+
+        self.assertEqual(asyncio.run(record_and_replay()), (['first', 'second'], ['first', 'second']))
+        self.assertEqual(replay.passes, 1)
+        self.assertEqual(replay.replayed, 2)
+
+    def test_recording_is_opened_after_connecting(self):
+        upstream = mock.MagicMock(__aenter__=mock.AsyncMock(side_effect=OSError('refused')))
+
+        async def record():
+            async with frames.RecordingConnection(upstream, self.path):
+                pass
+
+        with self.assertRaises(OSError):
+            asyncio.run(record())
+        self.assertFalse(os.path.exists(self.path))
+
+    @mock.patch('orders.exchange.connect_ws')
+    def test_recording_stays_in_record_dir(self, _):
+        directory = os.path.dirname(self.path)
+        with override_settings(UPSTREAM_RECORD_DIR=directory), \
+                mock.patch.object(BitmexInstrumentConsumer, '_generate_auth_headers', mock.AsyncMock()):
+            connection = asyncio.run(BitmexInstrumentConsumer._connect_upstream('../../etc/test', 'wss://host'))
+
+        self.assertEqual(connection.path, os.path.join(directory, 'test.frames'))
+
+    @override_settings(UPSTREAM_REPLAY='recorded.frames', UPSTREAM_REPLAY_SPEED=0, UPSTREAM_REPLAY_LOOP=True)
+    def test_relay_connects_to_replay(self):
+        connection = asyncio.run(BitmexInstrumentConsumer._connect_upstream('test', 'wss://host/realtime'))
+
+        self.assertIsInstance(connection, frames.ReplayConnection)
+        self.assertEqual((connection.path, connection.speed, connection.loop), ('recorded.frames', 0, True))
+
+
+class ArchiveTest(BaseViewTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for order_id, timestamp in (('old', '2020-01-15T10:00:00Z'), ('older', '2019-12-31T23:59:00Z'),
+                                    ('hot', '2020-03-01T00:00:00Z')):
+            order = Order.objects.create(
+                order_id=order_id, symbol='XBTUSD', volume=10, side=Side.BUY, price=9000.0, account=self.account,
+            )
+            # `timestamp` is set on creation only
+            Order.objects.filter(pk=order.pk).update(timestamp=parse_datetime(timestamp))
+
+    def test_old_months_are_moved_to_files(self):
+        archived = archive.archive_orders(datetime.datetime(2020, 2, 10), self.directory)
+
+        self.assertEqual(archived, [
+            (os.path.join(self.directory, 'orders-2019-12.csv.gz'), 1),
+            (os.path.join(self.directory, 'orders-2020-01.csv.gz'), 1),
+        ])
+        self.assertEqual(list(Order.objects.values_list('order_id', flat=True)), ['hot'])
+        self.assertEqual(
+            [row['order_id'] for row in archive.read_archived(self.directory, self.account)],
+            ['older', 'old'],
+        )
+        with self.assertRaises(archive.ArchiveError):
+            # the archived month would be overwritten
+            Order.objects.filter(order_id='hot').update(timestamp=parse_datetime('2020-01-01T00:00:00Z'))
+            archive.archive_orders(datetime.datetime(2020, 2, 10), self.directory)
+
+    def test_export_includes_archived_orders(self):
+        archive.archive_orders(datetime.datetime(2020, 2, 1), self.directory)
+
+        with override_settings(ORDERS_ARCHIVE_DIR=self.directory):
+            response = self.client.get(reverse('orders-export'), {
+                'account': self.account_name, 'since': '2020-01-01T00:00:00',
+            })
+            rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['order_id'] for row in rows], ['old', 'hot'])
+        self.assertEqual([row['timestamp'] for row in rows], ['2020-01-15T10:00:00+00:00', '2020-03-01T00:00:00+00:00'])
+
+    def test_export_invalid_time(self):
+        response = self.client.get(reverse('orders-export'), {'account': self.account_name, 'until': 'yesterday'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_command_keeps_hot_months(self):
+        stdout = io.StringIO()
+        with mock.patch('orders.management.commands.archive_orders.timezone.now',
+                        return_value=parse_datetime('2020-03-20T00:00:00Z')):
+            call_command('archive_orders', '--keep-months', '3', '--dir', self.directory, stdout=stdout,
+                         stderr=io.StringIO())
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ['orders-2019-12.csv.gz'])
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertIn('Archived 1 orders', stdout.getvalue())
+
+    def test_partitions_are_detached_before_the_copy(self):
+        january, february = (datetime.datetime(2020, month, 1, tzinfo=datetime.timezone.utc) for month in (1, 2))
+        cursor = mock.MagicMock(fetchone=mock.MagicMock(return_value=(1,)))
+        connection = mock.MagicMock(**{'cursor.return_value.__enter__.return_value': cursor})
+
+        with mock.patch('orders.archive.connection', connection), \
+                mock.patch('orders.archive.is_partitioned', return_value=True), \
+                mock.patch('orders.archive.get_partitions', return_value={february: 'orders_order_p202002'}), \
+                mock.patch('orders.archive.get_detached_partitions', return_value={january: 'orders_order_p202001'}):
+            archived = archive.archive_orders(datetime.datetime(2020, 3, 10), self.directory)
+
+        self.assertEqual([count for _, count in archived], [1, 1])
+        statements = [call.args[0].split(' ')[0:2] for call in cursor.execute.call_args_list]
+        # the interrupted archiving of january is finished, february is detached first
+        self.assertEqual(statements, [
+            ['SELECT', 'count(*)'], ['UPDATE', 'orders_conditionalorder'], ['DROP', 'TABLE'],
+            ['ALTER', 'TABLE'], ['SELECT', 'count(*)'], ['UPDATE', 'orders_conditionalorder'], ['DROP', 'TABLE'],
+        ])
+        self.assertIn('DETACH PARTITION orders_order_p202002', cursor.execute.call_args_list[3].args[0])
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], REPLICA_STALENESS=5)
+class ReplicaRouterTest(BaseViewTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_only_read_only_paths_go_to_replicas(self):
+        with replicas.replica_reads(self.account_name) as alias:
+            self.assertEqual(alias, 'replica1')
+            self.assertEqual(ReplicaRouter.db_for_read(Order), 'replica1')
+            self.assertEqual(ReplicaRouter.db_for_write(Order), 'default')
+
+        self.assertIsNone(ReplicaRouter.db_for_read(Order))
+        self.assertTrue(ReplicaRouter.allow_migrate('default', 'orders'))
+        self.assertFalse(ReplicaRouter.allow_migrate('replica1', 'orders'))
+
+    def test_written_account_is_read_from_primary(self):
+        replicas.record_write(self.account_name)
+
+        with replicas.replica_reads(self.account_name) as alias:
+            self.assertEqual(alias, 'default')
+            self.assertIsNone(ReplicaRouter.db_for_read(Order))
+        self.assertEqual(replicas.get_read_alias('another_account'), 'replica1')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        replicas.record_write(self.account_name)
+
+        self.assertEqual(replicas.get_read_alias(self.account_name), 'default')
+        self.assertIsNone(cache.get(f'orders-written:{self.account_name}'))
+
+    @mock.patch('orders.views.exchange.new_market_order', return_value={'orderID': '123', 'price': 9000.0})
+    def test_created_order_pins_reads_to_primary(self, _):
+        url = _add_query_parameters_to_url(reverse('orders'), {'account': self.account_name})
+        response = self.client.post(url, OrdersViewTest.base_post_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replicas.get_read_alias(self.account_name), 'default')
+
+
+class AdmissionTest(BaseViewTest):
+
+    @staticmethod
+    def _acquire_in_thread_(controller: AdmissionController, account_name: str, priority: int,
+                            admitted: typ.List[str], name: str) -> threading.Thread:
+        def acquire():
+            try:
+                controller.acquire(account_name, priority)
+            except Overloaded:
+                admitted.append(f'{name} shed')
+            else:
+                admitted.append(name)
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _wait_queued_(controller: AdmissionController, count: int) -> None:
+        deadline = time.monotonic() + 5
+        while len(controller.waiters) < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def test_per_account_limit(self):
+        controller = AdmissionController(max_concurrent=0, max_per_account=1, queue_size=4, queue_timeout=5)
+        controller.acquire('first')
+        controller.acquire('second')
+        admitted = []
+        thread = self._acquire_in_thread_(controller, 'first', Priority.NEW, admitted, 'queued')
+        self._wait_queued_(controller, 1)
+
+        self.assertEqual(admitted, [])
+        controller.release('first')
+        thread.join()
+        self.assertEqual(admitted, ['queued'])
+        self.assertEqual(controller.accounts, {'first': 1, 'second': 1})
+
+    def test_cancels_are_admitted_first(self):
+        controller = AdmissionController(max_concurrent=1, max_per_account=0, queue_size=4, queue_timeout=5)
+        controller.acquire('account')
+        admitted = []
+        threads = [self._acquire_in_thread_(controller, 'account', Priority.NEW, admitted, 'new')]
+        self._wait_queued_(controller, 1)
+        threads.append(self._acquire_in_thread_(controller, 'account', Priority.CANCEL, admitted, 'cancel'))
+        self._wait_queued_(controller, 2)
+
+        controller.release('account')
+        threads[1].join()
+        controller.release('account')
+        threads[0].join()
+        self.assertEqual(admitted, ['cancel', 'new'])
+
+    def test_full_queue_sheds_lower_priority(self):
+        controller = AdmissionController(max_concurrent=1, max_per_account=0, queue_size=1, queue_timeout=5)
+        controller.acquire('account')
+        admitted = []
+        thread = self._acquire_in_thread_(controller, 'account', Priority.NEW, admitted, 'new')
+        self._wait_queued_(controller, 1)
+
+        with self.assertRaises(Overloaded):
+            controller.acquire('account', Priority.NEW)
+        cancel = self._acquire_in_thread_(controller, 'account', Priority.CANCEL, admitted, 'cancel')
+        thread.join()
+        self.assertEqual(admitted, ['new shed'])
+        controller.release('account')
+        cancel.join()
+        self.assertEqual(admitted, ['new shed', 'cancel'])
+
+    def test_queue_timeout(self):
+        controller = AdmissionController(
+            max_concurrent=1, max_per_account=0, queue_size=4, queue_timeout=0.01, retry_after=3,
+        )
+        with controller.admit('account'):
+            with self.assertRaises(Overloaded) as context:
+                controller.acquire('account', Priority.CANCEL)
+        self.assertEqual(context.exception.retry_after, 3)
+        self.assertEqual((controller.active, controller.accounts, controller.waiters), (0, {}, []))
+
+    @mock.patch('orders.views.exchange.new_market_order')
+    def test_shed_request_response(self, mock_new_market_order):
+        controller = AdmissionController(
+            max_concurrent=0, max_per_account=1, queue_size=0, queue_timeout=0, retry_after=2,
+        )
+        controller.acquire(self.account_name)
+        url = _add_query_parameters_to_url(reverse('orders'), {'account': self.account_name})
+        with mock.patch('orders.admission.controller', controller):
+            response = self.client.post(url, OrdersViewTest.base_post_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '2')
+        mock_new_market_order.assert_not_called()
+
+
+class ExchangeImportTest(TestCase):
+
+    def test_workers_start_without_exchange_libraries(self):
+        result = subprocess.run(
+            [sys.executable, '-c', 'import sys, django; django.setup(); '
+                                   'import bitmex_orders.urls, bitmex_orders.routing; '
+                                   'print(sorted({"bitmex", "bravado", "websockets"} & set(sys.modules)))'],
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'bitmex_orders.settings'},
+            capture_output=True, text=True,
+        )
+
+        self.assertEqual(result.stdout.strip(), '[]', result.stderr)
+
+    def test_exchange_errors_are_imported_on_access(self):
+        self.assertIs(exchange.HTTPNotFound, HTTPNotFound)
+        with self.assertRaises(AttributeError):
+            exchange.HTTPTeapot
+
+
+class MultiAccountSubscribeTest(TestCase):
+
+    def setUp(self) -> None:
+        self.consumer = BitmexInstrumentConsumer(scope={'type': 'websocket'})
+        self.consumer.channel_name = 'consumer!1'
+        self.consumer.channel_layer = mock.MagicMock(group_add=mock.AsyncMock(), group_discard=mock.AsyncMock())
+        self.consumer.send = mock.AsyncMock()
+        self.consumer.curr_subs['first'] = DEFAULT_KEY
+        self.account_names = mock.AsyncMock(side_effect=lambda names: ['first', 'second', 'third'] if names is None
+                                            else [name for name in names if name != 'missed'])
+        self.consumer._get_account_names = self.account_names
+
+        patcher = mock.patch('orders.consumer.coordinator')
+        self.coordinator = patcher.start()
+        self.coordinator.subscribe_many = mock.AsyncMock()
+        self.addCleanup(patcher.stop)
+
+    def _receive(self, *messages: dict) -> typ.List[dict]:
+        async def receive():
+            for message in messages:
+                await self.consumer.receive(text_data=json.dumps(message))
+
+        asyncio.run(receive())
+        return [json.loads(call.kwargs['text_data']) for call in self.consumer.send.await_args_list]
+
+    def test_accounts_are_subscribed_with_one_ack(self):
+        replies = self._receive({'action': 'subscribe', 'accounts': ['first', 'second', 'third', 'second']})
+
+        self.assertEqual(replies, [{
+            'success': True, 'subscribe': 'instrument', 'accounts': ['second', 'third'], 'skipped': ['first'],
+        }])
+        self.account_names.assert_awaited_once_with(['first', 'second', 'third'])
+        self.assertEqual(self.consumer.channel_layer.group_add.await_count, 2)
+        self.coordinator.subscribe_many.assert_awaited_once_with(['second', 'third'], DEFAULT_KEY)
+        self.assertEqual(list(self.consumer.curr_subs), ['first', 'second', 'third'])
+
+    def test_all_accounts(self):
+        replies = self._receive(
+            {'action': 'subscribe', 'accounts': 'all'},
+            {'action': 'unsubscribe', 'accounts': 'all'},
+        )
+
+        self.account_names.assert_awaited_once_with(None)
+        self.assertEqual(replies[0]['accounts'], ['second', 'third'])
+        self.assertEqual(replies[1], {
+            'success': True, 'unsubscribe': 'instrument', 'accounts': ['first', 'second', 'third'], 'skipped': [],
+        })
+        self.assertEqual(self.consumer.curr_subs, {})
+        self.assertEqual(self.coordinator.unsubscribe.call_count, 3)
+
+    def test_invalid_accounts(self):
+        replies = self._receive(
+            {'action': 'subscribe', 'accounts': ['second', 'missed']},
+            {'action': 'subscribe', 'accounts': 'second'},
+            {'action': 'alert', 'accounts': ['second']},
+        )
+
+        self.assertEqual([reply['status'] for reply in replies], [400] * 3)
+        self.assertIn("['missed']", replies[0]['error'])
+        self.consumer.channel_layer.group_add.assert_not_awaited()
+        self.assertEqual(list(self.consumer.curr_subs), ['first'])
+
+
+class BenchmarkTest(TransactionTestCase):
+
+    def test_ws_fanout_scenario_finishes(self):
+        account = Account.objects.create(name='benchmark', api_key='key', api_secret='secret')
+
+        result = asyncio.run(asyncio.wait_for(
+            bench_ws_fanout(account, subscribers=2, rate=100, duration=0.3, frames=None), timeout=30,
+        ))
+
+        self.assertGreater(result.operations, 0)
+        self.assertEqual(feed_coordinator.status()['feeds'], [])
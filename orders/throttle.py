@@ -0,0 +1,72 @@
+import time
+import asyncio
+import typing as typ
+
+# sends a relayed message to a channel layer group: (group, message, received_at)
+Send = typ.Callable[[str, typ.Any, float], typ.Awaitable]
+
+
+class SymbolThrottle:
+    """Relays at most one message per `interval` seconds of every group and symbol
+
+    The first message of a symbol is relayed right away. The newer ones
+    within the interval are conflated (merged, so the fields of the older
+    ones are kept) and relayed when the interval ends, so the last value of
+    a quiet instrument is relayed as well. The upstream reader never waits,
+    so the other tables of the feed (e.g. the order books) are not delayed.
+
+    :param interval: seconds between the relayed messages of a symbol, 0 relays every message
+    :param send: coroutine function sending a message to a group
+    """
+
+    def __init__(self, interval: float, send: Send):
+        self.interval = interval
+        self.send = send
+        self.conflated = 0
+        # last relay time by groups and symbols
+        self._sent_at: typ.Dict[typ.Tuple[str, str], float] = {}
+        # conflated message and its receive time by groups and symbols
+        self._pending: typ.Dict[typ.Tuple[str, str], typ.Tuple[typ.Any, float]] = {}
+        self._flusher: typ.Optional[asyncio.Task] = None
+
+    async def relay(self, group: str, message: typ.Any, received_at: float) -> None:
+        """Relay the message now or conflate it until the interval of its symbol ends"""
+        symbol = message.get('symbol') if isinstance(message, typ.Mapping) else None
+        if not self.interval or symbol is None:
+            await self.send(group, message, received_at)
+            return
+        key, now = (group, symbol), time.monotonic()
+        if (pending := self._pending.get(key)) is not None:
+            self._pending[key] = (_merge_(pending[0], message), received_at)
+            self.conflated += 1
+        elif key not in self._sent_at or now - self._sent_at[key] >= self.interval:
+            self._sent_at[key] = now
+            await self.send(group, message, received_at)
+        else:
+            self._pending[key] = (message, received_at)
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.create_task(self._flush())
+
+    def close(self) -> None:
+        """Drop the conflated messages (e.g. when the upstream connection is closed)"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+        self._pending.clear()
+
+    async def _flush(self) -> None:
+        while self._pending:
+            now = time.monotonic()
+            due = [key for key in self._pending if now - self._sent_at[key] >= self.interval]
+            if not due:
+                await asyncio.sleep(min(self._sent_at[key] for key in self._pending) + self.interval - now)
+                continue
+            for key in due:
+                message, received_at = self._pending.pop(key)
+                self._sent_at[key] = now
+                await self.send(key[0], message, received_at)
+
+
+def _merge_(older: typ.Mapping, newer: typ.Mapping) -> typ.Mapping:
+    if all(field in newer for field in older):
+        return newer
+    return {**older, **newer}
@@ -0,0 +1,121 @@
+import sys
+import json
+import typing as typ
+from collections.abc import Mapping
+from json.encoder import encode_basestring_ascii
+
+from channels.layers import InMemoryChannelLayer
+
+# fields of every tick, in the order of its JSON object
+FIELDS = ('timestamp', 'account', 'symbol')
+
+# preallocated parts of an encoded tick, only the values (odd items) are replaced on encoding
+_parts = ['{"timestamp": ', '', ', "account": ', '', ', "symbol": ', '', ', ', '', ': ', '', '}']
+
+
+class Tick(Mapping):
+    """Relayed message of one instrument field (e.g. the last price of the default pipeline)
+
+    A compact read-only stand-in for the message dict
+    `{'timestamp': ..., 'account': ..., 'symbol': ..., <field>: <value>}`.
+    The account and symbol strings are interned, so the conflation and
+    delta keys of all the ticks share them. A tick is immutable, so the
+    in-memory channel layer passes the same tick to every subscriber instead
+    of deep copying it, and it is encoded to JSON once for all of them.
+
+    :param timestamp: Bitmex instrument timestamp
+    :param account: account name
+    :param symbol: instrument symbol
+    :param field: relayed field name (e.g. `price`)
+    :param value: relayed field value
+    """
+    __slots__ = ('timestamp', 'account', 'symbol', 'field', 'value', '_text')
+
+    def __init__(self, timestamp: typ.Optional[str], account: str, symbol: typ.Optional[str], field: str,
+                 value: typ.Any):
+        self.timestamp = timestamp
+        self.account = _intern_(account)
+        self.symbol = _intern_(symbol)
+        self.field = field
+        self.value = value
+        self._text: typ.Optional[str] = None
+
+    def __getitem__(self, key: str) -> typ.Any:
+        if key == self.field:
+            return self.value
+        if key in FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key: str, default: typ.Any = None) -> typ.Any:
+        if key == self.field:
+            return self.value
+        if key in FIELDS:
+            return getattr(self, key)
+        return default
+
+    def __contains__(self, key) -> bool:
+        return key == self.field or key in FIELDS
+
+    def __iter__(self) -> typ.Iterator[str]:
+        yield from FIELDS
+        yield self.field
+
+    def __len__(self) -> int:
+        return len(FIELDS) + 1
+
+    def __repr__(self) -> str:
+        return f'Tick({dict(self)!r})'
+
+    def __copy__(self) -> 'Tick':
+        return self
+
+    def __deepcopy__(self, memo: dict) -> 'Tick':
+        return self
+
+    def encode(self) -> str:
+        """Get JSON text of the tick, the same as `json.dumps(dict(tick))` (encoded once per tick)"""
+        if self._text is None:
+            _parts[1] = _encode_value_(self.timestamp)
+            _parts[3] = _encode_value_(self.account)
+            _parts[5] = _encode_value_(self.symbol)
+            _parts[7] = encode_basestring_ascii(self.field)
+            _parts[9] = _encode_value_(self.value)
+            self._text = ''.join(_parts)
+        return self._text
+
+
+def encode(message: typ.Any) -> str:
+    """Get JSON text of a relayed message (a tick, a dict or a pre-encoded text)"""
+    if message.__class__ is Tick:
+        return message.encode()
+    return message if isinstance(message, str) else json.dumps(message)
+
+
+def passes_ticks(channel_layer) -> bool:
+    """Whether the channel layer passes the ticks to the consumers as they are
+
+    Only the in-memory layer does, the cross-process layers (e.g. Redis)
+    serialize the messages with msgpack which knows nothing of the ticks.
+    """
+    return isinstance(channel_layer, InMemoryChannelLayer)
+
+
+def as_dict(message: typ.Any) -> typ.Any:
+    """Get the message dict of a tick to send through a cross-process channel layer (other messages as they are)"""
+    return dict(message) if message.__class__ is Tick else message
+
+
+def _intern_(value: typ.Optional[str]) -> typ.Optional[str]:
+    return sys.intern(value) if value.__class__ is str else value
+
+
+def _encode_value_(value: typ.Any) -> str:
+    if value.__class__ is str:
+        return encode_basestring_ascii(value)
+    if value.__class__ is float and value - value == 0:
+        # finite floats only, json encodes NaN and infinities on its own
+        return float.__repr__(value)
+    if value.__class__ is int:
+        return int.__repr__(value)
+    return json.dumps(value)
@@ -1,9 +1,20 @@
 from django.urls import include, path
 
-from orders.views import Orders, OrderDetail
+from orders.metrics import metrics_view
+from orders.views import (
+    Orders, OrdersFanOut, OrdersExport, OrderDetail, ConditionalOrders, ConditionalOrderDetail, Positions, Depth, Feeds,
+)
 
 urlpatterns = [
     path('orders/', Orders.as_view(), name='orders'),
+    path('orders/fanout/', OrdersFanOut.as_view(), name='orders-fanout'),
+    path('orders/export/', OrdersExport.as_view(), name='orders-export'),
     path('orders/<str:order_id>/', OrderDetail.as_view(), name='order-detail'),
+    path('conditional-orders/', ConditionalOrders.as_view(), name='conditional-orders'),
+    path('conditional-orders/<int:pk>/', ConditionalOrderDetail.as_view(), name='conditional-order-detail'),
+    path('positions/', Positions.as_view(), name='positions'),
+    path('depth/', Depth.as_view(), name='depth'),
+    path('feeds/', Feeds.as_view(), name='feeds'),
+    path('metrics', metrics_view, name='metrics'),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework'))
 ]
@@ -1,20 +1,41 @@
 import json
+import datetime
+import typing as typ
+from concurrent.futures import ThreadPoolExecutor
 
-from bitmex import bitmex
 from django.conf import settings
+from asgiref.sync import async_to_sync
+from django.utils.dateparse import parse_datetime
+from django.db import transaction
 from rest_framework import status
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.views import APIView
 from django.http.request import QueryDict
 from rest_framework.response import Response
-from django.shortcuts import get_object_or_404
-from bravado.exception import HTTPNotFound, HTTPUnauthorized, HTTPBadRequest
+from django.shortcuts import get_list_or_404, get_object_or_404
 
-from orders.serializers import OrderSerializer
-from orders.models import Account, Order
+from orders import admission, archive, conditional, exchange, metrics, orderbook, replicas
+from orders.consumer import coordinator
+from orders.positions import get_positions, record_fill_change, record_order_removal
+from orders.serializers import OrderSerializer, ConditionalOrderSerializer
+from orders.models import (
+    Account, Order, OrderStatus, OPEN_STATUSES, LIFECYCLE_FIELDS, get_lifecycle_fields,
+    ConditionalOrder, ConditionalOrderStatus,
+)
 
 
-BITMEX_TEST_MODE = settings.DEBUG
+# order fields which can be amended mapped to the Bitmex amend parameters
+AMEND_FIELDS = {'volume': 'orderQty', 'price': 'price'}
+
+# response statuses of the fan-out order placement for the Bitmex errors (by the bravado error names),
+# any other error of an account placement (e.g. a connection error) is reported as 502
+EXCHANGE_ERROR_STATUSES = {
+    'HTTPUnauthorized': status.HTTP_401_UNAUTHORIZED,
+    'HTTPNotFound': status.HTTP_404_NOT_FOUND,
+    'HTTPBadRequest': status.HTTP_400_BAD_REQUEST,
+    # shed by the admission control
+    'Overloaded': status.HTTP_503_SERVICE_UNAVAILABLE,
+}
 
 
 class Orders(APIView):
@@ -31,13 +52,16 @@ class Orders(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        orders = Order.objects.all()
-        serializer = OrderSerializer(orders, many=True)
-        orders = get_object_or_404(orders, account=account)
-        self.check_object_permissions(request, orders)
-        return Response(serializer.data)
+        with replicas.replica_reads(account.name):
+            if order_status := request.query_params.get('status'):
+                return _get_orders_by_status_(account, order_status)
+
+            orders = get_list_or_404(Order, account=account)
+            serializer = OrderSerializer(orders, many=True, context={'account': account})
+            return Response(serializer.data)
 
     @staticmethod
+    @admission.admitted(admission.Priority.NEW)
     def post(request):
         """Create new order for an account"""
         try:
@@ -49,31 +73,26 @@ class Orders(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        client = bitmex(
-            test=BITMEX_TEST_MODE,
-            api_key=account.api_key,
-            api_secret=account.api_secret,
-        )
         try:
             # FIXME: it always raises error:
             #  "Account has insufficient Available Balance"
-            result, _ = client.Order.Order_new(
+            result = exchange.new_market_order(
+                account=account,
                 symbol=request.data['symbol'],
-                orderQty=request.data['volume'],
+                volume=request.data['volume'],
                 side=request.data['side'],
-                ordType='Market',
-            ).result()
-        except HTTPUnauthorized as err:
+            )
+        except exchange.HTTPUnauthorized as err:
             return Response(
                 data={'error': str(err)},
                 status=status.HTTP_401_UNAUTHORIZED,
             )
-        except HTTPNotFound as err:
+        except exchange.HTTPNotFound as err:
             return Response(
                 data={'error': str(err)},
                 status=status.HTTP_404_NOT_FOUND,
             )
-        except HTTPBadRequest as err:
+        except exchange.HTTPBadRequest as err:
             return Response(
                 data={'error': str(err)},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -90,16 +109,189 @@ class Orders(APIView):
                 'order_id': result.get('orderID'),
                 'price': result.get('price'),
                 'account': account.id,
+                **get_lifecycle_fields(result),
             }
         )
         if serializer.is_valid():
-            serializer.save()
+            with transaction.atomic():
+                record_fill_change(serializer.save())
+            replicas.record_write(account.name)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @staticmethod
+    @admission.admitted(admission.Priority.AMEND)
+    def patch(request):
+        """Amend several orders for an account at once"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        if not isinstance(request.data, list) or not request.data:
+            return Response(
+                data={'error': 'Expected a non-empty list of orders to amend'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if invalid := [index for index, order_info in enumerate(request.data) if not isinstance(order_info, dict)]:
+            return Response(
+                data={'error': f'Expected an object with the order fields at index {invalid[0]}'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            amends = [
+                {'orderID': order_info['order_id'], **_get_amend_params_(order_info)}
+                for order_info in request.data
+            ]
+        except KeyError as err:
+            return Response(
+                data={'error': f'Missed mandatory field {err}'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except NothingToAmend as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        client = exchange.get_client(account)
+        with transaction.atomic():
+            orders = {
+                order.order_id: order
+                for order in Order.objects.select_for_update().filter(
+                    order_id__in=[amend['orderID'] for amend in amends],
+                    account=account,
+                )
+            }
+            if missed := [amend['orderID'] for amend in amends if amend['orderID'] not in orders]:
+                return Response(
+                    data={
+                        'error': f'Can not find any order with order ids: {missed!r} '
+                                 f'for the account name: {account.name!r}'
+                    },
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+
+            try:
+                result, _ = exchange.get_result(client.Order.Order_amendBulk(orders=json.dumps(amends)))
+                exchange.reads.forget(account.name)
+            except exchange.HTTPUnauthorized as err:
+                return Response(
+                    data={'error': str(err)},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+            except exchange.HTTPNotFound as err:
+                return Response(
+                    data={'error': str(err)},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            except exchange.HTTPBadRequest as err:
+                return Response(
+                    data={'error': str(err)},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            old_fills = {order_id: (order.filled_volume, order.avg_price) for order_id, order in orders.items()}
+            for order_info in result:
+                if order := orders.get(order_info.get('orderID')):
+                    _apply_amend_result_(order, order_info)
+            Order.objects.bulk_update(orders.values(), fields=['volume', 'price', *LIFECYCLE_FIELDS])
+            for order_id, order in orders.items():
+                record_fill_change(order, *old_fills[order_id])
+        replicas.record_write(account.name)
+
+        serializer = OrderSerializer(orders.values(), many=True)
+        return Response(serializer.data)
+
+
+class OrdersFanOut(APIView):
+    """Create the same order for several accounts at once"""
+
+    @staticmethod
+    def post(request):
+        """Create new order for every account in parallel
+
+        `accounts` is either a list of account names (all of them get `volume`)
+        or a mapping of account names to their own volumes.
+        """
+        try:
+            volumes = _get_fanout_volumes_(request.data)
+            symbol, side = request.data['symbol'], request.data['side']
+        except KeyError as err:
+            return Response(
+                data={'error': f'Missed mandatory field {err}'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except ValueError as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        accounts = {account.name: account for account in Account.objects.filter(name__in=volumes)}
+        if missed := [account_name for account_name in volumes if account_name not in accounts]:
+            return Response(
+                data={'error': f'Can not find these account names: {missed!r}'},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        def place_order(account_name: str):
+            try:
+                with admission.controller.admit(account_name):
+                    return exchange.new_market_order(
+                        account=accounts[account_name],
+                        symbol=symbol,
+                        volume=volumes[account_name],
+                        side=side,
+                    )
+            except Exception as err:
+                # e.g. a connection error or timeout, the orders placed for the other accounts are saved anyway
+                return err
+
+        # the exchange round-trips of all the accounts overlap, the DB is only used by the request thread
+        workers = min(settings.FANOUT_WORKERS, len(volumes))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fanout') as pool:
+            results = dict(zip(volumes, pool.map(place_order, volumes)))
+
+        response = {}
+        with transaction.atomic():
+            for account_name, result in results.items():
+                if isinstance(result, Exception):
+                    response[account_name] = {
+                        'status': EXCHANGE_ERROR_STATUSES.get(type(result).__name__, status.HTTP_502_BAD_GATEWAY),
+                        'error': str(result),
+                    }
+                    continue
+                serializer = OrderSerializer(
+                    data={
+                        'symbol': symbol,
+                        'volume': volumes[account_name],
+                        'side': side,
+                        'order_id': result.get('orderID'),
+                        'price': result.get('price'),
+                        'account': accounts[account_name].id,
+                        **get_lifecycle_fields(result),
+                    },
+                    context={'account': accounts[account_name]},
+                )
+                if serializer.is_valid():
+                    record_fill_change(serializer.save())
+                    replicas.record_write(account_name)
+                    response[account_name] = {'status': status.HTTP_201_CREATED, 'order': serializer.data}
+                else:
+                    response[account_name] = {'status': status.HTTP_400_BAD_REQUEST, 'error': serializer.errors}
+
+        if all(result['status'] == status.HTTP_201_CREATED for result in response.values()):
+            return Response(response, status=status.HTTP_201_CREATED)
+        return Response(response, status=status.HTTP_207_MULTI_STATUS)
+
 
 class OrderDetail(APIView):
-    """View/delete order for an account"""
+    """View/amend/delete order for an account"""
 
     @staticmethod
     def get(request, order_id):
@@ -113,15 +305,9 @@ class OrderDetail(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        client = bitmex(
-            test=BITMEX_TEST_MODE,
-            api_key=account.api_key,
-            api_secret=account.api_secret,
-        )
-        filter_ = json.dumps({'orderID': order_id})
         try:
-            result, _ = client.Order.Order_getOrders(filter=filter_).result()
-        except HTTPUnauthorized as err:
+            result = exchange.get_orders(account, filter_=json.dumps({'orderID': order_id}))
+        except exchange.HTTPUnauthorized as err:
             return Response(
                 data={'error': str(err)},
                 status=status.HTTP_401_UNAUTHORIZED,
@@ -138,6 +324,71 @@ class OrderDetail(APIView):
         return Response(result)
 
     @staticmethod
+    @admission.admitted(admission.Priority.AMEND)
+    def patch(request, order_id):
+        """Amend price/volume of an order for an account"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        try:
+            amend_params = _get_amend_params_(request.data)
+        except NothingToAmend as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        client = exchange.get_client(account)
+        with transaction.atomic():
+            order = Order.objects.select_for_update().filter(
+                order_id=order_id,
+                account=account,
+            ).first()
+            if not order:
+                return Response(
+                    data={
+                        'error': f'Can not find any order with order id: {order_id!r} '
+                                 f'for the account name: {account.name!r}'
+                    },
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+
+            try:
+                result, _ = exchange.get_result(client.Order.Order_amend(orderID=order_id, **amend_params))
+                exchange.reads.forget(account.name)
+            except exchange.HTTPUnauthorized as err:
+                return Response(
+                    data={'error': str(err)},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+            except exchange.HTTPNotFound as err:
+                return Response(
+                    data={'error': str(err)},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            except exchange.HTTPBadRequest as err:
+                return Response(
+                    data={'error': str(err)},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            old_fill = (order.filled_volume, order.avg_price)
+            _apply_amend_result_(order, result)
+            order.save(update_fields=['volume', 'price', *LIFECYCLE_FIELDS])
+            record_fill_change(order, *old_fill)
+        replicas.record_write(account.name)
+
+        serializer = OrderSerializer(order)
+        return Response(serializer.data)
+
+    @staticmethod
+    @admission.admitted(admission.Priority.CANCEL)
     def delete(request, order_id):
         """Remove/Cancel order for an account"""
         try:
@@ -149,19 +400,16 @@ class OrderDetail(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        client = bitmex(
-            test=BITMEX_TEST_MODE,
-            api_key=account.api_key,
-            api_secret=account.api_secret,
-        )
+        client = exchange.get_client(account)
         try:
-            client.Order.Order_cancel(orderID=order_id).result()
-        except HTTPNotFound as err:
+            exchange.get_result(client.Order.Order_cancel(orderID=order_id))
+            exchange.reads.forget(account.name)
+        except exchange.HTTPNotFound as err:
             return Response(
                 data={'error': str(err)},
                 status=status.HTTP_404_NOT_FOUND,
             )
-        except HTTPUnauthorized as err:
+        except exchange.HTTPUnauthorized as err:
             return Response(
                 data={'error': str(err)},
                 status=status.HTTP_401_UNAUTHORIZED,
@@ -176,7 +424,233 @@ class OrderDetail(APIView):
                     },
                     status=status.HTTP_404_NOT_FOUND,
                 )
-        orders.delete()
+        with transaction.atomic():
+            # the materialized positions are the same as the aggregated ones of the remaining orders
+            for order in orders.select_for_update():
+                record_order_removal(order)
+            orders.delete()
+        replicas.record_write(account.name)
+        return HttpResponse(status=204)
+
+
+class OrdersExport(APIView):
+    """Export orders of an account as CSV, including the archived ones"""
+
+    @staticmethod
+    def get(request):
+        """Stream the archived and the current orders for an account
+
+        `?since=`/`?until=` ISO 8601 times limit the orders timestamps.
+        """
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        try:
+            since, until = (_get_time_(request.query_params.get(name)) for name in ('since', 'until'))
+        except ValueError as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # the orders are read while the response is streamed, after the view returns
+        lines = archive.export_orders(account, since, until, using=replicas.get_read_alias(account.name))
+        response = StreamingHttpResponse(lines, content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="orders-{account.name}.csv"'
+        return response
+
+
+class Positions(APIView):
+    """View positions aggregated from the orders of an account"""
+
+    @staticmethod
+    def get(request):
+        """Get net volume, VWAP and P&L per symbol for an account"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        # the mark prices are relayed by the worker relaying the account feed
+        mark_prices = None
+        if not coordinator.owns(account.name):
+            mark_prices = async_to_sync(coordinator.fetch_prices)(account.name, timeout=settings.FEED_DEPTH_TIMEOUT)
+        with replicas.replica_reads(account.name):
+            return Response(get_positions(account, mark_prices))
+
+
+class Depth(APIView):
+    """View L2 order book of an instrument kept from the relayed account feed"""
+
+    # number of levels per side by default
+    default_levels = 25
+
+    @staticmethod
+    def get(request):
+        """Get the best `levels` bids and asks of the `symbol` for an account"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        symbol = request.query_params.get('symbol')
+        if symbol not in settings.ORDER_BOOK_SYMBOLS:
+            # no worker keeps its book, so there is nothing to wait for
+            return Response(
+                data={
+                    'error': f'Order book of {symbol!r} is not kept, '
+                             f'expected one of the symbols: {settings.ORDER_BOOK_SYMBOLS!r}'
+                },
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        try:
+            levels = int(request.query_params.get('levels', Depth.default_levels))
+            if levels <= 0:
+                raise ValueError(levels)
+        except ValueError:
+            return Response(
+                data={'error': 'Expected a positive number of levels'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if (book := orderbook.get_book(account.name, symbol)) is not None:
+            return Response({'account': account.name, 'symbol': symbol, **book.top(levels)})
+        # the book is kept by the worker relaying the account feed
+        if not coordinator.owns(account.name) and (depth := async_to_sync(coordinator.fetch_depth)(
+                account.name, symbol, levels, timeout=settings.FEED_DEPTH_TIMEOUT)) is not None:
+            return Response({'account': account.name, 'symbol': symbol, 'bids': depth['bids'], 'asks': depth['asks']})
+        return Response(
+            data={
+                'error': f'Order book of {symbol!r} for the account name: {account.name!r} '
+                         'is not kept by any worker yet'
+            },
+            status=status.HTTP_404_NOT_FOUND,
+        )
+
+
+class Feeds(APIView):
+    """View upstream feeds assignment of the worker processes"""
+
+    @staticmethod
+    def get(request):
+        """Get workers, feeds relayed by this worker and owners of the needed feeds
+
+        `?account=<account name>` shows the worker owning the account feed only.
+        """
+        if account_name := request.query_params.get('account'):
+            return Response({
+                'account': account_name,
+                'worker': coordinator.ring.owner(account_name),
+            })
+        return Response(coordinator.status())
+
+
+class ConditionalOrders(APIView):
+    """Views/creates conditional (stop/take-profit) orders for an account
+
+    A pending conditional order is evaluated on every relayed last price of
+    its instrument and places a market order once the trigger price is reached.
+    """
+
+    @staticmethod
+    def get(request):
+        """Get all conditional orders for an account (`?status=` to filter them)"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        conditional_orders = ConditionalOrder.objects.filter(account=account).select_related('order')
+        if conditional_order_status := request.query_params.get('status'):
+            conditional_orders = conditional_orders.filter(status=conditional_order_status)
+        serializer = ConditionalOrderSerializer(conditional_orders, many=True, context={'account': account})
+        return Response(serializer.data)
+
+    @staticmethod
+    def post(request):
+        """Create new conditional order for an account"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        serializer = ConditionalOrderSerializer(
+            data={**request.data, 'account': account.id},
+            context={'account': account},
+        )
+        if serializer.is_valid():
+            serializer.save()
+            conditional.notify_changed(account.name)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class ConditionalOrderDetail(APIView):
+    """View/cancel a conditional order for an account"""
+
+    @staticmethod
+    def get(request, pk):
+        """Get the conditional order"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        conditional_order = get_object_or_404(ConditionalOrder.objects.select_related('order'), pk=pk, account=account)
+        return Response(ConditionalOrderSerializer(conditional_order, context={'account': account}).data)
+
+    @staticmethod
+    def delete(request, pk):
+        """Cancel the conditional order if it is still pending"""
+        try:
+            account_name = request.query_params.get('account')
+            account = _get_account_(account_name)
+        except AccountNotFound as err:
+            return Response(
+                data={'error': str(err)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        # the same conditional update as the trigger claim, so a fired order is never canceled
+        canceled = ConditionalOrder.objects.filter(
+            pk=pk,
+            account=account,
+            status=ConditionalOrderStatus.PENDING,
+        ).update(status=ConditionalOrderStatus.CANCELED)
+        if not canceled:
+            conditional_order = get_object_or_404(ConditionalOrder, pk=pk, account=account)
+            return Response(
+                data={'error': f'Can not cancel the conditional order {pk!r} '
+                               f'with the status: {conditional_order.status!r}'},
+                status=status.HTTP_409_CONFLICT,
+            )
+        conditional.notify_changed(account.name)
         return HttpResponse(status=204)
 
 
@@ -184,6 +658,10 @@ class AccountNotFound(Exception):
     """Can not find an account"""
 
 
+class NothingToAmend(Exception):
+    """There are no order fields to amend"""
+
+
 def _get_account_(account_name: QueryDict) -> Account:
     """Get account model by account name
 
@@ -195,7 +673,98 @@ def _get_account_(account_name: QueryDict) -> Account:
         raise AccountNotFound('Missed mandatory \'account\' parameter for the request')
 
     try:
-        account = Account.objects.get(name=account_name)
+        with metrics.timer('stage_duration_seconds', stage='account_lookup'):
+            account = Account.objects.get(name=account_name)
     except Account.DoesNotExist:
         raise AccountNotFound(f'Can not find this account name: {account_name!r}')
     return account
+
+
+def _get_time_(value: typ.Optional[str]) -> typ.Optional[datetime.datetime]:
+    """Get aware time from the ISO 8601 query parameter (UTC if it has no offset)
+
+    :raise ValueError: if the time is not valid
+    """
+    if not value:
+        return None
+    if (time := parse_datetime(value)) is None:
+        raise ValueError(f'Expected an ISO 8601 time, got: {value!r}')
+    return time if time.tzinfo is not None else time.replace(tzinfo=datetime.timezone.utc)
+
+
+def _get_fanout_volumes_(data: dict) -> typ.Dict[str, int]:
+    """Get order volume for every account of the fan-out request
+
+    :param data: request data with the `accounts` names list or names to volumes mapping
+    :return: order volumes by account names
+    :raise KeyError: if a mandatory field is missed
+    :raise ValueError: if there are no accounts
+    """
+    accounts = data['accounts']
+    if isinstance(accounts, dict):
+        volumes = dict(accounts)
+    elif isinstance(accounts, list):
+        if not all(isinstance(account_name, str) for account_name in accounts):
+            raise ValueError('Expected account names as strings')
+        volumes = dict.fromkeys(accounts, data['volume'])
+    else:
+        raise ValueError('Expected a list of account names or a mapping of account names to volumes')
+    if not volumes:
+        raise ValueError('Expected at least one account')
+    return volumes
+
+
+def _get_amend_params_(data: dict) -> dict:
+    """Get Bitmex amend parameters from the request data
+
+    :param data: request data with the order fields to change
+    :return: Bitmex amend parameters
+    :raise NothingToAmend: if there are no fields to change
+    """
+    params = {
+        bitmex_field: data[field]
+        for field, bitmex_field in AMEND_FIELDS.items()
+        if field in data
+    }
+    if not params:
+        raise NothingToAmend(f'Missed any of the fields to amend: {list(AMEND_FIELDS)}')
+    return params
+
+
+def _apply_amend_result_(order: Order, order_info: dict) -> None:
+    """Update order model fields from the Bitmex amend result
+
+    :param order: local order model
+    :param order_info: order info returned by Bitmex
+    """
+    for field, bitmex_field in AMEND_FIELDS.items():
+        if (value := order_info.get(bitmex_field)) is not None:
+            setattr(order, field, value)
+    for field, value in get_lifecycle_fields(order_info).items():
+        setattr(order, field, value)
+
+
+def _get_orders_by_status_(account: Account, order_status: str) -> Response:
+    """Get account orders with the needed status straight from the DB
+
+    :param account: account model
+    :param order_status: 'open' for all the resting orders or one of the order statuses
+    :return: serialized orders
+    """
+    if order_status == 'open':
+        # served by the partial index on open orders per account
+        statuses = OPEN_STATUSES
+    elif order_status in OrderStatus.values:
+        statuses = (order_status,)
+    else:
+        return Response(
+            data={
+                'error': f'Got unknown order status: {order_status!r}. '
+                         f'Available statuses are: {["open", *OrderStatus.values]}'
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    orders = Order.objects.filter(account=account, status__in=statuses)
+    serializer = OrderSerializer(orders, many=True, context={'account': account})
+    return Response(serializer.data)